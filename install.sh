@@ -91,6 +91,8 @@ function update-nginx() {
     
 function restart-services() {
     systemctl restart nbh-monitor
+    # the collector is optional, see stats_collector_socket
+    [ -n "$stats_collector_socket" ] && systemctl restart nbh-collector
     systemctl restart nginx
     systemctl restart nbh-uwsgi
 }
@@ -98,11 +100,17 @@ function restart-services() {
 function enable-services() {
     rsync $rsopts systemd/nbh-uwsgi.service /etc/systemd/system/
     rsync $rsopts systemd/nbh-monitor.service /etc/systemd/system/
+    rsync $rsopts systemd/nbh-collector.service /etc/systemd/system/
     systemctl daemon-reload
     systemctl enable docker
     systemctl enable nginx
     systemctl enable nbh-uwsgi
     systemctl enable nbh-monitor
+    if [ -n "$stats_collector_socket" ]; then
+        systemctl enable nbh-collector
+    else
+        systemctl disable --now nbh-collector >& /dev/null
+    fi
 }
 
 function default-main() {
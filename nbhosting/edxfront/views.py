@@ -4,6 +4,8 @@ import pprint
 import hashlib
 import re
 
+import docker
+
 from django.shortcuts import render, redirect
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, HttpResponseForbidden
 
@@ -81,6 +83,70 @@ def authorized(request):
                     "explanation = {}".format(explanation))
     return result
 
+def notebook_url(request, course, student, notebook_withext, port, token):
+    # redirect with same proto (http or https) as incoming 
+    scheme = request.scheme
+    # get the host part of the incoming URL
+    host = request.get_host()
+    # remove initial port if present in URL
+    if ':' in host:
+        host, _ = host.split(':', 1)
+    ########## forge a URL that nginx will intercept
+    # port depends on scheme - we do not specify it
+    # passing along course and student is for 'reset_from_origin'
+    url = "{scheme}://{host}/{port}/notebooks/{path}?token={token}&course={course}&student={student}"\
+          .format(scheme=scheme, host=host, port=port,
+                  path=notebook_withext, token=token,
+                  course=course, student=student)
+    logger.info("edxfront: redirecting to {}".format(url))
+    return url
+
+
+# one client per worker process, created on first use
+_docker_client = None
+
+def unpause_fast_path(course, student, notebook_withext):
+    """
+    a container that the monitor has paused only needs to be resumed,
+    which takes milliseconds; if in addition the student already has
+    that notebook, there is no need to go through nbh at all
+
+    dockerd is only asked when the monitor has left a marker
+    for that container, see Stats.mark_paused
+
+    returns a tuple (action, port, token), or None if the regular
+    path must be taken
+    """
+    global _docker_client
+    stats = Stats(course)
+    if not stats.is_marked_paused(student):
+        return None
+    student_notebook = Path(sitesettings.nbhroot) / "students" / student \
+                       / course / notebook_withext
+    if not student_notebook.exists():
+        return None
+    # the container name is also the jupyter token
+    container_name = "{}-x-{}".format(course, student)
+    try:
+        if _docker_client is None:
+            _docker_client = docker.from_env(version='auto')
+        container = _docker_client.containers.get(container_name)
+        if container.status != 'paused':
+            # resumed in the meanwhile
+            stats.mark_paused(student, False)
+            return None
+        container.unpause()
+        stats.mark_paused(student, False)
+        port = int(container.attrs['NetworkSettings']
+                   ['Ports']['8888/tcp'][0]['HostPort'])
+        logger.info("edxfront: unpaused {}".format(container_name))
+        return 'unpaused', port, container_name
+    except Exception as e:
+        logger.exception("edxfront: cannot unpause {}, using nbh"
+                         .format(container_name))
+        return None
+
+
 def edx_request(request, course, student, notebook):
 
     """
@@ -99,6 +165,14 @@ def edx_request(request, course, student, notebook):
     # have we received a request to force the copy (for reset_from_origin)
     forcecopy = request.GET.get('forcecopy', False)
 
+    if not forcecopy:
+        fast_path = unpause_fast_path(course, student, notebook_withext)
+        if fast_path is not None:
+            action, actual_port, jupyter_token = fast_path
+            Stats(course).record_open_notebook(student, notebook, action, actual_port)
+            return HttpResponseRedirect(notebook_url(
+                request, course, student, notebook_withext, actual_port, jupyter_token))
+
     subcommand = 'docker-view-student-course-notebook'
     
     # build command
@@ -142,21 +216,8 @@ def edx_request(request, course, student, notebook):
 
         # remember that in events file for statistics
         Stats(course).record_open_notebook(student, notebook, action, actual_port)
-        # redirect with same proto (http or https) as incoming 
-        scheme = request.scheme
-        # get the host part of the incoming URL
-        host = request.get_host()
-        # remove initial port if present in URL
-        if ':' in host:
-            host, _ = host.split(':', 1)
-        ########## forge a URL that nginx will intercept
-        # port depends on scheme - we do not specify it
-        # passing along course and student is for 'reset_from_origin'
-        url = "{scheme}://{host}/{port}/notebooks/{path}?token={token}&course={course}&student={student}"\
-              .format(scheme=scheme, host=host, port=actual_port,
-                      path=notebook_withext, token=jupyter_token,
-                      course=course, student=student)
-        logger.info("edxfront: redirecting to {}".format(url))
+        url = notebook_url(request, course, student, notebook_withext,
+                           actual_port, jupyter_token)
 #        return HttpResponse('<a href="{}">click to be redirected</h1>'.format(url))
         return HttpResponseRedirect(url)           
 
@@ -43,9 +43,15 @@ urlpatterns = [
     url(r'^nbh/courses/clear-staff/(?P<course>[\w_.-]+)',       nbhosting.courses.views.clear_staff),
     url(r'^nbh/courses',                                        nbhosting.courses.views.list_courses),
     url(r'^nbh/course/(?P<course>[\w_.-]+)',                    nbhosting.courses.views.list_course),
+    url(r'^nbh/stats-overview/json',                            nbhosting.stats.views.send_overview),
+    url(r'^nbh/stats-overview',                                 nbhosting.stats.views.show_overview),
     url(r'^nbh/stats/daily_metrics/(?P<course>[\w_.-]+)',       nbhosting.stats.views.send_daily_metrics),
     url(r'^nbh/stats/monitor_counts/(?P<course>[\w_.-]+)',      nbhosting.stats.views.send_monitor_counts),
     url(r'^nbh/stats/material_usage/(?P<course>[\w_.-]+)',      nbhosting.stats.views.send_material_usage),
+    url(r'^nbh/stats/student/(?P<course>[\w_.-]+)/(?P<student>[\w_.-]+)',
+                                                                nbhosting.stats.views.send_student_timeline),
+    url(r'^nbh/stats/live/(?P<course>[\w_.-]+)',                nbhosting.stats.views.send_live),
+    url(r'^nbh/stats/all/(?P<course>[\w_.-]+)',                 nbhosting.stats.views.send_all_metrics),
     url(r'^nbh/stats/(?P<course>[\w_.-]+)',                     nbhosting.stats.views.show_stats),
     url(r'^nbh',                                                nbhosting.main.views.welcome),
 ]
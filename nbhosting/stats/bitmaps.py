@@ -0,0 +1,112 @@
+"""
+compact sets for the stats computations
+
+students are 32-char hashes, and notebooks are paths; rather than
+keeping sets of these strings - one per day, one per notebook... -
+each scan maps them once to dense integers with a NameIds instance,
+and sets of such integers are stored as Bitmap instances
+"""
+
+import numpy as np
+
+
+class NameIds:
+    """
+    the mapping name -> dense id, ids being allocated
+    in order of first appearance
+    """
+    def __init__(self):
+        self.index = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def id(self, name):
+        try:
+            return self.index[name]
+        except KeyError:
+            id = self.index[name] = len(self.names)
+            self.names.append(name)
+            return id
+
+
+class Bitmap:
+    """
+    a set of dense ids, stored as one byte per id in a bytearray
+    that grows as needed, so that add() and `in` are cheap;
+    bulk operations are done with numpy on that same buffer
+
+    once a bitmap is not expected to change, pack() divides its
+    size by 8; it is transparently unpacked if needed again
+    """
+    def __init__(self):
+        self._bytes = bytearray()
+        # when packed, self._bytes is empty
+        self._packed = None
+        self._length = 0
+
+    @staticmethod
+    def from_ids(ids):
+        bitmap = Bitmap()
+        for id in ids:
+            bitmap.add(id)
+        return bitmap
+
+    def _unpack(self):
+        if self._packed is not None:
+            self._bytes = bytearray(np.unpackbits(
+                np.frombuffer(self._packed, dtype=np.uint8),
+                count=self._length).tobytes())
+            self._packed = None
+        return self._bytes
+
+    def _array(self):
+        # a numpy view; must not be kept while the bitmap may grow
+        return np.frombuffer(self._unpack(), dtype=bool)
+
+    def _grow(self, length):
+        bytes = self._unpack()
+        if length > len(bytes):
+            bytes.extend(b'\0' * max(length - len(bytes), len(bytes)))
+
+    # these 2 are called for each event
+    def __contains__(self, id):
+        if self._packed is not None:
+            self._unpack()
+        bytes = self._bytes
+        return id < len(bytes) and bytes[id] != 0
+
+    def add(self, id):
+        if self._packed is not None:
+            self._unpack()
+        if id >= len(self._bytes):
+            self._grow(id + 1)
+        self._bytes[id] = 1
+
+    def count(self):
+        return int(np.count_nonzero(self._array()))
+
+    def count_new(self, other):
+        """
+        the number of ids in self and not in other
+        """
+        mine, others = self._array(), other._array()
+        common = min(len(mine), len(others))
+        return int(np.count_nonzero(mine[:common] & ~others[:common])
+                   + np.count_nonzero(mine[common:]))
+
+    def update(self, other):
+        """
+        add all the ids in other
+        """
+        self._grow(len(other._unpack()))
+        others = other._array()
+        mine = self._array()
+        mine[:len(others)] |= others
+
+    def pack(self):
+        if self._packed is None:
+            self._length = len(self._bytes)
+            self._packed = np.packbits(self._array()).tobytes()
+            self._bytes = bytearray()
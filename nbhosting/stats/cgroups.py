@@ -0,0 +1,149 @@
+"""
+cpu and memory accounting of the containers, straight from the cgroup files
+
+asking dockerd for stats costs one streaming request per container,
+that takes a couple seconds to return; instead, the kernel already
+exposes the figures of each container in its cgroup directory, so
+reading them for all containers only takes a few small reads
+
+both layouts are supported
+* cgroup v2, where /sys/fs/cgroup/cgroup.controllers exists:
+  memory.current, memory.stat and cpu.stat in the container directory
+* cgroup v1: memory.usage_in_bytes and memory.stat in the memory
+  hierarchy, and cpuacct.usage in the cpuacct one
+
+and in both cases a container directory is named either
+  system.slice/docker-<id>.scope       with the systemd cgroup driver
+  docker/<id>                          with the cgroupfs one
+
+like docker stats, memory does not account for the page cache
+that could be reclaimed right away; cpu is a percentage of one core,
+averaged since the previous sample of the same container
+"""
+
+import re
+import time
+from pathlib import Path
+
+from nbhosting.main.settings import logger
+
+container_id_regexp = re.compile(r"\A[0-9a-f]{64}\Z")
+
+
+def read_loadavg(path=Path("/proc/loadavg")):
+    """
+    the 3 load averages as floats
+    """
+    return [float(x) for x in path.read_text().split()[:3]]
+
+
+def _read_int(path):
+    return int(path.read_text())
+
+
+def _read_keyed(path):
+    """
+    the contents of files like memory.stat or cpu.stat as a dict
+    """
+    result = {}
+    for line in path.read_text().splitlines():
+        key, _, value = line.partition(' ')
+        try:
+            result[key] = int(value)
+        except ValueError:
+            pass
+    return result
+
+
+class CgroupAccounting:
+
+    def __init__(self, root=Path("/sys/fs/cgroup")):
+        self.root = Path(root)
+        self.unified = (self.root / "cgroup.controllers").exists()
+        # container id -> (time, cumulated cpu in ns) at previous sample
+        self.previous = {}
+
+    def container_dirs(self, controller):
+        """
+        a dict container id -> cgroup directory in that controller's
+        hierarchy - the controller is ignored with cgroup v2
+        """
+        if self.unified:
+            base = self.root
+        else:
+            base = self.root / controller
+            # cpuacct is often mounted together with cpu
+            if not base.exists() and controller in ('cpu', 'cpuacct'):
+                base = self.root / "cpu,cpuacct"
+        dirs = {}
+        for path in base.glob("system.slice/docker-*.scope"):
+            dirs[path.name[len("docker-"):-len(".scope")]] = path
+        for path in base.glob("docker/*"):
+            if container_id_regexp.match(path.name):
+                dirs[path.name] = path
+        return dirs
+
+    def _memory(self, path):
+        if self.unified:
+            usage = _read_int(path / "memory.current")
+            inactive = _read_keyed(path / "memory.stat").get('inactive_file', 0)
+        else:
+            usage = _read_int(path / "memory.usage_in_bytes")
+            inactive = _read_keyed(path / "memory.stat").get('total_inactive_file', 0)
+        return max(0, usage - inactive)
+
+    def _cpu_ns(self, path):
+        if self.unified:
+            return 1000 * _read_keyed(path / "cpu.stat")['usage_usec']
+        return _read_int(path / "cpuacct.usage")
+
+    def memory(self, ids):
+        """
+        a dict container id -> memory in bytes, for the containers in ids
+        that can be found; unlike sample(), this leaves the cpu figures alone
+        """
+        memory_dirs = self.container_dirs('memory')
+        result = {}
+        for id in ids:
+            try:
+                result[id] = self._memory(memory_dirs[id])
+            except (KeyError, FileNotFoundError, ProcessLookupError):
+                pass
+            except Exception as e:
+                logger.exception("cannot read cgroup memory for {}"
+                                 .format(id[:12]))
+        return result
+
+    def sample(self, ids=None):
+        """
+        returns a dict container id -> (memory in bytes, cpu percent),
+        for the containers in ids if specified, or all the ones found;
+        cpu percent is None on the first sample of a container
+
+        containers that vanish in the meanwhile are just left out
+        """
+        memory_dirs = self.container_dirs('memory')
+        cpu_dirs = memory_dirs if self.unified else self.container_dirs('cpuacct')
+        if ids is None:
+            ids = memory_dirs.keys()
+        now = time.monotonic()
+        result = {}
+        previous, self.previous = self.previous, {}
+        for id in ids:
+            try:
+                memory = self._memory(memory_dirs[id])
+                cpu_ns = self._cpu_ns(cpu_dirs[id])
+            except (KeyError, FileNotFoundError, ProcessLookupError):
+                continue
+            except Exception as e:
+                logger.exception("cannot read cgroup accounting for {}"
+                                 .format(id[:12]))
+                continue
+            self.previous[id] = (now, cpu_ns)
+            cpu_percent = None
+            if id in previous:
+                then, then_ns = previous[id]
+                if now > then and cpu_ns >= then_ns:
+                    cpu_percent = 100 * (cpu_ns - then_ns) / ((now - then) * 1e9)
+            result[id] = (memory, cpu_percent)
+        return result
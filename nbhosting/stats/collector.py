@@ -0,0 +1,196 @@
+"""
+a local collector for the events lines
+
+without it, each web worker appends to raw/<course>/events.raw on its
+own, on the path of the request that opens a notebook, and while up to
+as many other workers do the same
+
+with stats_collector_socket set, web workers rather send each event
+as a datagram on that unix socket, which never blocks; the collector -
+see scripts/nbh-collector - gathers them, and every stats_collector_period
+seconds writes each course's events with a single write() - see
+Stats.write_events - and fsync's the events.raw files written since
+the last sync, at most every stats_collector_fsync seconds
+
+if the collector is not running, or if its socket buffer is full,
+workers just write the event themselves as before
+"""
+
+import os
+import re
+import sys
+import time
+import stat
+import socket
+import select
+import signal
+from collections import defaultdict
+
+from nbhosting.main.settings import sitesettings, logger
+
+# a datagram is one line of ascii-encoded fields
+#   epoch course student notebook action port
+nb_fields = 6
+
+# the names that can show up in a course directory
+course_regexp = re.compile(r"\A[\w.-]+\Z")
+
+
+def socket_path():
+    return getattr(sitesettings, 'stats_collector_socket', None)
+
+
+# one client socket per worker process, created on first use
+_client = None
+# so that a collector being down only gets logged once
+_collector_up = True
+
+def send_event(course, epoch, student, notebook, action, port):
+    """
+    returns True if the event was handed over to the collector,
+    False if the caller needs to write it itself
+    """
+    global _client, _collector_up
+    path = socket_path()
+    if not path:
+        return False
+    try:
+        if _client is None:
+            _client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            _client.setblocking(False)
+        _client.sendto("{} {} {} {} {} {}".format(
+            epoch, course, student, notebook, action, port).encode(), path)
+        if not _collector_up:
+            logger.info("events collector back on {}".format(path))
+            _collector_up = True
+        return True
+    except OSError as e:
+        # no collector listening, or its buffer is full
+        if _collector_up:
+            logger.warning("events collector unavailable on {} ({}), "
+                           "writing events directly".format(path, e))
+            _collector_up = False
+        return False
+
+
+def parse_event(datagram):
+    """
+    returns a tuple (course, (epoch, student, notebook, action, port))
+    or None if datagram is misformed
+    """
+    try:
+        fields = datagram.decode().split()
+        if len(fields) != nb_fields:
+            return None
+        epoch, course, student, notebook, action, port = fields
+        if not course_regexp.match(course):
+            return None
+        return course, (int(epoch), student, notebook, action, port)
+    except Exception as e:
+        return None
+
+
+class Collector:
+    """
+    receives events on a unix datagram socket,
+    and writes them in batches, one per course
+    """
+    def __init__(self, path, period=1., fsync_period=5., max_batch=1000):
+        self.path = path
+        self.period = period
+        self.fsync_period = fsync_period
+        self.max_batch = max_batch
+        # course -> list of events, in the order received
+        self.pending = defaultdict(list)
+        self.nb_pending = 0
+        # the courses written since the last fsync
+        self.unsynced = set()
+        self.next_fsync = time.time() + fsync_period
+        self.socket = None
+
+    def bind(self):
+        # a leftover from a previous run
+        try:
+            if stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.socket.setblocking(False)
+
+    def receive(self):
+        """
+        read all the datagrams that are available
+        """
+        while True:
+            try:
+                datagram = self.socket.recv(64 * 1024)
+            except BlockingIOError:
+                return
+            parsed = parse_event(datagram)
+            if parsed is None:
+                logger.error("collector: ignoring misformed event {}"
+                             .format(datagram[:200]))
+                continue
+            course, event = parsed
+            self.pending[course].append(event)
+            self.nb_pending += 1
+
+    def flush(self):
+        # imported here because stats needs this module
+        from nbhosting.stats.stats import Stats
+        for course, events in self.pending.items():
+            # events from several workers may arrive slightly out of order
+            events.sort(key=lambda event: event[0])
+            try:
+                Stats(course).write_events(events)
+                self.unsynced.add(course)
+            except Exception as e:
+                logger.exception("collector: cannot write {} events for {}"
+                                 .format(len(events), course))
+        self.pending.clear()
+        self.nb_pending = 0
+
+    def sync(self):
+        """
+        fsync the events files written since the last sync
+        """
+        from nbhosting.stats.stats import Stats
+        for course in self.unsynced:
+            path = Stats(course).notebook_events_path()
+            try:
+                with path.open('rb') as f:
+                    os.fsync(f.fileno())
+            except Exception as e:
+                logger.exception("collector: cannot sync {}".format(path))
+        self.unsynced.clear()
+        self.next_fsync = time.time() + self.fsync_period
+
+    def run_forever(self):
+        self.bind()
+        logger.info("events collector listening on {}".format(self.path))
+        # stop cleanly on systemctl stop
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        deadline = time.time() + self.period
+        try:
+            while True:
+                readable, _, _ = select.select(
+                    [self.socket], [], [], max(0, deadline - time.time()))
+                if readable:
+                    self.receive()
+                if time.time() >= deadline or self.nb_pending >= self.max_batch:
+                    if self.nb_pending:
+                        self.flush()
+                    deadline = time.time() + self.period
+                # even if nothing comes in afterwards
+                if self.unsynced and time.time() >= self.next_fsync:
+                    self.sync()
+        finally:
+            # do not lose what is already received
+            self.receive()
+            self.flush()
+            self.sync()
+            self.socket.close()
+            os.unlink(self.path)
+            logger.info("events collector stopped")
@@ -0,0 +1,438 @@
+"""
+a binary, columnar, counterpart of events.raw
+
+events.raw has lines like
+    2018-01-08T09:12:43 flotpython 6a1f...e3 w1/w1-s1-c1-intro created 9234
+
+and re-parsing millions of these lines is expensive, so each event
+is also stored in raw/<course>/ as one record spread in 4 columns
+
+* events.time       int64   epoch seconds
+* events.student    uint32  index in students.dict
+* events.notebook   uint32  index in notebooks.dict
+* events.action     uint8   index in actions.dict
+
+the .dict files have one name per line, so that an id is a line number
+all files are append-only, and readers can memmap the columns
+
+appending to - or rebuilding - the store requires to hold the lock
+that Stats also uses when it writes into events.raw, so that
+both files remain in sync
+"""
+
+import os
+import fcntl
+import struct
+import calendar
+from contextlib import contextmanager
+
+import numpy as np
+
+from nbhosting.main.settings import logger
+
+
+# all columns are little-endian
+columns = [
+    # name      struct   numpy
+    ('time',     '<q',   '<i8'),
+    ('student',  '<I',   '<u4'),
+    ('notebook', '<I',   '<u4'),
+    ('action',   '<B',   '<u1'),
+]
+
+# each action is mapped on a uint8
+max_actions = 256
+
+# the actions that are not about opening a notebook, i.e.
+# monitor 'killing' or 'pausing' a container, or 'culling' an idle kernel
+non_open_actions = ('killing', 'pausing', 'culling')
+
+
+def epoch_from_timestamp(timestamp, _day_cache={}):
+    """
+    a fast equivalent of calendar.timegm(time.strptime(timestamp, time_format))
+    for timestamps like 2018-01-08T09:12:43
+    the epoch for the beginning of each day is cached
+    """
+    day = timestamp[:10]
+    try:
+        day_epoch = _day_cache[day]
+    except KeyError:
+        day_epoch = calendar.timegm(
+            (int(day[:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+        _day_cache[day] = day_epoch
+    return (day_epoch + 3600 * int(timestamp[11:13])
+            + 60 * int(timestamp[14:16]) + int(timestamp[17:19]))
+
+
+class Interner:
+    """
+    the mapping name -> id for one .dict file
+
+    the file is re-read incrementally, so that several processes
+    can share the same file - provided that they hold the lock
+    when calling refresh() and intern()
+    """
+    def __init__(self, path):
+        self.path = path
+        self._reset()
+
+    def _reset(self):
+        self.names = []
+        self.index = {}
+        self.inode = None
+        self.offset = 0
+
+    def refresh(self):
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            self._reset()
+            return
+        # file was rebuilt by convert(), ids are no longer valid
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self._reset()
+            self.inode = stat.st_ino
+        if stat.st_size == self.offset:
+            return
+        with self.path.open('rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        # only consider complete lines
+        chunk = chunk[:chunk.rfind(b'\n')+1]
+        self.offset += len(chunk)
+        for name in chunk.decode().splitlines():
+            self.index[name] = len(self.names)
+            self.names.append(name)
+
+    def intern(self, name):
+        try:
+            return self.index[name]
+        except KeyError:
+            pass
+        with self.path.open('a') as f:
+            f.write(name + "\n")
+        self.refresh()
+        return self.index[name]
+
+
+class ColumnarEvents:
+
+    def __init__(self, course_dir):
+        self.course_dir = course_dir
+        self.students = Interner(course_dir / "students.dict")
+        self.notebooks = Interner(course_dir / "notebooks.dict")
+        self.actions = Interner(course_dir / "actions.dict")
+
+    def column_path(self, column):
+        return self.course_dir / "events.{}".format(column)
+
+    def lock_path(self):
+        return self.course_dir / "events.lock"
+
+    @contextmanager
+    def locked(self, shared=False):
+        with self.lock_path().open('a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def exists(self):
+        return all(self.column_path(column).exists()
+                   for column, *_ in columns)
+
+    def create(self):
+        """
+        create an empty store - caller must hold the lock
+        """
+        for column, *_ in columns:
+            self.column_path(column).touch()
+        for interner in self.students, self.notebooks, self.actions:
+            interner.path.touch()
+
+    def _nb_records(self):
+        return min(self.column_path(column).stat().st_size // struct.calcsize(fmt)
+                   for column, fmt, _ in columns)
+
+    def _record(self, position):
+        """
+        the record at that position as a tuple (epoch, student, notebook, action)
+        with names rather than ids - caller must hold the lock
+        """
+        values = []
+        for column, fmt, _ in columns:
+            size = struct.calcsize(fmt)
+            with self.column_path(column).open('rb') as f:
+                f.seek(position * size)
+                values.append(struct.unpack(fmt, f.read(size))[0])
+        epoch, *ids = values
+        names = []
+        for interner, id in zip((self.students, self.notebooks, self.actions), ids):
+            interner.refresh()
+            names.append(interner.names[id])
+        return (epoch, *names)
+
+    def is_valid(self, events_path, day_index=None, tail=4096):
+        """
+        check that the store is consistent with events.raw
+
+        the last record must match the last well-formed line in events.raw;
+        and if day_index is provided, the lines since the beginning of the
+        last day must match as many records at the end of the store
+
+        like for the day index, this is a cheap check that catches
+        events.raw being written without the store, or truncated,
+        or rewritten; there is nothing to compare with when events.raw
+        has no line, e.g. right after it was sealed, and then it is True
+        """
+        with self.locked(shared=True):
+            try:
+                size = events_path.stat().st_size
+            except FileNotFoundError:
+                size = 0
+            entries = day_index.entries() if day_index is not None else []
+            # the index may be out of date itself
+            indexed = bool(entries) and entries[-1][1] < size
+            start = entries[-1][1] if indexed else max(0, size - tail)
+            lines = []
+            if size:
+                with events_path.open('rb') as f:
+                    f.seek(start)
+                    # the last one is incomplete, or empty
+                    lines = f.read(size - start).split(b'\n')[:-1]
+                # the first one may be partial
+                if not indexed and start:
+                    lines = lines[1:]
+            parsed = []
+            for bytes_line in reversed(lines):
+                try:
+                    timestamp, _, student, notebook, action, _ = \
+                        bytes_line.decode().split()
+                    parsed.append((epoch_from_timestamp(timestamp),
+                                   student, notebook, action))
+                except Exception as e:
+                    continue
+                # no need to parse more
+                if not indexed:
+                    break
+            if not parsed:
+                return True
+            nb_records = self._nb_records()
+            if len(parsed) > nb_records:
+                return False
+            try:
+                if self._record(nb_records - 1) != parsed[0]:
+                    return False
+                # misformed lines do not make it into the store
+                return not indexed or \
+                    self._record(nb_records - len(parsed)) == parsed[-1]
+            except (IndexError, struct.error) as e:
+                return False
+
+    def append(self, epoch, student, notebook, action):
+        """
+        add one event - caller must hold the lock
+        """
+        self.extend([(epoch, student, notebook, action)])
+
+    def extend(self, events):
+        """
+        add several events, each as a tuple (epoch, student, notebook, action),
+        with one write per column - caller must hold the lock
+        """
+        for interner in self.students, self.notebooks, self.actions:
+            interner.refresh()
+        values = {column: [] for column, *_ in columns}
+        for epoch, student, notebook, action in events:
+            action_id = self.actions.intern(action)
+            if action_id >= max_actions:
+                raise ValueError("too many actions in {}".format(self.actions.path))
+            values['time'].append(epoch)
+            values['student'].append(self.students.intern(student))
+            values['notebook'].append(self.notebooks.intern(notebook))
+            values['action'].append(action_id)
+        # a previous append may have been interrupted halfway
+        # make sure all columns are aligned before adding records
+        nb_records = self._nb_records()
+        for column, fmt, _ in columns:
+            with self.column_path(column).open('ab') as f:
+                f.truncate(nb_records * struct.calcsize(fmt))
+                f.write(struct.pack("<{}{}".format(len(values[column]), fmt[1:]),
+                                    *values[column]))
+
+    def convert(self, events_path, segments=()):
+        """
+        rebuild the store from scratch from an existing events.raw,
+        preceded by its closed segments if any - see segments.py
+        caller must hold the lock
+
+        returns the number of events in the store
+        """
+        students, notebooks, actions = {}, {}, {}
+        values = {column: [] for column, *_ in columns}
+        sources = [(segment.path, segment.lines) for segment in segments]
+        sources.append((events_path, lambda: events_path.open('rb')))
+        for path, open_lines in sources:
+            lines = open_lines()
+            for lineno, bytes_line in enumerate(lines, 1):
+                if not bytes_line.endswith(b'\n'):
+                    break
+                try:
+                    timestamp, _, student, notebook, action, _ = \
+                        bytes_line.decode().split()
+                    epoch = epoch_from_timestamp(timestamp)
+                    action_id = actions.setdefault(action, len(actions))
+                    if action_id >= max_actions:
+                        raise ValueError("too many actions")
+                except Exception as e:
+                    logger.error("{}:{}: skipped misformed events line :{} - {}"
+                                 .format(path, lineno, bytes_line, e))
+                    continue
+                values['time'].append(epoch)
+                values['student'].append(students.setdefault(student, len(students)))
+                values['notebook'].append(notebooks.setdefault(notebook, len(notebooks)))
+                values['action'].append(action_id)
+            lines.close()
+        # write everything aside, and then rename
+        renames = []
+        for column, _, dtype in columns:
+            path = self.column_path(column)
+            tmp_path = path.with_name(path.name + ".tmp")
+            np.array(values[column], dtype=dtype).tofile(str(tmp_path))
+            renames.append((tmp_path, path))
+        for interner, names in ((self.students, students),
+                                (self.notebooks, notebooks),
+                                (self.actions, actions)):
+            tmp_path = interner.path.with_name(interner.path.name + ".tmp")
+            with tmp_path.open('w') as f:
+                # dicts preserve insertion order, i.e. ids
+                for name in names:
+                    f.write(name + "\n")
+            renames.append((tmp_path, interner.path))
+        for tmp_path, path in renames:
+            tmp_path.rename(path)
+        return len(values['time'])
+
+    def load(self):
+        """
+        returns a LoadedEvents instance, where columns are memmapped
+        an empty LoadedEvents is returned if the store does not exist
+        """
+        with self.locked(shared=True):
+            if not self.exists():
+                return LoadedEvents({column: np.empty(0, dtype=dtype)
+                                     for column, _, dtype in columns},
+                                    [], [], [])
+            nb_records = self._nb_records()
+            arrays = {}
+            for column, _, dtype in columns:
+                # np.memmap won't map an empty file
+                if nb_records == 0:
+                    arrays[column] = np.empty(0, dtype=dtype)
+                else:
+                    arrays[column] = np.memmap(str(self.column_path(column)),
+                                               dtype=dtype, mode='r',
+                                               shape=(nb_records,))
+            names = []
+            for interner in self.students, self.notebooks, self.actions:
+                interner.refresh()
+                names.append(interner.names[:])
+            return LoadedEvents(arrays, *names)
+
+
+class LoadedEvents:
+    """
+    a read-only snapshot of the columnar store
+
+    times, students, notebooks and actions are numpy arrays of the same size
+    student_names, notebook_names and action_names allow to map ids
+    back to names
+    """
+    def __init__(self, arrays, student_names, notebook_names, action_names):
+        self.times = arrays['time']
+        self.students = arrays['student']
+        self.notebooks = arrays['notebook']
+        self.actions = arrays['action']
+        self.student_names = student_names
+        self.notebook_names = notebook_names
+        self.action_names = action_names
+
+    def __len__(self):
+        return len(self.times)
+
+    # events are appended in chronological order, except
+    # when the clock goes backwards, by less than this (in seconds)
+    window_slack = 24 * 3600
+
+    def window(self, since=None, until=None):
+        """
+        a LoadedEvents restricted to the events in [since, until] (epochs)
+
+        times are expected to be mostly sorted, so the range is first
+        located by a binary search, widened by window_slack;
+        the exact range is then applied on that part only
+        """
+        times = self.times
+        start = 0 if since is None \
+                else np.searchsorted(times, since - self.window_slack, side='left')
+        stop = len(times) if until is None \
+               else np.searchsorted(times, until + self.window_slack, side='right')
+        part = times[start:stop]
+        mask = np.ones(len(part), dtype=bool)
+        if since is not None:
+            mask &= (part >= since)
+        if until is not None:
+            mask &= (part <= until)
+        arrays = {
+            'time' : part[mask],
+            'student' : self.students[start:stop][mask],
+            'notebook' : self.notebooks[start:stop][mask],
+            'action' : self.actions[start:stop][mask],
+        }
+        return LoadedEvents(arrays, self.student_names,
+                            self.notebook_names, self.action_names)
+
+    def action_id(self, action):
+        """
+        the id for that action, or None if it never occurred
+        """
+        try:
+            return self.action_names.index(action)
+        except ValueError:
+            return None
+
+
+# one instance per course directory and per process, so that
+# the dictionaries do not get re-read from scratch on each event
+_columnar_events_by_dir = {}
+
+def columnar_events(course_dir):
+    try:
+        return _columnar_events_by_dir[course_dir]
+    except KeyError:
+        return _columnar_events_by_dir.setdefault(
+            course_dir, ColumnarEvents(course_dir))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    # this is a one-shot converter, for courses that
+    # already have an events.raw
+    from nbhosting.courses.models import CoursesDir
+    from nbhosting.stats.stats import Stats
+    parser = ArgumentParser()
+    parser.add_argument("courses", nargs='*',
+                        help="courses to convert - default is all courses")
+    args = parser.parse_args()
+    for course in (args.courses or CoursesDir().coursenames()):
+        stats = Stats(course)
+        events_path = stats.notebook_events_path()
+        if not events_path.exists():
+            print("{}: no events file - skipped".format(course))
+            continue
+        store = stats.columnar_events()
+        with store.locked():
+            nb_events = store.convert(events_path, stats.segments().events())
+        print("{}: converted {} events".format(course, nb_events))
@@ -0,0 +1,175 @@
+"""
+an index of events.raw by UTC day
+
+for each day that has events, the index - a text file
+named events.days - has one line like
+    2018-01-08 1234567 8910
+that gives the offset in bytes, and the line number (starting at 1)
+of the first line for that day in events.raw
+
+the index is updated as events get written, which requires to hold the
+same lock as for writing events.raw; it can also be rebuilt from scratch
+
+as most events are not the first of their day, the last entry is kept
+in memory, so that recording an event usually costs a single stat()
+"""
+
+import os
+import re
+
+from nbhosting.main.settings import logger
+
+day_regexp = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+
+class DayIndex:
+
+    def __init__(self, events_path, index_path):
+        self.events_path = events_path
+        self.index_path = index_path
+        # the last entry, and the (inode, size) of the index it was read from
+        self._last = None
+        self._last_key = None
+
+    def exists(self):
+        return self.index_path.exists()
+
+    def entries(self):
+        """
+        a list of (day, offset, lineno) tuples
+        """
+        entries = []
+        try:
+            with self.index_path.open() as f:
+                for line in f:
+                    day, offset, lineno = line.split()
+                    entries.append((day, int(offset), int(lineno)))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _count_lines(self, start, end):
+        count = 0
+        with self.events_path.open('rb') as f:
+            f.seek(start)
+            while start < end:
+                chunk = f.read(min(end - start, 1024 * 1024))
+                if not chunk:
+                    break
+                count += chunk.count(b'\n')
+                start += len(chunk)
+        return count
+
+    def _last_entry(self):
+        """
+        the last (day, offset, lineno) entry, or None if the index is empty;
+        only read again if the index has changed, e.g. in another process
+        """
+        try:
+            stat = self.index_path.stat()
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_size)
+        if key != self._last_key:
+            last = None
+            with self.index_path.open('rb') as f:
+                # entries are short
+                f.seek(max(0, stat.st_size - 256))
+                for line in reversed(f.read().splitlines()):
+                    try:
+                        day, offset, lineno = line.decode().split()
+                        last = (day, int(offset), int(lineno))
+                        break
+                    except ValueError:
+                        continue
+            self._last, self._last_key = last, key
+        return self._last
+
+    def record(self, day, offset):
+        """
+        to be called - with the lock held - when a line for that day
+        is about to be written at that offset in events.raw
+        """
+        last = self._last_entry()
+        if last is None:
+            lineno = self._count_lines(0, offset) + 1
+        else:
+            last_day, last_offset, last_lineno = last
+            # same day, or clock going backwards
+            if day <= last_day:
+                return
+            lineno = last_lineno + self._count_lines(last_offset, offset)
+        with self.index_path.open('a') as f:
+            f.write("{} {} {}\n".format(day, offset, lineno))
+            f.flush()
+            stat = os.fstat(f.fileno())
+            self._last = (day, offset, lineno)
+            self._last_key = (stat.st_ino, stat.st_size)
+
+    def rebuild(self):
+        """
+        rebuild the index from scratch - to be called with the lock held
+        """
+        tmp_path = self.index_path.with_name(self.index_path.name + ".tmp")
+        last_day = None
+        offset = 0
+        with self.events_path.open('rb') as events, tmp_path.open('w') as index:
+            for lineno, line in enumerate(events, 1):
+                day = line[:10].decode(errors='replace')
+                # ignore misformed lines
+                if not day_regexp.match(day):
+                    pass
+                elif last_day is None or day > last_day:
+                    index.write("{} {} {}\n".format(day, offset, lineno))
+                    last_day = day
+                offset += len(line)
+        tmp_path.rename(self.index_path)
+
+    def is_valid(self):
+        """
+        check that the index is consistent with events.raw
+        by looking at the last entry
+        """
+        entries = self.entries()
+        if not entries:
+            return True
+        day, offset, _ = entries[-1]
+        try:
+            with self.events_path.open('rb') as f:
+                f.seek(offset)
+                return f.read(len(day)).decode() == day
+        except Exception as e:
+            return False
+
+    def window(self, since_day=None, until_day=None):
+        """
+        since_day and until_day are days like '2018-01-08'
+
+        returns a tuple (start_offset, start_lineno, end_offset) where
+        all the lines for days in [since_day, until_day] can be found;
+        start_lineno is the number of lines before start_offset, and
+        end_offset is None when reading until the end is needed
+        returns None if there is no line in that range
+        """
+        start_offset, start_lineno, end_offset = None, None, None
+        for day, offset, lineno in self.entries():
+            if start_offset is None and (since_day is None or day >= since_day):
+                start_offset, start_lineno = offset, lineno - 1
+            if until_day is not None and day > until_day:
+                end_offset = offset
+                break
+        if start_offset is None or start_offset == end_offset:
+            return None
+        return start_offset, start_lineno, end_offset
+
+
+# one instance per index and per process, so that
+# the last entry does not get re-read on each event
+_day_indexes_by_path = {}
+
+def day_index(events_path, index_path):
+    try:
+        return _day_indexes_by_path[index_path]
+    except KeyError:
+        return _day_indexes_by_path.setdefault(
+            index_path, DayIndex(events_path, index_path))
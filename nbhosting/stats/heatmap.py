@@ -0,0 +1,110 @@
+"""
+the heatmap part of material_usage, common to both engines
+
+the engines provide the heatmap as an iterable of lines - one per student,
+in display order - where each line is a list of (column, count) tuples
+sorted on column, with column an index in the notebooks list
+
+from that, this module produces the 'z' entry either as
+* a dense matrix, i.e. a list of lines, each with one entry per notebook,
+  set to None if the student has never opened that notebook
+* a sparse list of [line, column, count] triples, with only
+  the non-empty cells
+
+in both cases, the result can be restricted to a window, i.e.
+a range of lines and/or a range of columns; in that case indices
+in the sparse triples are relative to the window
+
+z is built by a generator, so that it can be streamed without
+being fully built in memory
+"""
+
+import itertools
+
+encodings = ('dense', 'sparse')
+
+
+def parse_window(value):
+    """
+    turns a string like '100:200' into a tuple (100, 200)
+    either bound can be omitted, as in python slices
+    returns None if value is None or empty
+    raises ValueError if value is misformed
+    """
+    if not value:
+        return None
+    start, stop = value.split(':')
+    return (int(start) if start else None,
+            int(stop) if stop else None)
+
+
+def _dense_lines(lines, first_column, nb_columns):
+    for line in lines:
+        dense = [None] * nb_columns
+        for column, count in line:
+            column -= first_column
+            if 0 <= column < nb_columns:
+                dense[column] = count
+        yield dense
+
+
+def _sparse_triples(lines, first_column, nb_columns):
+    for index, line in enumerate(lines):
+        for column, count in line:
+            column -= first_column
+            if 0 <= column < nb_columns:
+                yield [index, column, count]
+
+
+def heatmap(x, y, lines, zmin, zmax,
+            encoding='dense', rows=None, cols=None, lazy=False):
+    """
+    x and y are the labels for columns and lines
+    lines is described in the module docstring
+    rows and cols are optional windows, as returned by parse_window
+
+    returns the 'heatmap' dict in the material_usage result; for
+    backwards compatibility, the dense encoding with no window
+    has only the 'x', 'y', 'z', 'zmin' and 'zmax' keys
+
+    z is a list, unless lazy is set, in which case it is a generator
+    """
+    if encoding not in encodings:
+        raise ValueError("unknown heatmap encoding {}".format(encoding))
+    line_range = range(len(y))[slice(*(rows or (None, None)))]
+    column_range = range(len(x))[slice(*(cols or (None, None)))]
+    lines = itertools.islice(lines, line_range.start, line_range.stop)
+    builder = _dense_lines if encoding == 'dense' else _sparse_triples
+    z = builder(lines, column_range.start, len(column_range))
+    result = {
+        'x' : x[column_range.start:column_range.stop],
+        'y' : y[line_range.start:line_range.stop],
+        'z' : z if lazy else list(z),
+        'zmin' : zmin, 'zmax' : zmax,
+    }
+    if encoding != 'dense' or rows or cols:
+        result.update({
+            'encoding' : encoding,
+            # the size of the complete matrix
+            'shape' : [len(y), len(x)],
+            'rows' : [line_range.start, line_range.stop],
+            'cols' : [column_range.start, column_range.stop],
+        })
+    return result
+
+
+def reencode(result, encoding):
+    """
+    the same heatmap in another encoding; result is a heatmap
+    as returned above, with no window, and with z as a list
+    """
+    lines = [[] for _ in result['y']]
+    if result.get('encoding', 'dense') == 'dense':
+        for line, dense in zip(lines, result['z']):
+            line.extend((column, count) for column, count in enumerate(dense)
+                        if count is not None)
+    else:
+        for index, column, count in result['z']:
+            lines[index].append((column, count))
+    return heatmap(result['x'], result['y'], lines,
+                   result['zmin'], result['zmax'], encoding=encoding)
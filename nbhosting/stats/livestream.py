@@ -0,0 +1,310 @@
+"""
+a live view on a course, as server-sent events
+
+the stream tails events.raw and counts.raw, and sends
+* a 'notebook' event for each new notebook opened - not 'open',
+  that EventSource fires by itself on each connection
+* a 'kill' event when monitor kills a container
+* a 'pause' event when monitor pauses a container
+* a 'cull' event when monitor shuts down an idle kernel
+* a 'counts' event for each new counts line
+* a 'rate' event with the number of opens over the last minute,
+  after each batch of opens and on each heartbeat
+
+files are watched with inotify when available - through libc,
+so there is no additional dependency - and otherwise by polling stat();
+in both cases only the lines appended since the last wakeup get read
+
+a stream lasts at most stats_live_max_seconds, after which the browser
+reconnects on its own; this way a web worker is never held forever
+"""
+
+import os
+import time
+import json
+import struct
+import select
+import ctypes
+import ctypes.util
+from collections import deque
+
+from nbhosting.stats.stats import time_format, keep_student
+from nbhosting.stats.columnar import epoch_from_timestamp
+from nbhosting.stats.rollups import seek_timestamp
+from nbhosting.main.settings import sitesettings, logger
+
+
+class InotifyWatcher:
+    """
+    wakes up when some files in a directory are written, created or replaced
+    raises OSError if inotify is not available
+    """
+    IN_MODIFY = 0x00000002
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    # struct inotify_event, without the trailing name
+    event_header = struct.Struct("iIII")
+
+    def __init__(self, directory, names):
+        self.names = set(names)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, str(directory).encode(), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed on {}".format(directory))
+
+    def _relevant(self, buffer):
+        offset = 0
+        while offset + self.event_header.size <= len(buffer):
+            _, _, _, length = self.event_header.unpack_from(buffer, offset)
+            offset += self.event_header.size
+            name = buffer[offset:offset+length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if name in self.names:
+                return True
+        return False
+
+    def wait(self, timeout):
+        """
+        returns True if one of the files has changed, False on timeout
+        """
+        deadline = time.time() + timeout
+        while True:
+            # other files in the directory wake us up as well
+            readable, _, _ = select.select(
+                [self.fd], [], [], max(0, deadline - time.time()))
+            if not readable:
+                return False
+            relevant = False
+            while True:
+                try:
+                    buffer = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    break
+                if not buffer:
+                    break
+                relevant = self._relevant(buffer) or relevant
+            if relevant:
+                return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    same interface as InotifyWatcher, by looking at stat() periodically
+    """
+    def __init__(self, directory, names, period=1.):
+        self.paths = [directory / name for name in names]
+        self.period = period
+        self.stats = self._stats()
+
+    def _stats(self):
+        stats = []
+        for path in self.paths:
+            try:
+                stat = path.stat()
+                stats.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stats.append(None)
+        return stats
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            stats = self._stats()
+            if stats != self.stats:
+                self.stats = stats
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.period, remaining))
+
+    def close(self):
+        pass
+
+
+def watcher(directory, names):
+    try:
+        return InotifyWatcher(directory, names)
+    except Exception as e:
+        logger.info("inotify not available ({}), polling {}".format(e, directory))
+        return PollingWatcher(directory, names)
+
+
+class Tail:
+    """
+    the lines appended to a file; starts at the end of the file,
+    or at the first line not older than since (a timestamp) if specified;
+    copes with the file being replaced or truncated - e.g. when
+    monitor seals segments - without sending the same lines again
+    """
+    def __init__(self, path, since=None):
+        self.path = path
+        self.inode = None
+        self.offset = 0
+        # the last dated line returned, to resume after it
+        self.last_line = None
+        try:
+            with path.open('rb') as f:
+                self.inode = os.fstat(f.fileno()).st_ino
+                if since is not None:
+                    seek_timestamp(f, since)
+                else:
+                    f.seek(0, os.SEEK_END)
+                self.offset = f.tell()
+        except FileNotFoundError:
+            pass
+
+    def lines(self):
+        """
+        the complete lines appended since last call
+        """
+        try:
+            f = self.path.open('rb')
+        except FileNotFoundError:
+            return []
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self.inode = stat.st_ino
+                self.offset = self._resume(f, stat.st_size)
+            if stat.st_size == self.offset:
+                return []
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+        # the last line may be still being written
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        lines = data[:end].splitlines(keepends=True)
+        for bytes_line in reversed(lines):
+            if not bytes_line.startswith(b'#'):
+                self.last_line = bytes_line
+                break
+        return [bytes_line.decode(errors='replace').rstrip('\n')
+                for bytes_line in lines]
+
+    def _resume(self, f, size):
+        """
+        where to start in a file that has replaced or truncated
+        the one being tailed: right after the last line returned,
+        or before the first one that is more recent; and at the end
+        of the file if no line was returned yet
+        """
+        if self.last_line is None:
+            return size
+        key = self.last_line.split(b' ', 1)[0]
+        seek_timestamp(f, key.decode(errors='replace'))
+        while True:
+            position = f.tell()
+            bytes_line = f.readline()
+            # the last line may be still being written
+            if not bytes_line.endswith(b'\n'):
+                return position
+            if bytes_line == self.last_line:
+                return f.tell()
+            if not bytes_line.startswith(b'#') and bytes_line[:len(key)] > key:
+                return position
+
+
+class OpenRate:
+    """
+    the number of opens over a sliding window, maintained incrementally:
+    each open is pushed once and popped once
+    """
+    def __init__(self, window=60):
+        self.window = window
+        self.epochs = deque()
+
+    def add(self, epoch):
+        self.epochs.append(epoch)
+
+    def rate(self, now):
+        while self.epochs and self.epochs[0] <= now - self.window:
+            self.epochs.popleft()
+        return len(self.epochs)
+
+
+def sse(event, data):
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data)).encode()
+
+
+def live_events(stats, staff, heartbeat=15, max_seconds=None):
+    """
+    a generator of server-sent events for that course, see above;
+    staff students are ignored, like in the stats
+    """
+    if max_seconds is None:
+        max_seconds = getattr(sitesettings, 'stats_live_max_seconds', 600)
+    keep = lambda student: keep_student(staff, student)
+    rate = OpenRate()
+    now = time.time()
+    # the opens in the last minute show up right away, and seed the rate
+    events = Tail(stats.notebook_events_path(),
+                  since=time.strftime(time_format, time.gmtime(now - rate.window)))
+    counts = Tail(stats.monitor_counts_path())
+    watch = watcher(stats.course_dir, ['events.raw', 'counts.raw'])
+    deadline = now + max_seconds
+    try:
+        # ask the browser to reconnect quickly when we are done
+        yield b"retry: 3000\n\n"
+        last_counts = stats.last_monitor_counts()
+        if last_counts is not None:
+            timestamp, values = last_counts
+            yield sse('counts', dict(timestamp=timestamp, **values))
+        changed, send_rate = True, True
+        while time.time() < deadline:
+            if changed:
+                for line in events.lines():
+                    try:
+                        timestamp, _, student, notebook, action, _ = line.split()
+                        epoch = epoch_from_timestamp(timestamp)
+                    except ValueError:
+                        continue
+                    if not keep(student):
+                        continue
+                    if action == 'killing':
+                        yield sse('kill', dict(timestamp=timestamp, student=student))
+                    elif action == 'pausing':
+                        yield sse('pause', dict(timestamp=timestamp, student=student))
+                    elif action == 'culling':
+                        yield sse('cull', dict(timestamp=timestamp, student=student,
+                                               notebook=notebook))
+                    else:
+                        rate.add(epoch)
+                        send_rate = True
+                        yield sse('notebook', dict(timestamp=timestamp, student=student,
+                                               notebook=notebook, action=action))
+                for line in counts.lines():
+                    if line.startswith('#'):
+                        continue
+                    try:
+                        timestamp, *values = line.split()
+                        values = [int(v) for v in values]
+                    except ValueError:
+                        continue
+                    yield sse('counts', dict(timestamp=timestamp,
+                                             **dict(zip(stats.known_counts, values))))
+            else:
+                # a heartbeat keeps proxies from closing the connection,
+                # and lets the rate decay
+                send_rate = True
+            if send_rate:
+                now = time.time()
+                yield sse('rate', dict(
+                    timestamp=time.strftime(time_format, time.gmtime(now)),
+                    opens_per_minute=rate.rate(now)))
+                send_rate = False
+            changed = watch.wait(min(heartbeat, max(0, deadline - time.time())))
+    except Exception as e:
+        logger.exception("live stream for {} interrupted".format(stats.course))
+    finally:
+        watch.close()
@@ -5,8 +5,14 @@ import time
 import calendar
 import json
 from pathlib import Path
-import subprocess
 import logging
+import functools
+import itertools
+import threading
+from collections import defaultdict
+import heapq
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 import asyncio
 import aiohttp
@@ -18,16 +24,38 @@ from nbhosting.main.settings import sitesettings
 from nbhosting.main.settings import monitor_logger as logger
 from nbhosting.courses.models import CourseDir, CoursesDir
 from nbhosting.stats.stats import Stats
+from nbhosting.stats.snapshots import write_snapshots
+from nbhosting.stats.overview import overview
+from nbhosting.stats.cgroups import CgroupAccounting, read_loadavg
+from nbhosting.stats.pressure import MemoryPressure, read_meminfo
 
 """
 This processor is designed to be started as a systemd service
 
 It will trigger on a cyclic basis - typically 15 minutes, and will
-* spot and kill jupyter instances that have had no recent activity
+* spot and kill jupyter instances that have had no recent activity;
+  containers are known from the docker events stream, and
+  a full list is only fetched every once in a while;
+  each container gets probed only when it could have been idle
+  for more than the grace timeout, see CullingScheduler
+* optionally pause the instances that have been idle for some time
+  but not long enough to be killed, so they can be resumed instantly
+* in an instance that is kept, shut down the kernels that have had
+  no recent activity - with a shorter timeout
+* when the host runs short of memory, kill the least recently
+  active instances right away, even within grace, see pressure.py
 * when an instance is killed, the stats/<course>/events.raw file
-  is updated with a 'killing' line
+  is updated with a 'killing' line, with a 'pausing' line when it
+  is paused, and with a 'culling' line when a kernel is shut down
 * also writes into stats/<course>/counts.raw one line with the numbers
-  of jupyter instances (running and frozen), and number of running kernels
+  of jupyter instances (running, frozen, paused and evicted), number of
+  running and culled kernels, and the memory and cpu that these
+  instances use - as read from their cgroups, see cgroups.py
+* and into stats/<course>/usage.raw one line for each of the
+  instances that use the most memory
+* moves the lines from previous months in these files
+  into compressed segments, see segments.py
+* and finally precomputes the stats for each course, see snapshots.py
 
 Also note that 
 
@@ -38,12 +66,189 @@ Also note that
 """
 
 
+class ContainerTable:
+    """
+    the containers known to dockerd, kept in memory
+
+    listing all containers is expensive when there are many frozen ones,
+    so this is done only on startup and then once in a while; in between,
+    the table gets updated from the docker events stream, that a
+    separate thread reads - see follow()
+
+    the table maps each container name to its docker Container object,
+    as inspected when it was last created or started, and also
+    keeps track of the ones that are running, and of the ones
+    that are paused
+    """
+
+    # the events that matter
+    actions = ('create', 'start', 'die', 'destroy', 'pause', 'unpause')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.containers = {}
+        self.running = set()
+        self.paused = set()
+        self.reconciled = None
+        # the time of the last event processed, to resume from there
+        self.since = None
+        # set when events may have been missed
+        self.stale = True
+        # while a full list is in progress, the updates made in the
+        # meanwhile, so they can be replayed on top of that list
+        self.journal = None
+
+    def _update(self, name, container=None, status=None):
+        """
+        the one place where the table gets changed - caller holds the lock
+        status is as in mark(), or 'destroyed', or None to leave it unchanged
+        """
+        if self.journal is not None:
+            self.journal.append((name, container, status))
+        if container is not None:
+            self.containers[name] = container
+        if status is None:
+            return
+        self.running.discard(name)
+        self.paused.discard(name)
+        if status == 'running':
+            self.running.add(name)
+        elif status == 'paused':
+            self.paused.add(name)
+        elif status == 'destroyed':
+            self.containers.pop(name, None)
+
+    def reconcile(self, proxy):
+        """
+        rebuild the table from a full list
+        """
+        beg = time.time()
+        with self.lock:
+            self.journal = []
+            # if the events stream breaks during the list,
+            # this gets set again
+            self.stale = False
+        # this can take a while, so the table remains available meanwhile
+        try:
+            containers = proxy.containers.list(all=True)
+        except Exception:
+            with self.lock:
+                self.journal = None
+                self.stale = True
+            raise
+        with self.lock:
+            journal, self.journal = self.journal, None
+            self.containers = {container.name : container
+                               for container in containers}
+            self.running = {container.name for container in containers
+                            if container.status == 'running'}
+            self.paused = {container.name for container in containers
+                           if container.status == 'paused'}
+            # the events that showed up in the meanwhile are more recent
+            for name, container, status in journal:
+                self._update(name, container, status)
+            self.reconciled = time.time()
+        logger.info("listed {} containers ({} running) in {:.2f}s"
+                    .format(len(self.containers), len(self.running),
+                            time.time() - beg))
+
+    def needs_reconcile(self, period):
+        return (self.stale or self.reconciled is None
+                or time.time() - self.reconciled >= period)
+
+    def apply(self, event, get_container):
+        """
+        update the table from one event as sent by dockerd, e.g.
+        {'Type': 'container', 'Action': 'start', 'time': 1519055905,
+         'Actor': {'ID': '5a3c...', 'Attributes': {'name': 'flotpython-x-...'}}}
+
+        get_container is a function that returns the Container object
+        for an id - typically proxy.containers.get
+        """
+        if event.get('Type') != 'container':
+            return
+        action = event.get('Action')
+        self.since = event.get('time', self.since)
+        if action not in self.actions:
+            return
+        actor = event['Actor']
+        name = actor.get('Attributes', {}).get('name')
+        if action in ('create', 'start'):
+            # inspect it, so that its ports and image are known
+            try:
+                container = get_container(actor['ID'])
+            except Exception as e:
+                # typically already gone
+                logger.info("cannot inspect container {} after {} - {}"
+                            .format(name, action, e))
+                return
+            with self.lock:
+                self._update(container.name, container,
+                             'running' if action == 'start' else None)
+        elif action in ('die', 'pause', 'unpause'):
+            self.mark(name, {'die': 'stopped', 'pause': 'paused',
+                             'unpause': 'running'}[action])
+        elif action == 'destroy':
+            with self.lock:
+                self._update(name, status='destroyed')
+
+    def mark(self, name, status):
+        """
+        status is either 'running', 'paused' or 'stopped'; this is
+        also used for the containers that we kill or pause ourselves,
+        with no need to wait for the event
+        """
+        with self.lock:
+            self._update(name, status=status)
+
+    def snapshot(self):
+        """
+        returns a list of (container, status) tuples,
+        with status as in mark()
+        """
+        with self.lock:
+            return [(container,
+                     'running' if name in self.running
+                     else 'paused' if name in self.paused
+                     else 'stopped')
+                    for name, container in self.containers.items()]
+
+    def follow(self, events, get_container):
+        """
+        apply an iterable of events, until it ends
+        """
+        for event in events:
+            self.apply(event, get_container)
+
+    def follow_forever(self, retry=5):
+        """
+        meant to run in a separate thread: follow the docker events stream,
+        and reconnect if it breaks; the table gets marked as stale
+        in that case, so that it gets rebuilt on next cycle
+        """
+        while True:
+            try:
+                proxy = docker.from_env(version='auto')
+                events = proxy.events(
+                    decode=True, since=self.since,
+                    filters={'type': 'container'})
+                logger.info("following docker events")
+                self.follow(events, proxy.containers.get)
+            except Exception as e:
+                logger.exception("docker events stream interrupted")
+            self.stale = True
+            time.sleep(retry)
+
+
 class CourseFigures:
 
     def __init__(self):
         self.frozen_containers = 0
         self.running_containers = 0
         self.running_kernels = 0
+        self.paused_containers = 0
+        # student -> (memory in MiB, cpu in %), see CgroupAccounting
+        self.usages = {}
 
     # to avoid counting kernels in containers that get killed
     # we count updateboth counters at the same time
@@ -56,6 +261,202 @@ class CourseFigures:
         else:
             self.frozen_containers += 1
 
+    # paused containers still hold their memory,
+    # but they are neither running nor frozen
+    def count_paused_container(self):
+        self.paused_containers += 1
+
+    def count_usage(self, student, memory, cpu_percent):
+        # cpu is not known yet on the first sample of a container
+        self.usages[student] = (round(memory / 1024**2), round(cpu_percent or 0))
+
+    def total_memory(self):
+        return sum(memory for memory, _ in self.usages.values())
+
+    def total_cpu(self):
+        return sum(cpu for _, cpu in self.usages.values())
+
+    def max_memory(self):
+        return max((memory for memory, _ in self.usages.values()), default=0)
+
+    def top_usages(self, top):
+        """
+        the top consumers as (student, memory, cpu), biggest memory first
+        """
+        return sorted(((student, memory, cpu)
+                       for student, (memory, cpu) in self.usages.items()),
+                      key=lambda usage: (usage[1], usage[2]), reverse=True)[:top]
+
+class DockerCalls:
+    """
+    the docker SDK is synchronous, so its calls are run in a bounded
+    thread pool, which keeps them from freezing the event loop
+
+    the calls that kill or remove containers are also rate-limited,
+    at most kills_per_second, so as to not swamp dockerd
+    """
+
+    def __init__(self, executor, kills_per_second):
+        self.executor = executor
+        self.interval = 1 / kills_per_second
+        self.next_slot = 0
+        self.lock = asyncio.Lock()
+
+    async def run(self, function, *args, **kwds):
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(function, *args, **kwds))
+
+    async def run_throttled(self, function, *args, **kwds):
+        async with self.lock:
+            now = time.time()
+            if self.next_slot > now:
+                await asyncio.sleep(self.next_slot - now)
+            self.next_slot = max(now, self.next_slot) + self.interval
+        return await self.run(function, *args, **kwds)
+
+
+class KernelProbes:
+    """
+    what is shared by all the /api/kernels probes in one monitor cycle:
+    a single http session, whose connector caps the number of sockets,
+    a semaphore that caps the number of probes in flight, and the
+    figures about latency, failures and timeouts that end up in monitor.log
+    """
+
+    def __init__(self, session, concurrency):
+        self.session = session
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # in seconds, for successful probes only
+        self.latencies = []
+        self.failures = 0
+        self.timeouts = 0
+
+    async def get_json(self, url):
+        async with self.semaphore:
+            beg = time.time()
+            try:
+                async with self.session.get(url) as response:
+                    json_str = await response.text()
+                result = json.loads(json_str)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise
+            except Exception:
+                self.failures += 1
+                raise
+            self.latencies.append(time.time() - beg)
+            return result
+
+    async def delete(self, url):
+        """
+        raises an exception if the request does not succeed
+        """
+        async with self.semaphore:
+            async with self.session.delete(url) as response:
+                response.raise_for_status()
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        nb_probes = len(latencies) + self.failures + self.timeouts
+        summary = ("{} kernel probes: {} ok, {} failed, {} timed out"
+                   .format(nb_probes, len(latencies), self.failures, self.timeouts))
+        if latencies:
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+            summary += (" - latency min {:.3f}s median {:.3f}s p95 {:.3f}s max {:.3f}s"
+                        .format(latencies[0], percentile(.5),
+                                percentile(.95), latencies[-1]))
+        return summary
+
+class CullingScheduler:
+    """
+    the running containers in a heap, keyed on the earliest time at which
+    they can have been idle for more than grace, i.e. last activity + grace;
+    this way a container gets probed only when it comes due, and not
+    at every cycle
+
+    entries are not removed from the heap; when a container gets
+    rescheduled or forgotten, its former entry is just ignored
+    """
+
+    def __init__(self):
+        self.heap = []
+        # name -> the current deadline for that container
+        self.deadlines = {}
+        # name -> the number of kernels found at the last probe
+        self.nb_kernels = {}
+        # name -> the last activity in the containers that we have paused,
+        # as they cannot be probed anymore
+        self.paused = {}
+        # name -> the last activity found at the last probe
+        self.activity = {}
+
+    def schedule(self, name, deadline, nb_kernels=None):
+        self.deadlines[name] = deadline
+        self.nb_kernels[name] = nb_kernels
+        heapq.heappush(self.heap, (deadline, name))
+
+    def forget(self, name):
+        self.deadlines.pop(name, None)
+        self.nb_kernels.pop(name, None)
+        self.paused.pop(name, None)
+        self.activity.pop(name, None)
+
+    @staticmethod
+    def started_at(container):
+        try:
+            # e.g. 2018-02-19T12:58:25.204761234Z
+            return calendar.timegm(time.strptime(
+                container.attrs['State']['StartedAt'][:19], "%Y-%m-%dT%H:%M:%S"))
+        except Exception as e:
+            return 0
+
+    def last_activity(self, name, container):
+        """
+        the last activity known for that container, without probing it;
+        it cannot be older than when the container was started
+        """
+        if name in self.paused:
+            return self.paused[name]
+        return max(self.activity.get(name) or 0, self.started_at(container))
+
+    def sync(self, containers, now, grace, spread):
+        """
+        containers is a dict name -> container of the ones running or paused
+
+        a container that shows up cannot be idle for more than grace
+        before it has been running that long; the ones that are past that
+        already, typically when the monitor starts, are spread over
+        the next spread seconds, so they do not all get probed at once
+        """
+        for name in list(self.nb_kernels):
+            if name not in containers:
+                self.forget(name)
+        for name, container in containers.items():
+            if name not in self.deadlines:
+                deadline = self.started_at(container) + grace
+                if deadline <= now:
+                    deadline = now + random.uniform(0, spread)
+                self.schedule(name, deadline, self.nb_kernels.get(name))
+        # get rid of the ignored entries once in a while
+        if len(self.heap) > 2 * len(self.deadlines) + 1024:
+            self.heap = [(deadline, name) for name, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def due(self, now):
+        """
+        the names of the containers whose deadline has come;
+        they need to be scheduled again once probed
+        """
+        result = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, name = heapq.heappop(self.heap)
+            if self.deadlines.get(name) == deadline:
+                del self.deadlines[name]
+                result.append(name)
+        return result
+
+
 class MonitoredJupyter:
 
     # container is an instance of
@@ -64,15 +465,24 @@ class MonitoredJupyter:
                  container : docker.models.containers.Container,
                  course : str,
                  student : str,
-                 figures : CourseFigures,
                  # the hash of the expected image - may be None
-                 hash : str):
+                 hash : str,
+                 # either 'running' or 'paused'
+                 status : str = 'running',
+                 # for a container that we have paused, its last activity
+                 paused_activity : float = None):
         self.container = container
         self.course = course
         self.student = student
-        self.figures = figures
         self.hash = hash
+        self.status = status
+        self.paused_activity = paused_activity
         self.nb_kernels = None
+        self.last_activity = None
+        self.api_kernels = []
+        self.killed = False
+        self.paused = False
+        self.culled_kernels = 0
 
     def __str__(self):
         return "container {} [{}k]".format(self.name, self.nb_kernels)
@@ -129,10 +539,11 @@ class MonitoredJupyter:
             logger.error(f"MonitoredJupyter.last_time - fatal error {type(e)} - {e}")
             return time.time()
 
-    async def count_running_kernels(self):
+    async def count_running_kernels(self, probes):
         """
         updates:
-        * self.figures with number of running kernels
+        * self.nb_kernels with number of running kernels
+        * self.api_kernels with the data on each kernel
         * self.last_activity - a epoch/timestamp/nb of seconds
           may be None if using an old jupyter
         """
@@ -142,10 +553,8 @@ class MonitoredJupyter:
         url = "http://localhost:{}/api/kernels?token={}"\
             .format(port, self.name)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    json_str = await response.text()
-            api_kernels = json.loads(json_str)
+            api_kernels = await probes.get_json(url)
+            self.api_kernels = api_kernels
             self.nb_kernels = len(api_kernels)
 
             last_times = [
@@ -154,20 +563,110 @@ class MonitoredJupyter:
             # if times is empty (no kernel): no activity
             self.last_activity = max(last_times, default=0)
                 
+        except asyncio.TimeoutError as e:
+            # no need for a stack trace, this is accounted for in the summary
+            logger.error("Timeout when probing number of kernels in {}"
+                         .format(self))
+            self.last_activity = None
         except Exception as e:
             logger.exception("Cannot probe number of kernels in {} - {}: {}"
                              .format(self, type(e), e))
             self.last_activity = None
 
 
-    async def co_run(self, grace):
-        nbhroot = Path(sitesettings.nbhroot)
-        # stopped containers are useful only for statistics
-        if self.container.status != 'running':
-            self.figures.count_container(False)
+    async def cull_kernels(self, kernel_grace, probes):
+        """
+        shut down the kernels that have been idle for more than kernel_grace,
+        while the container keeps running for the other ones
+        """
+        now = time.time()
+        idle_kernels = [
+            api_kernel for api_kernel in self.api_kernels
+            # a long computation may not show up as activity
+            if api_kernel.get('execution_state') != 'busy'
+            and self.last_time(api_kernel) <= now - kernel_grace
+        ]
+        if not idle_kernels:
             return
+        port = self.port_number()
+        # find out the notebook for each kernel, for events.raw
+        notebook_by_kernel = {}
+        try:
+            url = "http://localhost:{}/api/sessions?token={}"\
+                .format(port, self.name)
+            for session in await probes.get_json(url):
+                path = session.get('path') or session['notebook']['path']
+                # like in edxfront, notebooks go without their extension
+                if path.endswith(".ipynb"):
+                    path = path[:-len(".ipynb")]
+                notebook_by_kernel[session['kernel']['id']] = path
+        except Exception as e:
+            logger.exception("Cannot get sessions in {}".format(self))
+        for api_kernel in idle_kernels:
+            kernel_id = api_kernel['id']
+            url = "http://localhost:{}/api/kernels/{}?token={}"\
+                .format(port, kernel_id, self.name)
+            try:
+                await probes.delete(url)
+            except Exception as e:
+                logger.exception("Cannot shut down kernel {} in {}"
+                                 .format(kernel_id, self))
+                continue
+            idle_minutes = (now - self.last_time(api_kernel)) // 60
+            notebook = notebook_by_kernel.get(kernel_id, '-')
+            logger.info("{}: kernel for {} has been idle for {} mn - culled"
+                        .format(self, notebook, idle_minutes))
+            self.api_kernels.remove(api_kernel)
+            self.nb_kernels -= 1
+            self.culled_kernels += 1
+            Stats(self.course).record_cull_kernel(self.student, notebook, port)
+
+    def deadline(self, grace, kernel_grace):
+        """
+        once probed and spared, the time when
+        this container needs to be probed again;
+        grace is the one for pausing, if enabled
+        """
+        deadline = self.last_activity + grace
+        if kernel_grace:
+            for api_kernel in self.api_kernels:
+                if api_kernel.get('execution_state') != 'busy':
+                    deadline = min(deadline,
+                                   self.last_time(api_kernel) + kernel_grace)
+        return deadline
+
+    async def co_run(self, grace, probes, docker_calls,
+                     kernel_grace=None, pause_grace=None):
+        """
+        probe the jupyter, and kill the container if it has been idle
+        for more than grace; sets self.killed accordingly
+
+        if pause_grace is set, a container that has been idle for more
+        than that, but less than grace, gets paused instead, which
+        releases its cpu but keeps its memory, so that it can be
+        resumed instantly; sets self.paused accordingly
+
+        otherwise, if kernel_grace is set, shut down the kernels that
+        have been idle for more than that
+        """
+        if self.status == 'paused':
+            # paused by us, and has come due: no need to resume it
+            if self.paused_activity is not None:
+                self.last_activity = self.paused_activity
+                idle_minutes = (time.time() - self.last_activity) // 60
+                logger.info("{} has been idle for {} mn - killing".format(self, idle_minutes))
+                await self.co_kill(docker_calls)
+                return
+            # paused but not by us, e.g. by hand while the monitor was running:
+            # resume it to find out its last activity
+            try:
+                await docker_calls.run_throttled(self.container.unpause)
+            except Exception as e:
+                logger.exception("could not unpause {}".format(self))
+                return
+            self.status = 'running'
         # count number of kernels and last activity
-        await self.count_running_kernels()
+        await self.count_running_kernels(probes)
         # last_activity may be 0 if no kernel is running inside that container
         # or None if we could not determine it properly
         if self.last_activity is None:
@@ -177,47 +676,367 @@ class MonitoredJupyter:
         now = time.time()
         grace_past = now - grace
         idle_minutes = (now - self.last_activity) // 60
-        if self.last_activity > grace_past:
+        if self.last_activity > now - (pause_grace or grace):
             logger.debug("sparing {} that had activity {}' ago"
                          .format(self, idle_minutes))
-            self.figures.count_container(True, self.nb_kernels)
+            if kernel_grace:
+                await self.cull_kernels(kernel_grace, probes)
+        elif pause_grace and self.last_activity and self.last_activity > grace_past:
+            logger.info("{} has been idle for {} mn - pausing".format(self, idle_minutes))
+            try:
+                await docker_calls.run_throttled(self.container.pause)
+            except Exception as e:
+                logger.exception("could not pause {}".format(self))
+                return
+            self.paused = True
+            stats = Stats(self.course)
+            stats.record_pause_jupyter(self.student)
+            # see edxfront.views.unpause_fast_path
+            stats.mark_paused(self.student)
         else:
             if self.last_activity:
                 logger.info("{} has been idle for {} mn - killing".format(self, idle_minutes))
             else:
                 logger.info("{} has no kernel attached - killing".format(self))
-            # kill it
-            self.container.kill()
-            # if that container does not run the expected image hash
-            # it is because the course image was upgraded in the meanwhile
-            # then we even remove the container so it will get re-created
-            # next time with the right image this time
-            actual_hash = self.container.image.id
-            if actual_hash != self.hash:
-                logger.info("removing container {} - has hash {} instead of expected {}"
-                            .format(self.name, actual_hash[:15], self.hash[:15]))
-                self.container.remove(v=True)
-            # this counts for one dead container
-            self.figures.count_container(False)
-            # keep track or that removal in events.raw
-            Stats(self.course).record_kill_jupyter(self.student)
+            await self.co_kill(docker_calls)
+
+    async def co_evict(self, min_idle, probes, docker_calls):
+        """
+        kill the container, regardless of grace, to free memory;
+        a running container is probed first and spared if it has
+        had activity in the last min_idle seconds
+        """
+        if self.status == 'paused':
+            # not in use right now, as a student would resume it
+            self.last_activity = self.paused_activity
+            logger.info("{} is paused - evicting".format(self))
+            await self.co_kill(docker_calls)
+            return
+        await self.count_running_kernels(probes)
+        if self.last_activity is None:
+            logger.error("not evicting container {} with no known last_activity"
+                         .format(self.name))
+            return
+        idle_minutes = (time.time() - self.last_activity) // 60
+        if self.last_activity > time.time() - min_idle:
+            logger.info("not evicting {} that had activity {}' ago"
+                        .format(self, idle_minutes))
+            return
+        logger.info("{} has been idle for {} mn - evicting".format(self, idle_minutes))
+        await self.co_kill(docker_calls)
+
+    async def co_kill(self, docker_calls):
+        try:
+            # a paused container needs to be resumed first
+            if self.status == 'paused':
+                await docker_calls.run_throttled(self.container.unpause)
+            await docker_calls.run_throttled(self.container.kill)
+        except Exception as e:
+            logger.exception("could not kill {}".format(self))
+            return
+        self.killed = True
+        if self.status == 'paused':
+            Stats(self.course).mark_paused(self.student, False)
+        # if that container does not run the expected image hash
+        # it is because the course image was upgraded in the meanwhile
+        # then we even remove the container so it will get re-created
+        # next time with the right image this time
+        # this comes with the containers list, no need to ask dockerd
+        actual_hash = self.container.attrs['Image']
+        if actual_hash != self.hash:
+            logger.info("removing container {} - has hash {} instead of expected {}"
+                        .format(self.name, actual_hash[:15], self.hash[:15]))
+            try:
+                await docker_calls.run_throttled(self.container.remove, v=True)
+            except Exception as e:
+                logger.exception("could not remove {}".format(self))
+        # keep track or that removal in events.raw
+        Stats(self.course).record_kill_jupyter(self.student)
 
 class Monitor:
 
-    def __init__(self, grace, period, debug):
+    def __init__(self, grace, period, debug, kernel_grace=None, pause_grace=None):
         """
         All times in seconds
 
         Parameters:
             grace: is how long an idle server is kept running
             period: is how often the monitor runs
+            kernel_grace: is how long an idle kernel is kept running
+              in a server that is otherwise active; None means never
+              shut down kernels individually
+            pause_grace: is how long an idle server is kept running
+              before it gets paused, and then killed after grace;
+              None means never pause servers
         """
         self.grace = grace
         self.period = period
+        self.kernel_grace = kernel_grace
+        if pause_grace and pause_grace >= grace:
+            logger.warning("pause grace {}s is not shorter than grace {}s - ignored"
+                           .format(pause_grace, grace))
+            pause_grace = None
+        self.pause_grace = pause_grace
+        # the kernels culled since the last counts line
+        self.culled_by_course = defaultdict(int)
+        # the containers evicted since the last counts line
+        self.evicted_by_course = defaultdict(int)
+        # evictions are opt-in; a low watermark of 0 disables them
+        low_watermark = getattr(sitesettings, 'monitor_memory_low_watermark', 0)
+        self.memory_pressure = None if not low_watermark else MemoryPressure(
+            low_watermark,
+            getattr(sitesettings, 'monitor_memory_high_watermark', 20),
+            getattr(sitesettings, 'monitor_memory_stall_threshold', 10))
+        # for the docker calls, see DockerCalls
+        self.docker_executor = ThreadPoolExecutor(
+            max_workers=getattr(sitesettings, 'monitor_docker_workers', 8))
+        self.container_table = ContainerTable()
+        self.scheduler = CullingScheduler()
+        # keeps the cpu time of each container from one cycle to the next
+        self.cgroups = CgroupAccounting()
+        self.hash_by_course = {}
         if debug:
             logger.setLevel(logging.DEBUG)
 
+    def refresh_image_hashes(self, proxy, coursenames):
+        # courses often share the same image, and
+        # the images can be looked up concurrently
+        image_by_course = {coursename : CourseDir(coursename).image
+                           for coursename in coursenames}
+        images = list(set(image_by_course.values()))
+        hash_by_image = dict(zip(images, self.docker_executor.map(
+            self.image_hash, itertools.repeat(proxy), images)))
+        self.hash_by_course = {coursename : hash_by_image[image]
+                               for coursename, image in image_by_course.items()}
+
+    @staticmethod
+    def image_hash(proxy, image):
+        """
+        the hash of that image, or None - like CourseDir.image_hash
+        """
+        try:
+            return proxy.images.get(image).id
+        except Exception as e:
+            logger.exception("cannot find hash for image {}".format(image))
+            return None
+
+    async def co_run_jupyters(self, monitored_jupyters, evict_idle=None):
+        """
+        probe all running jupyters through one http session;
+        the number of connections and of probes in flight are bounded,
+        and each probe has its own timeouts, so that a cycle
+        does not get stalled by a few unresponsive containers
+
+        with evict_idle set, the jupyters get evicted rather
+        than culled, see MonitoredJupyter.co_evict
+        """
+        connector = aiohttp.TCPConnector(
+            limit=getattr(sitesettings, 'monitor_probe_connections', 100))
+        connect_timeout = getattr(sitesettings, 'monitor_probe_connect_timeout', 5)
+        read_timeout = getattr(sitesettings, 'monitor_probe_read_timeout', 10)
+        timeout = aiohttp.ClientTimeout(
+            total=connect_timeout + read_timeout,
+            sock_connect=connect_timeout, sock_read=read_timeout)
+        docker_calls = DockerCalls(
+            self.docker_executor,
+            getattr(sitesettings, 'monitor_docker_kills_per_second', 5))
+        beg = time.time()
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            probes = KernelProbes(
+                session, getattr(sitesettings, 'monitor_probe_concurrency', 100))
+            if evict_idle is None:
+                jobs = (monitored_jupyter.co_run(
+                    self.grace, probes, docker_calls, self.kernel_grace, self.pause_grace)
+                        for monitored_jupyter in monitored_jupyters)
+            else:
+                jobs = (monitored_jupyter.co_evict(evict_idle, probes, docker_calls)
+                        for monitored_jupyter in monitored_jupyters)
+            await asyncio.gather(*jobs)
+        logger.info("{} containers checked in {:.2f}s - {}"
+                    .format(len(monitored_jupyters), time.time() - beg,
+                            probes.summary()))
+
+    def adopt_paused(self, coursenames):
+        """
+        at startup, take over the containers that are paused, typically
+        by a previous run; their last activity is not known anymore, so
+        they are considered paused right now, i.e. idle for pause_grace,
+        and they get killed after grace like the ones that we pause
+
+        the markers for edxfront are rebuilt accordingly
+        """
+        proxy = docker.from_env(version='auto')
+        self.container_table.reconcile(proxy)
+        now = time.time()
+        students_by_course = defaultdict(list)
+        for container, status in self.container_table.snapshot():
+            if status != 'paused':
+                continue
+            try:
+                coursename, student = container.name.split('-x-')
+            # typically non-nbhosting containers
+            except ValueError as e:
+                continue
+            students_by_course[coursename].append(student)
+            activity = now - (self.pause_grace or 0)
+            self.scheduler.paused[container.name] = activity
+            self.scheduler.schedule(container.name, activity + self.grace)
+        for coursename in set(coursenames) | set(students_by_course):
+            stats = Stats(coursename)
+            students = students_by_course[coursename]
+            stats.clear_paused_markers(keep=students)
+            for student in students:
+                stats.mark_paused(student)
+        logger.info("{} paused containers found"
+                    .format(sum(len(v) for v in students_by_course.values())))
+
+    def cull_due(self):
+        """
+        probe the running containers that have come due,
+        kill the idle ones, and schedule the others again
+        """
+        proxy = docker.from_env(version='auto')
+        if self.container_table.needs_reconcile(
+                getattr(sitesettings, 'monitor_reconcile_period', 6 * 3600)):
+            logger.debug("scanning containers")
+            self.container_table.reconcile(proxy)
+        if not self.hash_by_course:
+            self.refresh_image_hashes(proxy, CoursesDir().coursenames())
+        now = time.time()
+        containers, statuses = {}, {}
+        for container, status in self.container_table.snapshot():
+            if status != 'stopped':
+                containers[container.name] = container
+                statuses[container.name] = status
+        # the containers that we have paused, and that a student has resumed
+        # or that are gone in the meanwhile
+        for name in list(self.scheduler.paused):
+            if statuses.get(name) != 'paused':
+                coursename, student = name.split('-x-', 1)
+                Stats(coursename).mark_paused(student, False)
+            if statuses.get(name) == 'running':
+                del self.scheduler.paused[name]
+                self.scheduler.schedule(
+                    name, now + self.pause_grace, self.scheduler.nb_kernels.get(name))
+        self.scheduler.sync(containers, now, self.grace, self.period)
+        monitored_jupyters = []
+        for name in self.scheduler.due(now):
+            container = containers[name]
+            try:
+                coursename, student = name.split('-x-')
+            # typically non-nbhosting containers
+            except ValueError as e:
+                # ignore this container as we don't even know
+                # in what course it; check again next period
+                logger.debug("ignoring non-nbhosting {}".format(container))
+                self.scheduler.schedule(name, now + self.period)
+                continue
+            # may be None if s/t is misconfigured
+            hash = self.hash_by_course.get(coursename) \
+                   or "hash not found for course {}".format(coursename)
+            monitored_jupyters.append(
+                MonitoredJupyter(container, coursename, student, hash,
+                                 statuses[name], self.scheduler.paused.get(name)))
+        if not monitored_jupyters:
+            return
+        try:
+            asyncio.get_event_loop().run_until_complete(
+                self.co_run_jupyters(monitored_jupyters))
+        finally:
+            for monitored_jupyter in monitored_jupyters:
+                name = monitored_jupyter.name
+                self.culled_by_course[monitored_jupyter.course] += \
+                    monitored_jupyter.culled_kernels
+                if monitored_jupyter.killed:
+                    self.scheduler.forget(name)
+                    self.container_table.mark(name, 'stopped')
+                elif monitored_jupyter.paused:
+                    self.container_table.mark(name, 'paused')
+                    self.scheduler.paused[name] = monitored_jupyter.last_activity
+                    self.scheduler.schedule(
+                        name, monitored_jupyter.last_activity + self.grace,
+                        monitored_jupyter.nb_kernels)
+                elif monitored_jupyter.last_activity is None:
+                    # could not probe, try again next period
+                    self.scheduler.schedule(name, now + self.period)
+                else:
+                    self.scheduler.activity[name] = monitored_jupyter.last_activity
+                    # at least a minute, in case of clock skews
+                    deadline = monitored_jupyter.deadline(
+                        self.pause_grace or self.grace, self.kernel_grace)
+                    self.scheduler.schedule(
+                        name, max(deadline, now + 60), monitored_jupyter.nb_kernels)
+
+    def evict_under_pressure(self):
+        """
+        if the host is short of memory, kill the least recently active
+        containers - even within grace - until enough memory is freed;
+        the memory each one frees is read from its cgroup, and
+        the ones that turn out to be active are spared
+        """
+        if self.memory_pressure is None:
+            return
+        to_free = self.memory_pressure.to_free()
+        if not to_free:
+            return
+        candidates = []
+        for container, status in self.container_table.snapshot():
+            name = container.name
+            if status == 'stopped' or '-x-' not in name:
+                continue
+            candidates.append(
+                (self.scheduler.last_activity(name, container), name, container, status))
+        # least recently active first
+        candidates.sort(key=lambda candidate: candidate[:2])
+        memory_by_id = self.cgroups.memory(
+            container.id for _, _, container, _ in candidates)
+        min_idle = getattr(sitesettings, 'monitor_evict_min_idle', 5 * 60)
+        freed, nb_evicted = 0, 0
+        # the ones that get spared do not count, so go on with
+        # further candidates, in batches that would free what is missing
+        while freed < to_free and candidates:
+            monitored_jupyters, expected = [], 0
+            while expected < to_free - freed and candidates:
+                last_activity, name, container, status = candidates.pop(0)
+                coursename, student = name.split('-x-', 1)
+                hash = self.hash_by_course.get(coursename) \
+                       or "hash not found for course {}".format(coursename)
+                monitored_jupyters.append(
+                    MonitoredJupyter(container, coursename, student, hash,
+                                     status, self.scheduler.paused.get(name)))
+                # if not known, evict one container at a time
+                expected += memory_by_id.get(container.id) or (to_free - freed)
+            logger.info("memory pressure - trying to free {} MiB from {} containers"
+                        .format((to_free - freed) // 1024**2, len(monitored_jupyters)))
+            try:
+                asyncio.get_event_loop().run_until_complete(
+                    self.co_run_jupyters(monitored_jupyters, evict_idle=min_idle))
+            finally:
+                for monitored_jupyter in monitored_jupyters:
+                    name = monitored_jupyter.name
+                    if monitored_jupyter.killed:
+                        nb_evicted += 1
+                        freed += memory_by_id.get(monitored_jupyter.container.id) \
+                                 or (to_free - freed)
+                        self.evicted_by_course[monitored_jupyter.course] += 1
+                        self.scheduler.forget(name)
+                        self.container_table.mark(name, 'stopped')
+                    elif monitored_jupyter.last_activity is not None:
+                        # so it does not come first next time
+                        self.scheduler.activity[name] = monitored_jupyter.last_activity
+        if freed < to_free:
+            logger.warning("memory pressure - no container left to evict, "
+                           "freed {} MiB out of {} MiB from {} containers"
+                           .format(freed // 1024**2, to_free // 1024**2, nb_evicted))
+        else:
+            logger.info("memory pressure - freed {} MiB from {} containers"
+                        .format(freed // 1024**2, nb_evicted))
+
     def run_once(self):
+        """
+        write the counts for all courses, from what is known
+        about the containers - culling is done separately
+        """
 
         # initialize all known courses - we want data on courses
         # even if they don't run any container yet 
@@ -229,39 +1048,38 @@ class Monitor:
 
         try:
             proxy = docker.from_env(version='auto')
-            logger.debug("scanning containers")
-            containers = proxy.containers.list(all=True)
-            hash_by_course = {coursename : CourseDir(coursename).image_hash(proxy)
-                              for coursename in coursenames}
+            # course images may have been rebuilt
+            self.refresh_image_hashes(proxy, coursenames)
         except Exception as e:
             logger.exception(
-                "Cannot gather containers list at the docker daemon - skipping")
+                "Cannot gather images at the docker daemon - skipping")
             return
 
-        # a list of async futures
-        futures = []
-        for container in containers:
+        culled_by_course, self.culled_by_course = self.culled_by_course, defaultdict(int)
+        evicted_by_course, self.evicted_by_course = self.evicted_by_course, defaultdict(int)
+        # container id -> (coursename, student) for the ones that hold resources
+        accounted = {}
+        for container, status in self.container_table.snapshot():
             try:
-                name = container.name
-                # too much spam ven in debug mode
-                # logger.debug("dealing with container {}".format(name))
-                coursename, student = name.split('-x-')
-                figures_by_course.setdefault(coursename, CourseFigures())
-                figures = figures_by_course[coursename]
-                # may be None if s/t is misconfigured
-                hash = hash_by_course[coursename] \
-                       or "hash not found for course {}".format(coursename)
-                monitored_jupyter = MonitoredJupyter(container, coursename, student, figures, hash)
-                futures.append(monitored_jupyter.co_run(self.grace))
+                coursename, student = container.name.split('-x-')
             # typically non-nbhosting containers
             except ValueError as e:
-                # ignore this container as we don't even know
-                # in what course it
-                logger.info("ignoring non-nbhosting {}"
-                            .format(container))
-            except Exception as e:
-                logger.exception("ignoring {} in monitor - unexpected exception"
-                                 .format(container))
+                continue
+            figures = figures_by_course.setdefault(coursename, CourseFigures())
+            if status == 'paused':
+                figures.count_paused_container()
+            else:
+                figures.count_container(
+                    status == 'running', self.scheduler.nb_kernels.get(container.name))
+            if status != 'stopped':
+                accounted[container.id] = (coursename, student)
+        # a few reads per container, instead of one docker stats call each
+        try:
+            for id, (memory, cpu_percent) in self.cgroups.sample(accounted).items():
+                coursename, student = accounted[id]
+                figures_by_course[coursename].count_usage(student, memory, cpu_percent)
+        except Exception as e:
+            logger.exception("monitor cannot read containers cgroups")
         # ds stands for disk_space
         docker_root = proxy.info()['DockerRootDir']
         nbhroot = sitesettings.nbhroot
@@ -286,20 +1104,23 @@ class Monitor:
 
         # loads
         try:
-            uptime_output = subprocess.check_output('uptime').decode().strip()
-            end_of_line = uptime_output.split(':')[-1]
-            floads = end_of_line.split(', ')
-            load1, load5, load15 = [round(100*float(x)) for x in floads]
+            load1, load5, load15 = [round(100*x) for x in read_loadavg()]
 
         except Exception as e:
             load1, load5, load15 = 0, 0, 0
             logger.exception("monitor cannot compute cpu loads")
 
 
-        # run the whole stuff 
-        asyncio.get_event_loop().run_until_complete(
-            asyncio.gather(*futures))
+        # memory
+        try:
+            available_memory = round(
+                read_meminfo()['MemAvailable'] / 1024**2)
+        except Exception as e:
+            available_memory = 0
+            logger.exception("monitor cannot read available memory")
+
         # write results
+        top = getattr(sitesettings, 'monitor_usage_top', 10)
         for coursename, figures in figures_by_course.items():
             student_homes = CourseDir(coursename).student_homes()
             Stats(coursename).record_monitor_counts(
@@ -310,25 +1131,77 @@ class Monitor:
                 ds['docker']['percent'], ds['docker']['free'],
                 ds['nbhosting']['percent'], ds['nbhosting']['free'],
                 ds['system']['percent'], ds['system']['free'],
+                culled_by_course[coursename],
+                figures.paused_containers,
+                figures.total_memory(), figures.total_cpu(), figures.max_memory(),
+                evicted_by_course[coursename], available_memory,
+                period=self.period,
             )
+            if figures.usages and top:
+                Stats(coursename).record_container_usage(figures.top_usages(top))
+        # at the beginning of a month, move the previous one
+        # into closed segments - this is a no-op otherwise
+        if getattr(sitesettings, 'stats_segments', True):
+            for coursename in figures_by_course:
+                try:
+                    Stats(coursename).seal_segments()
+                except Exception as e:
+                    logger.exception("cannot seal segments for {}"
+                                     .format(coursename))
+        # precompute what the stats views serve, so that
+        # web workers do not have to
+        if getattr(sitesettings, 'stats_snapshots', True):
+            beg = time.time()
+            for coursename in figures_by_course:
+                write_snapshots(coursename)
+            logger.info("stats snapshots for {} courses took {:.2f}s"
+                        .format(len(figures_by_course), time.time() - beg))
+            # same for /nbh/stats-overview
+            beg = time.time()
+            try:
+                overview(list(figures_by_course))
+            except Exception as e:
+                logger.exception("cannot compute stats overview")
+            logger.info("stats overview for {} courses took {:.2f}s"
+                        .format(len(figures_by_course), time.time() - beg))
 
     def run_forever(self):
         tick = time.time()
+        # how often are due containers looked for
+        step = getattr(sitesettings, 'monitor_cull_step', 60)
 
-        # one cycle can take some time as all the jupyters need to be http-probed
-        # so let us compute the actual time to wait
         logger.info("nbh-monitor is starting up")
+        # the events that occur while the table gets built are not lost
+        self.container_table.since = int(time.time())
+        threading.Thread(target=self.container_table.follow_forever,
+                         daemon=True).start()
         coursenames = CoursesDir().coursenames()
         for coursename in coursenames:
             Stats(coursename).record_monitor_known_counts_line()
+        try:
+            self.adopt_paused(coursenames)
+        except Exception as e:
+            logger.exception("cannot take over paused containers")
         while True:
-            try:
-                self.run_once()
             # just be extra sure it doesn't crash
+            try:
+                self.cull_due()
+            except Exception as e:
+                logger.exception("protecting against unexpected exception {}"
+                                 .format(e))
+            # after culling, that may have freed enough already
+            try:
+                self.evict_under_pressure()
             except Exception as e:
                 logger.exception("protecting against unexpected exception {}"
                                  .format(e))
-            tick += self.period
-            duration = max(0, int(tick - time.time()))
-            logger.info("monitor is waiting for {}s".format(duration))
-            time.sleep(duration)
+            if time.time() >= tick:
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.exception("protecting against unexpected exception {}"
+                                     .format(e))
+                tick += self.period
+                logger.info("next counts in {}s"
+                            .format(max(0, int(tick - time.time()))))
+            time.sleep(max(0, min(tick, time.time() + step) - time.time()))
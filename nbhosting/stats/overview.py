@@ -0,0 +1,170 @@
+"""
+headline figures for all courses at once
+
+for each course, the overview shows
+* students: the number of students who showed up at least once
+* notebooks: the number of notebooks read at least once
+* active containers: running containers and kernels, as per
+  the last line in counts.raw
+* last day activity: unique students and notebooks on the most recent
+  day that has events
+
+the figures for one course only depend on the files that all_metrics
+depends upon, so they are cached in raw/<course>/overview.json together
+with the signature of these files; a course is recomputed only when
+that signature has changed
+
+nbh-monitor refreshes these caches at the end of each cycle, computing
+the courses that need it concurrently in a process pool; web workers
+compute the few courses that may have changed since, sequentially
+
+the pool processes are spawned rather than forked, as nbh-monitor
+has threads running - e.g. the one that follows docker events - and
+a forked child could inherit a lock held by one of them
+"""
+
+import os
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from nbhosting.stats.stats import Stats
+from nbhosting.main.settings import sitesettings, logger
+
+
+def cache_path(stats):
+    return stats.course_dir / "overview.json"
+
+
+def load_cached(stats, signature):
+    """
+    the cached headlines for that course if they match signature,
+    None otherwise
+    """
+    try:
+        with cache_path(stats).open() as f:
+            cached = json.load(f)
+        if cached['signature'] == signature:
+            return cached['headlines']
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.exception("ignoring misformed overview cache for {}"
+                         .format(stats.course))
+    return None
+
+
+def store_cached(stats, signature, headlines):
+    path = cache_path(stats)
+    tmp_path = path.with_name(path.name + ".{}".format(os.getpid()))
+    try:
+        with tmp_path.open('w') as f:
+            json.dump({'signature': signature, 'headlines': headlines}, f)
+        tmp_path.rename(path)
+    except Exception as e:
+        logger.exception("cannot store overview cache for {}"
+                         .format(stats.course))
+
+
+def course_headlines(course, workers=None):
+    """
+    compute the headline figures for one course;
+    runs in a worker process, so it only takes and returns plain data
+
+    workers is passed to daily_metrics; it is 1 in a process pool,
+    so that pools do not get nested
+
+    returns a tuple (signature, headlines); the signature is taken
+    before reading the files, so that a change that happens during
+    the computation gets noticed next time
+    """
+    stats = Stats(course)
+    signature = stats.signature('all_metrics')
+    # checkpointed, so usually only the tail of events.raw gets read
+    metrics = stats.daily_metrics(workers=workers)
+    events, daily = metrics['events'], metrics['daily']
+    headlines = {
+        'students' : events['total_students'][-1] if events['timestamps'] else 0,
+        'notebooks' : events['total_notebooks'][-1] if events['timestamps'] else 0,
+        'last_event' : events['timestamps'][-1] if events['timestamps'] else None,
+        'last_day' : None,
+        'last_day_students' : 0,
+        'last_day_notebooks' : 0,
+        'last_day_new_students' : 0,
+        'counts_time' : None,
+        'running_containers' : None,
+        'frozen_containers' : None,
+        'running_kernels' : None,
+    }
+    if daily['timestamps']:
+        headlines.update({
+            'last_day' : daily['timestamps'][-1].split()[0],
+            'last_day_students' : daily['unique_students'][-1],
+            'last_day_notebooks' : daily['unique_notebooks'][-1],
+            'last_day_new_students' : daily['new_students'][-1],
+        })
+    last_counts = stats.last_monitor_counts()
+    if last_counts is not None:
+        timestamp, counts = last_counts
+        headlines.update({
+            'counts_time' : timestamp,
+            'running_containers' : counts.get('running_container'),
+            'frozen_containers' : counts.get('frozen_container'),
+            'running_kernels' : counts.get('running_kernel'),
+        })
+    return signature, headlines
+
+
+def overview_workers(nb_courses, workers=None):
+    if workers is None:
+        workers = getattr(sitesettings, 'stats_overview_workers', 4)
+    return max(1, min(workers or 1, os.cpu_count() or 1, nb_courses))
+
+
+def overview(coursenames, workers=None):
+    """
+    returns a dict course -> headlines, in the order of coursenames;
+    for a course that could not be computed, headlines is
+    { 'error' : message }
+
+    workers is the size of the process pool used for the courses
+    that need to be computed; it defaults to stats_overview_workers,
+    and 1 means no pool at all - which is what web workers use
+    """
+    results = {}
+    todo = []
+    for course in coursenames:
+        stats = Stats(course)
+        headlines = load_cached(stats, stats.signature('all_metrics'))
+        if headlines is not None:
+            results[course] = headlines
+        else:
+            todo.append(course)
+
+    def done(course, signature, headlines):
+        store_cached(Stats(course), signature, headlines)
+        results[course] = headlines
+
+    def failed(course, e):
+        logger.exception("cannot compute overview for {}".format(course))
+        results[course] = {'error' : "{}".format(e)}
+
+    workers = overview_workers(len(todo), workers)
+    if workers <= 1:
+        for course in todo:
+            try:
+                done(course, *course_headlines(course))
+            except Exception as e:
+                failed(course, e)
+    else:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [(course, executor.submit(course_headlines, course, 1))
+                       for course in todo]
+            # one failing course does not prevent the others
+            for course, future in futures:
+                try:
+                    done(course, *future.result())
+                except Exception as e:
+                    failed(course, e)
+    return {course: results[course] for course in coursenames}
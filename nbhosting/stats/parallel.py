@@ -0,0 +1,185 @@
+"""
+a parallel, map-reduce, scan of events.raw
+
+when no checkpoint is available, e.g. right after a deploy, a very
+large events.raw can be parsed by several processes; the file is cut
+on line boundaries into byte ranges, and each range is parsed by
+parse_range() in a ProcessPoolExecutor, which returns a Partial
+
+partials only hold aggregates - sets per day, counts per (notebook, student),
+first occurrences - that get merged into the usual result structures,
+see DailyMetrics.from_partials and MaterialUsage.from_partials in stats.py
+"""
+
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from nbhosting.stats.columnar import epoch_from_timestamp, non_open_actions
+from nbhosting.stats.timebuckets import AnimatedCounts
+from nbhosting.main.settings import logger
+
+
+def split_ranges(events_path, nb_ranges):
+    """
+    cut events_path into at most nb_ranges byte ranges
+    that all begin at the beginning of a line
+
+    returns a list of (start, end) tuples
+    """
+    size = events_path.stat().st_size
+    bounds = [0]
+    with events_path.open('rb') as f:
+        for i in range(1, nb_ranges):
+            f.seek(max(size * i // nb_ranges, bounds[-1]))
+            f.readline()
+            bound = f.tell()
+            if bounds[-1] < bound < size:
+                bounds.append(bound)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+class Partial:
+    """
+    what parse_range() has found in one range
+
+    event indices are relative to the range, and count
+    only the events that were kept
+    """
+    def __init__(self, start):
+        self.start = start
+        # the end of the last complete line
+        self.offset = start
+        self.nb_lines = 0
+        self.nb_events = 0
+        # for daily metrics
+        # day -> (set of students, set of notebooks), in order of appearance
+        self.days = OrderedDict()
+        self.last_day = None
+        # False if a day shows up again after another one
+        self.in_order = True
+        # student -> (index, timestamp) of its first event, same for notebooks
+        self.first_students = {}
+        self.first_notebooks = {}
+        self.last_timestamp = None
+        # for material usage
+        # (notebook, student) -> number of events
+        self.counts = defaultdict(int)
+        # (notebook, student) -> index of its first event
+        self.first_pairs = {}
+        # (index, epoch, quotient) for the events where the time bucket
+        # changes, and for the first event in the range
+        self.changes = []
+        self.last_quotient = None
+
+    def add_daily(self, timestamp, student, notebook):
+        index = self.nb_events
+        # same key as in DailyMetrics
+        day = timestamp.split('T')[0] + ' 23:59:59'
+        if day != self.last_day:
+            if day in self.days:
+                self.in_order = False
+            else:
+                self.days[day] = (set(), set())
+            self.last_day = day
+        students, notebooks = self.days[day]
+        students.add(student)
+        notebooks.add(notebook)
+        if student not in self.first_students:
+            self.first_students[student] = (index, timestamp)
+        if notebook not in self.first_notebooks:
+            self.first_notebooks[notebook] = (index, timestamp)
+        self.last_timestamp = timestamp
+
+    def add_material(self, timestamp, student, notebook, grain_seconds):
+        index = self.nb_events
+        epoch = epoch_from_timestamp(timestamp)
+        # same as AnimatedCounts.advance
+        quotient = (epoch - AnimatedCounts.origin) // grain_seconds
+        if index == 0 or quotient != self.last_quotient:
+            self.changes.append((index, epoch, quotient))
+        self.last_quotient = quotient
+        pair = notebook, student
+        self.counts[pair] += 1
+        if pair not in self.first_pairs:
+            self.first_pairs[pair] = index
+
+
+def feed_lines(partial, bytes_lines, keep_student, grain_seconds,
+               daily=True, material=True, source=None):
+    """
+    add the events in bytes_lines into partial, stopping at
+    the first incomplete line; partial.offset is updated accordingly
+
+    source is only used in error messages
+    returns partial
+    """
+    for bytes_line in bytes_lines:
+        # the last line may still be in the process of being written
+        if not bytes_line.endswith(b'\n'):
+            break
+        line_offset = partial.offset
+        partial.offset += len(bytes_line)
+        partial.nb_lines += 1
+        try:
+            timestamp, course, student, notebook, action, port = \
+                bytes_line.decode().split()
+            if action in non_open_actions:
+                continue
+            if not keep_student(student):
+                continue
+            # same order as in Stats._scan_events
+            if material:
+                partial.add_material(timestamp, student, notebook, grain_seconds)
+            if daily:
+                partial.add_daily(timestamp, student, notebook)
+            partial.nb_events += 1
+        except Exception as e:
+            # line numbers are not known at this point
+            logger.exception("{}@{}: skipped misformed events line :{}"
+                             .format(source, line_offset, bytes_line))
+    return partial
+
+
+def parse_range(events_path, start, end, keep_student, grain_seconds,
+                daily=True, material=True):
+    """
+    parse the lines in events_path that begin in [start, end)
+
+    keep_student must be picklable, and has the same
+    meaning as in Stats._scan_events
+    returns a Partial
+    """
+    with events_path.open('rb') as f:
+        f.seek(start)
+        def lines():
+            offset = start
+            while offset < end:
+                bytes_line = f.readline()
+                if not bytes_line:
+                    break
+                offset += len(bytes_line)
+                yield bytes_line
+        return feed_lines(Partial(start), lines(), keep_student, grain_seconds,
+                          daily, material, events_path)
+
+
+def map_ranges(events_path, workers, keep_student, grain_seconds,
+               daily=True, material=True):
+    """
+    parse events_path with that many processes
+
+    returns the list of partials, in file order
+    """
+    ranges = split_ranges(events_path, workers)
+    nb_ranges = len(ranges)
+    with ProcessPoolExecutor(max_workers=nb_ranges) as executor:
+        return list(executor.map(
+            parse_range,
+            [events_path] * nb_ranges,
+            [start for start, _ in ranges],
+            [end for _, end in ranges],
+            [keep_student] * nb_ranges,
+            [grain_seconds] * nb_ranges,
+            [daily] * nb_ranges,
+            [material] * nb_ranges))
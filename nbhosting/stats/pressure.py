@@ -0,0 +1,99 @@
+"""
+memory pressure on the host, as seen by nbh-monitor
+
+the grace timeout is a trade-off between keeping the containers of
+students who just take a break, and the memory that idle containers
+hold; on a busy day the host can run out of memory well before
+anything gets idle for that long
+
+so the monitor also watches
+* MemAvailable in /proc/meminfo
+* the memory stall time in /proc/pressure/memory - PSI, in kernels
+  that support it; that is the share of time some tasks were
+  waiting for memory, over the last 10 seconds
+
+and when the available memory gets below a low watermark, it
+evicts idle containers - the least recently active first - until
+the available memory is back above a high watermark; between both
+watermarks, a stall time above a threshold also starts evictions
+"""
+
+from pathlib import Path
+
+from nbhosting.main.settings import monitor_logger as logger
+
+
+def read_meminfo(path=Path("/proc/meminfo")):
+    """
+    a dict like {'MemTotal' : 16712523776, ...} - all in bytes
+    """
+    result = {}
+    for line in path.read_text().splitlines():
+        key, _, value = line.partition(':')
+        fields = value.split()
+        try:
+            result[key] = int(fields[0]) * (1024 if fields[1:] == ['kB'] else 1)
+        except (IndexError, ValueError):
+            pass
+    return result
+
+
+def read_memory_stall(path=Path("/proc/pressure/memory")):
+    """
+    the 'some avg10' figure - a percentage - or None if PSI is not available
+    """
+    try:
+        for line in path.read_text().splitlines():
+            kind, *fields = line.split()
+            if kind == 'some':
+                return float(dict(field.split('=') for field in fields)['avg10'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+class MemoryPressure:
+    """
+    low and high are watermarks in percent of the total memory,
+    stall_threshold is in percent as well, and may be None
+    """
+    def __init__(self, low, high, stall_threshold=None,
+                 meminfo_path=Path("/proc/meminfo"),
+                 pressure_path=Path("/proc/pressure/memory")):
+        self.low = low
+        self.high = max(low, high)
+        self.stall_threshold = stall_threshold
+        self.meminfo_path = meminfo_path
+        self.pressure_path = pressure_path
+        # True from the time low is crossed until high is reached again
+        self.evicting = False
+        # as of the last check, in bytes
+        self.available = None
+
+    def to_free(self):
+        """
+        check the current pressure, and return how many bytes
+        need to be freed to get back above the high watermark;
+        0 means there is no need to evict anything
+        """
+        meminfo = read_meminfo(self.meminfo_path)
+        total = meminfo['MemTotal']
+        available = self.available = meminfo['MemAvailable']
+        stall = read_memory_stall(self.pressure_path)
+        low, high = total * self.low / 100, total * self.high / 100
+        stall_text = "n/a" if stall is None else "{}%".format(stall)
+        stalled = self.stall_threshold is not None and stall is not None \
+                  and stall >= self.stall_threshold
+        if not self.evicting and (available < low or (stalled and available < high)):
+            logger.warning("memory pressure - {} MiB available out of {} MiB, "
+                           "stall {} - evicting idle containers"
+                           .format(available // 1024**2, total // 1024**2, stall_text))
+            self.evicting = True
+        elif self.evicting and available >= high:
+            logger.info("memory pressure is over - {} MiB available out of {} MiB, "
+                        "stall {}"
+                        .format(available // 1024**2, total // 1024**2, stall_text))
+            self.evicting = False
+        if not self.evicting:
+            return 0
+        return max(1, int(high - available))
@@ -0,0 +1,138 @@
+"""
+the stats products, i.e. what the /nbh/stats/ urls return
+
+a product is computed from a Stats instance, according to parameters
+that come from a query string; this is shared between the views,
+that compute products upon request, and nbh-monitor, that precomputes
+them in snapshots - see snapshots.py
+
+params are dict-like objects, typically request.GET
+"""
+
+import re
+import time
+import calendar
+import json
+import uuid
+import types
+import itertools
+
+from nbhosting.stats.stats import time_format
+from nbhosting.stats.heatmap import parse_window, encodings as heatmap_encodings
+
+
+def heatmap_options(params):
+    """
+    the query parameters that drive the heatmap encoding, i.e.
+    * heatmap=dense|sparse
+    * rows=<start>:<stop> and cols=<start>:<stop> for restricting
+      to a window, with the semantics of python slices
+    raises ValueError if any is misformed
+    """
+    options = { 'lazy' : True }
+    if 'heatmap' in params:
+        options['encoding'] = params['heatmap']
+        if options['encoding'] not in heatmap_encodings:
+            raise ValueError("unknown heatmap encoding")
+    for window in ('rows', 'cols'):
+        options[window] = parse_window(params.get(window))
+    return options
+
+
+def parse_time(value):
+    """
+    accepts either a number of seconds since the epoch,
+    or a UTC time like 2018-01-08T09:00:00, or a UTC day like 2018-01-08
+    returns an epoch, or None if value is None or empty
+    raises ValueError if value is misformed
+    """
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    format = "%Y-%m-%d" if len(value) == 10 else time_format
+    return calendar.timegm(time.strptime(value, format))
+
+
+def window_options(params):
+    """
+    the query parameters that restrict events to a time range, i.e.
+    from and to: see parse_time
+    raises ValueError if any is misformed
+    """
+    return {
+        'since' : parse_time(params.get('from')),
+        'until' : parse_time(params.get('to')),
+    }
+
+
+def counts_options(params):
+    """
+    the query parameters that select a time range and a resolution in counts, i.e.
+    * from and to: see parse_time
+    * max_points: the maximal number of points expected
+    raises ValueError if any is misformed
+    """
+    max_points = params.get('max_points')
+    options = window_options(params)
+    options['max_points'] = int(max_points) if max_points else None
+    return options
+
+
+def computer(product, params):
+    """
+    returns a function that computes product from a Stats instance
+    raises ValueError if params are misformed
+    """
+    if product == 'daily_metrics':
+        window = window_options(params)
+        return lambda stats: stats.daily_metrics(**window)
+    if product == 'monitor_counts':
+        counts = counts_options(params)
+        return lambda stats: stats.monitor_counts(**counts)
+    if product == 'material_usage':
+        options = heatmap_options(params)
+        window = window_options(params)
+        return lambda stats: stats.material_usage(**window, **options)
+    if product == 'all_metrics':
+        options = heatmap_options(params)
+        window = window_options(params)
+        counts = counts_options(params)
+        return lambda stats: stats.all_metrics(counts_options=counts,
+                                               **window, **options)
+    raise ValueError("unknown product {}".format(product))
+
+
+def json_chunks(obj, batch=1000):
+    """
+    like json.dumps(obj), but as an iterator over bytes;
+    the values in obj - or in its sub-dicts - that are generators
+    are encoded on the fly, by batches of that many items,
+    so that the corresponding lists never exist in memory
+    """
+    generators = {}
+    marker = uuid.uuid4().hex
+    def replace(value):
+        if isinstance(value, dict):
+            return { k: replace(v) for k, v in value.items() }
+        if isinstance(value, types.GeneratorType):
+            placeholder = "{}-{}".format(marker, len(generators))
+            generators[placeholder] = value
+            return placeholder
+        return value
+    encoded = json.dumps(replace(obj))
+    position = 0
+    for match in re.finditer(r'"({}-[0-9]+)"'.format(marker), encoded):
+        yield encoded[position:match.start()].encode()
+        yield b"["
+        separator = b""
+        generator = generators[match.group(1)]
+        while True:
+            items = list(itertools.islice(generator, batch))
+            if not items:
+                break
+            yield separator + json.dumps(items)[1:-1].encode()
+            separator = b", "
+        yield b"]"
+        position = match.end()
+    yield encoded[position:].encode()
@@ -0,0 +1,298 @@
+"""
+multi-resolution rollups of counts.raw
+
+counts.raw gets one line per monitor cycle, which over a year
+means tens of thousands of points per series; so alongside this
+raw file, the monitor maintains coarser versions, currently
+hourly and daily, in files named e.g. counts.hourly
+
+each line in a rollup file describes one closed bucket, as
+    <timestamp> <n> <min>,<mean>,<max> <min>,<mean>,<max> ...
+where timestamp is the beginning of the bucket, n the number of
+raw samples, followed by one triple per known count ('-' if unknown)
+
+the bucket being filled is not in these files yet; it is kept
+in counts.rollups - a JSON file - together with the monitor period,
+so that state survives a monitor restart
+"""
+
+import os
+import json
+import time
+
+from nbhosting.stats.columnar import epoch_from_timestamp
+from nbhosting.main.settings import logger
+
+# using gmtime in all raw files
+time_format = "%Y-%m-%dT%H:%M:%S"
+
+# name, period in seconds
+resolutions = [
+    ('hourly', 3600),
+    ('daily', 24 * 3600),
+]
+
+# used if the monitor has not told us its period yet
+default_raw_period = 600
+
+
+def timestamp_from_epoch(epoch):
+    return time.strftime(time_format, time.gmtime(epoch))
+
+
+class Bucket:
+    """
+    accumulates samples over one bucket, with min, max and mean
+    for each count; a sample may have missing values (None)
+    """
+    def __init__(self, start, nb_counts):
+        self.start = start
+        self.n = 0
+        self.mins = [None] * nb_counts
+        self.maxs = [None] * nb_counts
+        self.sums = [0] * nb_counts
+        self.nbs = [0] * nb_counts
+
+    def add(self, values):
+        self.n += 1
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            self.mins[i] = value if self.mins[i] is None else min(self.mins[i], value)
+            self.maxs[i] = value if self.maxs[i] is None else max(self.maxs[i], value)
+            self.sums[i] += value
+            self.nbs[i] += 1
+
+    def triples(self):
+        """
+        one (min, mean, max) tuple per count, or None
+        """
+        return [ (self.mins[i], round(self.sums[i] / self.nbs[i], 2), self.maxs[i])
+                 if self.nbs[i] else None
+                 for i in range(len(self.nbs)) ]
+
+    def line(self):
+        return "{} {} {}\n".format(
+            timestamp_from_epoch(self.start), self.n,
+            " ".join("{},{},{}".format(*triple) if triple else "-"
+                     for triple in self.triples()))
+
+    # for storing in the JSON state
+    def to_dict(self):
+        return vars(self)
+
+    @staticmethod
+    def from_dict(d, nb_counts):
+        bucket = Bucket(d['start'], nb_counts)
+        for attr in ('n', 'mins', 'maxs', 'sums', 'nbs'):
+            setattr(bucket, attr, d[attr])
+        # known_counts may have been extended since
+        for attr, filler in (('mins', None), ('maxs', None), ('sums', 0), ('nbs', 0)):
+            values = getattr(bucket, attr)
+            values.extend([filler] * (nb_counts - len(values)))
+        return bucket
+
+
+def parse_line(line, nb_counts):
+    """
+    the reverse of Bucket.line()
+    returns timestamp, list of triples (or None)
+    """
+    timestamp, _, *fields = line.split()
+    triples = []
+    for field in fields[:nb_counts]:
+        if field == '-':
+            triples.append(None)
+        else:
+            mini, mean, maxi = field.split(',')
+            triples.append((int(mini), float(mean), int(maxi)))
+    triples.extend([None] * (nb_counts - len(triples)))
+    return timestamp, triples
+
+
+class CountsRollups:
+    """
+    all the rollups for one course
+    """
+    def __init__(self, course_dir, known_counts):
+        self.course_dir = course_dir
+        self.known_counts = known_counts
+
+    def rollup_path(self, resolution):
+        return self.course_dir / "counts.{}".format(resolution)
+
+    def state_path(self):
+        return self.course_dir / "counts.rollups"
+
+    def exists(self):
+        return self.state_path().exists()
+
+    def _load_state(self):
+        try:
+            with self.state_path().open() as f:
+                state = json.load(f)
+            nb_counts = len(self.known_counts)
+            state['buckets'] = {
+                resolution: Bucket.from_dict(d, nb_counts)
+                for resolution, d in state['buckets'].items()
+            }
+            return state
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.exception("Cannot read rollups state {}"
+                             .format(self.state_path()))
+        return { 'period' : None, 'buckets' : {} }
+
+    def _store_state(self, state):
+        path = self.state_path()
+        tmp_path = path.with_name("{}.{}".format(path.name, os.getpid()))
+        with tmp_path.open('w') as f:
+            json.dump({ 'period' : state['period'],
+                        'buckets' : { resolution : bucket.to_dict()
+                                      for resolution, bucket in state['buckets'].items()}},
+                      f)
+        tmp_path.rename(path)
+
+    def _add(self, state, epoch, values, outputs):
+        """
+        add one sample; closed buckets are written in outputs
+        a dict resolution -> open file
+        """
+        nb_counts = len(self.known_counts)
+        for resolution, period in resolutions:
+            start = epoch - epoch % period
+            bucket = state['buckets'].get(resolution)
+            if bucket is not None and bucket.start != start:
+                outputs[resolution].write(bucket.line())
+                bucket = None
+            if bucket is None:
+                bucket = Bucket(start, nb_counts)
+                state['buckets'][resolution] = bucket
+            bucket.add(values)
+
+    def _open_outputs(self, mode):
+        return { resolution: self.rollup_path(resolution).open(mode)
+                 for resolution, _ in resolutions }
+
+    def add(self, epoch, values, period=None):
+        """
+        add one sample, i.e. what was written in one line of counts.raw
+        period is the monitor period in seconds, if known
+        """
+        state = self._load_state()
+        if period:
+            state['period'] = period
+        outputs = self._open_outputs('a')
+        try:
+            self._add(state, epoch, values, outputs)
+        finally:
+            for output in outputs.values():
+                output.close()
+        self._store_state(state)
+
+    def rebuild(self, raw_lines, period=None):
+        """
+        rebuild all rollups from scratch
+        raw_lines is an iterable over (epoch, values) tuples
+        """
+        state = { 'period' : period, 'buckets' : {} }
+        outputs = self._open_outputs('w')
+        try:
+            for epoch, values in raw_lines:
+                self._add(state, epoch, values, outputs)
+        finally:
+            for output in outputs.values():
+                output.close()
+        self._store_state(state)
+
+    def raw_period(self):
+        return self._load_state()['period'] or default_raw_period
+
+    def read(self, resolution, since=None, until=None):
+        """
+        the contents of one rollup, including the bucket being filled,
+        restricted to buckets that intersect [since, until] (epochs)
+
+        returns a dict with the same keys as Stats.monitor_counts(),
+        where the count values are the means; the min and max values are
+        exposed in additional keys, e.g. 'running_containers_min'
+        """
+        period = dict(resolutions)[resolution]
+        nb_counts = len(self.known_counts)
+        timestamps = []
+        series = { count: ([], [], []) for count in self.known_counts }
+        def append(timestamp, triples):
+            timestamps.append(timestamp)
+            for count, triple in zip(self.known_counts, triples):
+                for serie, value in zip(series[count], triple or (None, None, None)):
+                    serie.append(value)
+        def in_range(timestamp):
+            start = epoch_from_timestamp(timestamp)
+            return ((since is None or start + period > since)
+                    and (until is None or start <= until))
+        path = self.rollup_path(resolution)
+        try:
+            with path.open() as f:
+                for lineno, line in enumerate(f, 1):
+                    try:
+                        timestamp, triples = parse_line(line, nb_counts)
+                        if in_range(timestamp):
+                            append(timestamp, triples)
+                    except Exception as e:
+                        logger.error("{}:{}: skipped misformed rollup line {}"
+                                     .format(path, lineno, line))
+        except FileNotFoundError:
+            pass
+        bucket = self._load_state()['buckets'].get(resolution)
+        if bucket is not None:
+            timestamp = timestamp_from_epoch(bucket.start)
+            if in_range(timestamp):
+                append(timestamp, bucket.triples())
+        result = {}
+        for count, (mins, means, maxs) in series.items():
+            result["{}s".format(count)] = means
+            result["{}s_min".format(count)] = mins
+            result["{}s_max".format(count)] = maxs
+        result['timestamps'] = timestamps
+        result['resolution'] = resolution
+        return result
+
+
+def seek_timestamp(f, timestamp):
+    """
+    f is a file opened in binary mode, made of lines that start with
+    a timestamp, in increasing order; lines starting with '#' are ignored
+
+    moves f to the beginning of the first line whose timestamp is
+    greater or equal to timestamp, using a binary search
+    """
+    key = timestamp.encode()
+    def first_line_from(offset):
+        """
+        the offset and timestamp of the first non-comment line
+        that starts at or after offset, or (size, None)
+        """
+        f.seek(offset)
+        if offset > 0:
+            # we're likely in the middle of a line
+            f.seek(offset - 1)
+            f.readline()
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line:
+                return position, None
+            if not line.startswith(b'#'):
+                return position, line[:len(key)]
+    f.seek(0, os.SEEK_END)
+    low, high = 0, f.tell()
+    # invariant: the answer starts in [low, high]
+    while low < high:
+        middle = (low + high) // 2
+        position, line_key = first_line_from(middle)
+        if line_key is None or line_key >= key:
+            high = middle
+        else:
+            low = position + 1
+    f.seek(first_line_from(low)[0])
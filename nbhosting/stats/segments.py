@@ -0,0 +1,274 @@
+"""
+monthly segments of events.raw and counts.raw - and usage.raw
+
+these files only hold the lines of the current month - give or take a few
+lines; at the beginning of each month, nbh-monitor moves the older lines
+into closed segments in raw/<course>/segments/, named e.g.
+    events-2018-01.raw.gz
+    counts-2018-01.raw.gz
+    usage-2018-01.raw.gz
+
+a closed events segment comes with a sealed summary in
+    events-2018-01.summary
+that holds the set of students and notebooks seen in that month, and
+the per-day aggregates as a Partial - see nbhosting.stats.parallel;
+so the history can be accounted for without decompressing anything,
+and raw lines are only read from the segments that a query really needs
+
+a summary depends on the staff, which is filtered out; it is recomputed
+and sealed again if the staff changes, or if the segment gets appended to
+"""
+
+import os
+import re
+import gzip
+import pickle
+
+from nbhosting.stats import parallel
+from nbhosting.stats.columnar import non_open_actions
+from nbhosting.stats.rollups import seek_timestamp
+from nbhosting.main.settings import logger
+
+month_regexp = re.compile(rb"[0-9]{4}-[0-9]{2}-")
+
+# bump this when the contents of summaries change
+summary_version = 1
+
+
+class Segment:
+    """
+    one closed month of either events or counts
+    """
+    def __init__(self, path):
+        self.path = path
+        # e.g. events-2018-01.raw.gz
+        self.kind, rest = path.name.split('-', 1)
+        self.month = rest[:7]
+
+    def lines(self):
+        """
+        the bytes lines in that segment
+        """
+        with gzip.open(str(self.path), 'rb') as f:
+            yield from f
+
+    def summary_path(self):
+        return self.path.with_name("{}-{}.summary".format(self.kind, self.month))
+
+    def summary(self, staff, keep_student, grain_seconds):
+        """
+        the sealed summary of an events segment, as a dict with keys
+        * 'students' and 'notebooks': the sets of all the ones seen
+        * 'partial': a Partial for the events that pass keep_student,
+          with a material usage part computed with grain_seconds
+
+        keep_student is expected to filter out that staff, that is only
+        used to check that the sealed summary can be used
+        """
+        stat = self.path.stat()
+        key = {
+            'version' : summary_version,
+            'staff' : sorted(staff),
+            'grain' : grain_seconds,
+            'size' : stat.st_size,
+            'mtime' : stat.st_mtime_ns,
+        }
+        try:
+            with self.summary_path().open('rb') as f:
+                summary = pickle.load(f)
+            if summary['key'] == key:
+                return summary
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.exception("{}: discarding unreadable summary"
+                             .format(self.summary_path()))
+        return self._seal(key, keep_student, grain_seconds)
+
+    def _seal(self, key, keep_student, grain_seconds):
+        students, notebooks = set(), set()
+        def lines():
+            for bytes_line in self.lines():
+                fields = bytes_line.split()
+                if len(fields) == 6:
+                    students.add(fields[2].decode(errors='replace'))
+                    # the notebook for a 'killing' line is '-'
+                    if fields[4].decode(errors='replace') not in non_open_actions:
+                        notebooks.add(fields[3].decode(errors='replace'))
+                yield bytes_line
+        partial = parallel.feed_lines(
+            parallel.Partial(0), lines(), keep_student, grain_seconds,
+            source=self.path)
+        summary = {
+            'key' : key,
+            'students' : students,
+            'notebooks' : notebooks,
+            'partial' : partial,
+        }
+        summary_path = self.summary_path()
+        tmp_path = summary_path.with_name(summary_path.name + ".tmp")
+        try:
+            with tmp_path.open('wb') as f:
+                pickle.dump(summary, f, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_path.rename(summary_path)
+        except Exception as e:
+            logger.exception("cannot seal summary {}".format(summary_path))
+        return summary
+
+
+class Split:
+    """
+    moving the lines older than month from path
+    into the segments of that kind, in 2 steps
+
+    * prepare() compresses these lines into temporary files; these lines
+      are not going to change, so this is done without any lock
+    * install() puts the segments in place and rewrites path
+      with the remaining lines; this must be done with the lock held
+      for writing into path, if any
+    """
+    def __init__(self, segments, path, kind, month):
+        self.segments = segments
+        self.path = path
+        self.kind = kind
+        self.month = month
+        # month -> temporary path
+        self.tmp_paths = {}
+        # lines before the cut that belong in path
+        self.kept = []
+        self.inode = None
+        self.cut = None
+
+    def _tmp_path(self, month):
+        return self.segments.directory / "{}-{}.raw.gz.tmp".format(self.kind, month)
+
+    def prepare(self):
+        """
+        returns True if there is anything to move
+        """
+        try:
+            f = self.path.open('rb')
+        except FileNotFoundError:
+            return False
+        with f:
+            # the first dated line tells if there is anything to do
+            for bytes_line in f:
+                if month_regexp.match(bytes_line):
+                    break
+            else:
+                return False
+            if bytes_line[:7].decode() >= self.month:
+                return False
+            self.inode = os.fstat(f.fileno()).st_ino
+            seek_timestamp(f, self.month + "-01")
+            self.cut = f.tell()
+            f.seek(0)
+            self.segments.directory.mkdir(exist_ok=True)
+            outputs = {}
+            # comment lines go with the dated lines around them
+            current, pending = None, []
+            offset = 0
+            try:
+                for bytes_line in f:
+                    if offset >= self.cut:
+                        break
+                    offset += len(bytes_line)
+                    if month_regexp.match(bytes_line):
+                        current = bytes_line[:7].decode()
+                    elif current is None:
+                        pending.append(bytes_line)
+                        continue
+                    # a line that is out of order stays where it is
+                    if current >= self.month:
+                        self.kept.append(bytes_line)
+                        continue
+                    if current not in outputs:
+                        tmp_path = self._tmp_path(current)
+                        self.tmp_paths[current] = tmp_path
+                        outputs[current] = gzip.open(str(tmp_path), 'wb')
+                    output = outputs[current]
+                    for pending_line in pending:
+                        output.write(pending_line)
+                    pending = []
+                    output.write(bytes_line)
+            finally:
+                for output in outputs.values():
+                    output.close()
+            self.kept = pending + self.kept
+        return bool(self.tmp_paths)
+
+    def install(self):
+        """
+        returns True if path was rewritten
+        """
+        try:
+            with self.path.open('rb') as f:
+                # path has been replaced in the meanwhile
+                if os.fstat(f.fileno()).st_ino != self.inode:
+                    self.discard()
+                    return False
+                tmp_path = self.path.with_name(self.path.name + ".tmp")
+                with tmp_path.open('wb') as output:
+                    for bytes_line in self.kept:
+                        output.write(bytes_line)
+                    f.seek(self.cut)
+                    while True:
+                        chunk = f.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        output.write(chunk)
+            for month, segment_tmp_path in sorted(self.tmp_paths.items()):
+                segment_path = self.segments.path(self.kind, month)
+                if segment_path.exists():
+                    # late lines for a closed month; a gzip file
+                    # can be made of several members
+                    with segment_path.open('ab') as output:
+                        output.write(segment_tmp_path.read_bytes())
+                    segment_tmp_path.unlink()
+                else:
+                    segment_tmp_path.rename(segment_path)
+            tmp_path.rename(self.path)
+            return True
+        finally:
+            # leftovers, if anything went wrong
+            self.discard()
+
+    def discard(self):
+        for tmp_path in self.tmp_paths.values():
+            if tmp_path.exists():
+                tmp_path.unlink()
+        self.tmp_paths = {}
+
+
+class Segments:
+    """
+    the closed segments for one course
+    """
+    def __init__(self, course_dir):
+        self.directory = course_dir / "segments"
+
+    def path(self, kind, month):
+        return self.directory / "{}-{}.raw.gz".format(kind, month)
+
+    def _segments(self, kind):
+        # month names sort chronologically
+        return sorted((Segment(path) for path in
+                       self.directory.glob("{}-*.raw.gz".format(kind))),
+                      key=lambda segment: segment.month)
+
+    def events(self, since_month=None, until_month=None):
+        """
+        the events segments, in chronological order,
+        optionally restricted to months in [since_month, until_month]
+        """
+        return [segment for segment in self._segments('events')
+                if (since_month is None or segment.month >= since_month)
+                and (until_month is None or segment.month <= until_month)]
+
+    def counts(self, since_month=None, until_month=None):
+        return [segment for segment in self._segments('counts')
+                if (since_month is None or segment.month >= since_month)
+                and (until_month is None or segment.month <= until_month)]
+
+    def split(self, path, kind, month):
+        return Split(self, path, kind, month)
@@ -0,0 +1,165 @@
+"""
+precomputed stats products
+
+at the end of each cycle, nbh-monitor computes the products that
+the stats page needs, and stores them in raw/<course>/ as e.g.
+    snapshot-all_metrics-<key>.json
+    snapshot-all_metrics-<key>.json.gz
+where key identifies the query string that the snapshot answers
+
+the views serve these files as long as they are recent enough,
+unless the request has fresh=1
+
+the products that depend on events.raw all come out of a single
+all_metrics computation; and when neither events.raw nor the staff
+have changed since the previous cycle - as recorded in
+snapshots.signature - these snapshots are only marked as fresh,
+and all_metrics just gets its monitor counts updated
+"""
+
+import os
+import gzip
+import json
+import time
+import hashlib
+from urllib.parse import parse_qsl, urlencode
+
+from nbhosting.stats.stats import Stats
+from nbhosting.stats.heatmap import reencode
+from nbhosting.stats.products import (
+    computer, json_chunks, heatmap_options, window_options, counts_options)
+from nbhosting.main.settings import logger
+
+# the query string used by the stats page
+page_query = "heatmap=sparse&max_points=2000"
+
+# what gets precomputed: product, query string
+snapshot_requests = [
+    ('daily_metrics', ''),
+    ('monitor_counts', ''),
+    ('material_usage', ''),
+    ('all_metrics', page_query),
+]
+# the ones that depend on events.raw
+events_products = ('daily_metrics', 'material_usage', 'all_metrics')
+
+
+def query_key(query_string):
+    """
+    a short name for a query string, where the order
+    of parameters does not matter, and fresh is ignored
+    """
+    params = sorted((name, value) for name, value in parse_qsl(query_string)
+                    if name != 'fresh')
+    return hashlib.sha1(urlencode(params).encode()).hexdigest()[:12]
+
+
+class Snapshots:
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def path(self, product, query_string):
+        return self.stats.course_dir / "snapshot-{}-{}.json".format(
+            product, query_key(query_string))
+
+    @staticmethod
+    def gzip_path(path):
+        return path.with_name(path.name + ".gz")
+
+    def signature_path(self):
+        return self.stats.course_dir / "snapshots.signature"
+
+    def write(self, product, query_string, result=None):
+        """
+        compute product - unless result is provided - and store it,
+        both plain and gzipped; files are written aside and then renamed
+        """
+        if result is None:
+            result = computer(product, dict(parse_qsl(query_string)))(self.stats)
+        path = self.path(product, query_string)
+        gzip_path = self.gzip_path(path)
+        suffix = ".{}".format(os.getpid())
+        tmp_path = path.with_name(path.name + suffix)
+        tmp_gzip_path = gzip_path.with_name(gzip_path.name + suffix)
+        try:
+            with tmp_path.open('wb') as plain, \
+                 gzip.open(str(tmp_gzip_path), 'wb', compresslevel=6) as zipped:
+                for chunk in json_chunks(result):
+                    plain.write(chunk)
+                    zipped.write(chunk)
+            # the plain file is the one that the views look for
+            tmp_gzip_path.rename(gzip_path)
+            tmp_path.rename(path)
+        finally:
+            for leftover in tmp_path, tmp_gzip_path:
+                if leftover.exists():
+                    leftover.unlink()
+
+    def write_events_products(self):
+        """
+        the snapshots in events_products, from a single all_metrics
+        computation - or none at all if events.raw has not changed
+        """
+        params = dict(parse_qsl(page_query))
+        counts = counts_options(params)
+        signature = self.stats.signature('material_usage')
+        paths = [self.path(product, query_string)
+                 for product, query_string in snapshot_requests
+                 if product in events_products]
+        try:
+            unchanged = self.signature_path().read_text() == signature \
+                        and all(path.exists() for path in paths)
+        except FileNotFoundError:
+            unchanged = False
+        if unchanged:
+            for path in paths:
+                os.utime(str(path))
+                os.utime(str(self.gzip_path(path)))
+            path = self.path('all_metrics', page_query)
+            with path.open() as feed:
+                result = json.load(feed)
+            result['monitor_counts'] = self.stats.monitor_counts(**counts)
+            self.write('all_metrics', page_query, result)
+            return
+        # the heatmap gets encoded twice, so it cannot be a generator
+        options = heatmap_options(params)
+        options['lazy'] = False
+        result = self.stats.all_metrics(counts_options=counts,
+                                        **window_options(params), **options)
+        self.write('all_metrics', page_query, result)
+        self.write('daily_metrics', '', result['daily_metrics'])
+        material_usage = dict(result['material_usage'])
+        material_usage['heatmap'] = reencode(material_usage['heatmap'], 'dense')
+        self.write('material_usage', '', material_usage)
+        self.signature_path().write_text(signature)
+
+    def find(self, product, query_string, max_age):
+        """
+        the path of the snapshot that answers that request,
+        or None if there is none that is at most max_age seconds old
+        """
+        path = self.path(product, query_string)
+        try:
+            if time.time() - path.stat().st_mtime <= max_age:
+                return path
+        except FileNotFoundError:
+            pass
+        return None
+
+
+def write_snapshots(course):
+    """
+    compute and store all snapshots for that course
+    """
+    snapshots = Snapshots(Stats(course))
+    try:
+        snapshots.write('monitor_counts', '')
+    except Exception as e:
+        logger.exception("Cannot write monitor_counts snapshot for {}"
+                         .format(course))
+    try:
+        snapshots.write_events_products()
+    except Exception as e:
+        logger.exception("Cannot write {} snapshots for {}"
+                         .format(", ".join(events_products), course))
@@ -1,11 +1,26 @@
+import os
 from pathlib import Path
 import time
+import pickle
 import re
 import itertools
+import functools
 from datetime import timedelta
 from collections import OrderedDict, defaultdict
 
-from nbhosting.stats.timebuckets import TimeBuckets
+from nbhosting.stats.timebuckets import AnimatedCounts
+from nbhosting.stats.columnar import columnar_events, epoch_from_timestamp
+from nbhosting.stats.columnar import non_open_actions
+from nbhosting.stats.rollups import CountsRollups, seek_timestamp
+from nbhosting.stats.rollups import resolutions as rollup_resolutions
+from nbhosting.stats.dayindex import day_index
+from nbhosting.stats.studentindex import student_index
+from nbhosting.stats.segments import Segments
+from nbhosting.stats import vectorized
+from nbhosting.stats import parallel
+from nbhosting.stats import collector
+from nbhosting.stats.heatmap import heatmap
+from nbhosting.stats.bitmaps import NameIds, Bitmap
 from nbhosting.courses.models import CourseDir
 from nbhosting.main.settings import sitesettings, logger
 
@@ -20,6 +35,14 @@ time_format = "%Y-%m-%dT%H:%M:%S"
 edx_hash_regexp = re.compile(r"[0-9a-f]{32}")
 
 
+def keep_student(staff, student):
+    """
+    tells if a student is to be considered
+    i.e. not in staff and looking like an edx hash
+    """
+    return student not in staff and bool(edx_hash_regexp.match(student))
+
+
 # an iterable has no builtin len method
 def iter_len(iterable):
     count = 0
@@ -34,28 +57,33 @@ class DailyFigures:
     to the previous day
     in order to avoid useless expensive set copies, when moving to the next day, 
     caller must call the wrap() method that does accounting
+
+    students and notebooks are dense ids, as allocated in DailyMetrics,
+    and sets of them are bitmaps
     """
     def __init__(self, previous=None):
-        self.students = set()
-        self.notebooks = set()
+        self.students = Bitmap()
+        self.notebooks = Bitmap()
         if previous is None:
-            self.cumul_students = set()
-            self.cumul_notebooks = set()
+            self.cumul_students = Bitmap()
+            self.cumul_notebooks = Bitmap()
         else:
             self.cumul_students = previous.cumul_students
             self.cumul_notebooks = previous.cumul_notebooks
-        self._nb_total_students = len(self.cumul_students)
-        self._nb_total_notebooks = len(self.cumul_notebooks)
+        self._nb_total_students = self.cumul_students.count()
+        self._nb_total_notebooks = self.cumul_notebooks.count()
 
 
     def add_student(self, student):
-        if student not in self.students and student not in self.cumul_students:
-            self._nb_total_students += 1
-        self.students.add(student)
+        if student not in self.students:
+            if student not in self.cumul_students:
+                self._nb_total_students += 1
+            self.students.add(student)
     def add_notebook(self, notebook):
-        if notebook not in self.notebooks and notebook not in self.cumul_notebooks:
-            self._nb_total_notebooks += 1
-        self.notebooks.add(notebook)
+        if notebook not in self.notebooks:
+            if notebook not in self.cumul_notebooks:
+                self._nb_total_notebooks += 1
+            self.notebooks.add(notebook)
 
 
     # we call these zillions of times, can't afford to
@@ -69,12 +97,15 @@ class DailyFigures:
 
 
     def wrap(self):
-        self.nb_unique_students = len(self.students)
-        self.nb_unique_notebooks = len(self.notebooks)
-        self.nb_new_students = len(self.students - self.cumul_students)
-        self.nb_new_notebooks = len(self.notebooks - self.cumul_notebooks)
+        self.nb_unique_students = self.students.count()
+        self.nb_unique_notebooks = self.notebooks.count()
+        self.nb_new_students = self.students.count_new(self.cumul_students)
+        self.nb_new_notebooks = self.notebooks.count_new(self.cumul_notebooks)
         self.cumul_students.update(self.students)
         self.cumul_notebooks.update(self.notebooks)
+        # most likely we're done with that day
+        self.students.pack()
+        self.notebooks.pack()
 
 
 class TotalsAccumulator:
@@ -130,32 +161,454 @@ class TotalsAccumulator:
         self._insert(self.last_t, self.last_s, self.last_n)
         
 
+class DailyMetrics:
+    """
+    the state of the daily_metrics computation
+
+    events are fed with add_event() in the order of the events file;
+    this object is what gets checkpointed, so result() must be called
+    only once, as it alters the state
+    """
+    def __init__(self):
+        # a dictionary day -> figures
+        self.figures_by_day = OrderedDict()
+        self.current_figures = DailyFigures()
+        # the events dimension
+        self.accumulator = TotalsAccumulator()
+        # the ids used in figures
+        self.students = NameIds()
+        self.notebooks = NameIds()
+
+    def add_event(self, timestamp, student, notebook):
+        day = timestamp.split('T')[0] + ' 23:59:59'
+        if day in self.figures_by_day:
+            self.current_figures = self.figures_by_day[day]
+        else:
+            self.current_figures.wrap()
+            previous_figures = self.current_figures
+            self.current_figures = DailyFigures(previous_figures)
+            self.figures_by_day[day] = self.current_figures
+        self.current_figures.add_notebook(self.notebooks.id(notebook))
+        self.current_figures.add_student(self.students.id(student))
+        self.accumulator.insert(
+            timestamp,
+            self.current_figures.nb_total_students(),
+            self.current_figures.nb_total_notebooks())
+
+    @staticmethod
+    def from_partials(partials):
+        """
+        merge the results of a parallel scan - see nbhosting.stats.parallel -
+        into the state that add_event() would have reached
+
+        this is only possible if each day shows up in a single run of
+        events, which is the case unless the clock went backwards;
+        returns None otherwise
+        """
+        # the days in order, with their sets of students and notebooks
+        runs = []
+        first_students, first_notebooks = {}, {}
+        last_timestamp = None
+        base = 0
+        for partial in partials:
+            if not partial.in_order:
+                return None
+            for day, (students, notebooks) in partial.days.items():
+                if runs and runs[-1][0] == day:
+                    runs[-1][1].update(students)
+                    runs[-1][2].update(notebooks)
+                elif any(run[0] == day for run in runs):
+                    return None
+                else:
+                    runs.append((day, students, notebooks))
+            for firsts, partial_firsts in ((first_students, partial.first_students),
+                                           (first_notebooks, partial.first_notebooks)):
+                for key, (index, timestamp) in partial_firsts.items():
+                    if key not in firsts:
+                        firsts[key] = (base + index, timestamp)
+            if partial.nb_events:
+                last_timestamp = partial.last_timestamp
+            base += partial.nb_events
+
+        metrics = DailyMetrics()
+        # allocate ids in order of appearance, like add_event()
+        for names, firsts in ((metrics.students, first_students),
+                              (metrics.notebooks, first_notebooks)):
+            for name in sorted(firsts, key=firsts.get):
+                names.id(name)
+        for day, students, notebooks in runs:
+            metrics.current_figures.wrap()
+            figures = DailyFigures(metrics.current_figures)
+            figures.students = Bitmap.from_ids(
+                metrics.students.id(student) for student in students)
+            figures.notebooks = Bitmap.from_ids(
+                metrics.notebooks.id(notebook) for notebook in notebooks)
+            figures._nb_total_students += \
+                figures.students.count_new(figures.cumul_students)
+            figures._nb_total_notebooks += \
+                figures.notebooks.count_new(figures.cumul_notebooks)
+            metrics.figures_by_day[day] = figures
+            metrics.current_figures = figures
+        # totals only change on the first occurrence
+        # of a student or of a notebook
+        # index -> [timestamp, new students, new notebooks]
+        changes = {}
+        for firsts, column in ((first_students, 1), (first_notebooks, 2)):
+            for index, timestamp in firsts.values():
+                changes.setdefault(index, [timestamp, 0, 0])[column] += 1
+        nb_students, nb_notebooks = 0, 0
+        for index in sorted(changes):
+            timestamp, new_students, new_notebooks = changes[index]
+            nb_students += new_students
+            nb_notebooks += new_notebooks
+            metrics.accumulator.insert(timestamp, nb_students, nb_notebooks)
+        if last_timestamp is not None:
+            metrics.accumulator.insert(last_timestamp, nb_students, nb_notebooks)
+        return metrics
+
+    def result(self):
+        self.current_figures.wrap()
+        self.accumulator.wrap()
+        daily_timestamps = []
+        unique_students = []
+        unique_notebooks = []
+        new_students = []
+        new_notebooks = []
+
+        for timestamp, figures in self.figures_by_day.items():
+            daily_timestamps.append(timestamp)
+            unique_students.append(figures.nb_unique_students)
+            unique_notebooks.append(figures.nb_unique_notebooks)
+            new_students.append(figures.nb_new_students)
+            new_notebooks.append(figures.nb_new_notebooks)
+
+        accumulator = self.accumulator
+        return { 'daily' : { 'timestamps' : daily_timestamps,
+                             'unique_students' : unique_students,
+                             'unique_notebooks' : unique_notebooks,
+                             'new_students' : new_students,
+                             'new_notebooks' : new_notebooks},
+                 'events' : { 'timestamps' : accumulator.timestamps,
+                              'total_students' : accumulator.students,
+                              'total_notebooks' : accumulator.notebooks}}
+
+
+class MaterialUsage:
+    """
+    the state of the material_usage computation with the python engine
+
+    events are fed with add_event() in the order of the events file;
+    students and notebooks are mapped on dense ids, and the set
+    of students who have opened a given notebook is a bitmap
+    """
+    def __init__(self, grain):
+        self.students = NameIds()
+        self.notebooks = NameIds()
+        # notebook id -> bitmap of student ids
+        self.bitmap_by_notebook = []
+        # notebook id -> number of students, i.e. the bitmap size
+        self.nbstudents_by_notebook = []
+        # student id -> number of notebooks
+        self.nbnotebooks_by_student = []
+        # the number of students per notebook over time
+        self.animated = AnimatedCounts(grain=grain, time_format=time_format)
+        # a dict hashed on a tuple (notebook id, student id) -> number of visits
+        self.raw_counts = defaultdict(int)
+        # notebook ids sorted on their names, reset when a notebook shows up
+        self._sorted_notebooks = None
+
+    def _notebook_id(self, notebook):
+        id = self.notebooks.id(notebook)
+        if id == len(self.bitmap_by_notebook):
+            self.bitmap_by_notebook.append(Bitmap())
+            self.nbstudents_by_notebook.append(0)
+            self._sorted_notebooks = None
+        return id
+
+    def _student_id(self, student):
+        id = self.students.id(student)
+        if id == len(self.nbnotebooks_by_student):
+            self.nbnotebooks_by_student.append(0)
+        return id
+
+    def _add_pair(self, notebook_id, student_id):
+        """
+        returns True if that student had not opened that notebook yet
+        """
+        bitmap = self.bitmap_by_notebook[notebook_id]
+        if student_id in bitmap:
+            return False
+        bitmap.add(student_id)
+        self.nbstudents_by_notebook[notebook_id] += 1
+        self.nbnotebooks_by_student[student_id] += 1
+        return True
+
+    def sorted_notebooks(self):
+        if self._sorted_notebooks is None:
+            names = self.notebooks.names
+            self._sorted_notebooks = sorted(range(len(names)), key=names.__getitem__)
+        return self._sorted_notebooks
+
+    def nbstudents_per_notebook(self):
+        """
+        a sorted list of tuples (notebook, nb_students)
+        """
+        names = self.notebooks.names
+        return [ (names[id], self.nbstudents_by_notebook[id])
+                 for id in self.sorted_notebooks() ]
+
+    def add_event(self, timestamp, student, notebook):
+        # animated data must be taken care of before anything else
+        self.animated.advance(epoch_from_timestamp(timestamp))
+        notebook_id = self._notebook_id(notebook)
+        student_id = self._student_id(student)
+        if self._add_pair(notebook_id, student_id):
+            self.animated.increment(notebook_id)
+        self.raw_counts[notebook_id, student_id] += 1
+
+    @staticmethod
+    def from_partials(partials, grain):
+        """
+        merge the results of a parallel scan - see nbhosting.stats.parallel -
+        into the state that add_event() would have reached
+        """
+        material = MaterialUsage(grain)
+        # (notebook, student) -> number of visits
+        counts = defaultdict(int)
+        # (notebook, student) -> index of first event
+        first_pairs = {}
+        # (index, epoch) of the events where the time bucket changes
+        changes = []
+        last_quotient = None
+        base = 0
+        for partial in partials:
+            for pair, count in partial.counts.items():
+                counts[pair] += count
+            for pair, index in partial.first_pairs.items():
+                if pair not in first_pairs:
+                    first_pairs[pair] = base + index
+            for index, epoch, quotient in partial.changes:
+                # the first event in a range is not necessarily a change
+                if index == 0 and quotient == last_quotient:
+                    continue
+                changes.append((base + index, epoch))
+            if partial.nb_events:
+                last_quotient = partial.last_quotient
+            base += partial.nb_events
+        # allocate ids in order of appearance, like add_event()
+        by_first = sorted(first_pairs.items(), key=lambda item: item[1])
+        for (notebook, student), _ in by_first:
+            notebook_id = material._notebook_id(notebook)
+            student_id = material._student_id(student)
+            material._add_pair(notebook_id, student_id)
+            material.raw_counts[notebook_id, student_id] = counts[notebook, student]
+        # replay the time bucket changes, with the number of students
+        # per notebook as it was right before each change
+        animated = material.animated
+        position = 0
+        for index, epoch in changes + [(base, None)]:
+            while position < len(by_first) and by_first[position][1] < index:
+                (notebook, _), _ = by_first[position]
+                animated.increment(material.notebooks.id(notebook))
+                position += 1
+            if epoch is not None:
+                animated.advance(epoch)
+        return material
+
+    def result(self, **heatmap_options):
+        """
+        heatmap_options are passed to nbhosting.stats.heatmap.heatmap
+        """
+        raw_counts = self.raw_counts
+        nbstudents_per_notebook = self.nbstudents_per_notebook()
+
+        nbstudents_per_notebook_animated = self.animated.encode(self.notebooks.names)
+
+        # counting in the other direction is surprisingly tedious
+        nbstudents_per_nbnotebooks = [
+            (number, iter_len(v))
+            for (number, v) in itertools.groupby(sorted(self.nbnotebooks_by_student))
+        ]
+        # the heatmap
+        sorted_notebooks = self.sorted_notebooks()
+        heatmap_notebooks = [self.notebooks.names[id] for id in sorted_notebooks]
+        student_names = self.students.names
+        sorted_students = sorted(range(len(student_names)),
+                                 key=student_names.__getitem__)
+        heatmap_students = [student_names[id] for id in sorted_students]
+        column_of_notebook = { id: column
+                               for column, id in enumerate(sorted_notebooks) }
+        # a first attempt at showing the number of times a given notebook was open
+        # by a given student resulted in poor outcome
+        # problem being mostly with colorscale, we'd need to have '0' stick out
+        # as transparent or something, but OTOH sending None instead or 0 
+        # sort students on total number of opened notebooks
+        totals = [0] * len(student_names)
+        cells_by_student = [[] for _ in student_names]
+        for (notebook_id, student_id), count in raw_counts.items():
+            totals[student_id] += count
+            cells_by_student[student_id].append(
+                (column_of_notebook[notebook_id], count))
+        lines = (
+            sorted(cells_by_student[id])
+            for id in sorted(sorted_students, key=totals.__getitem__)
+        )
+
+        zmax = max(raw_counts.values(), default=None)
+        zmin = min(raw_counts.values(), default=None)
+
+        return {
+            'nbnotebooks' : len(self.notebooks),
+            'nbstudents' : len(self.students),
+            'nbstudents_per_notebook' : nbstudents_per_notebook,
+            'nbstudents_per_notebook_animated' : nbstudents_per_notebook_animated,
+            'nbstudents_per_nbnotebooks' : nbstudents_per_nbnotebooks,
+            'heatmap' : heatmap(heatmap_notebooks, heatmap_students, lines,
+                                zmin, zmax, **heatmap_options),
+        }
+
+
+# the course directories known to exist in this process
+_created_dirs = set()
+
+
 class Stats:
 
 
     def __init__(self, course):
         self.course = course
         self.course_dir = nbhroot / "raw" / self.course
-        self.course_dir.mkdir(parents=True, exist_ok=True)
+        # a Stats object gets created on each notebook open
+        if self.course_dir not in _created_dirs:
+            self.course_dir.mkdir(parents=True, exist_ok=True)
+            _created_dirs.add(self.course_dir)
 
     ####################
     def notebook_events_path(self):
         return self.course_dir / "events.raw"
     def monitor_counts_path(self):
         return self.course_dir / "counts.raw"
+    def container_usage_path(self):
+        return self.course_dir / "usage.raw"
     
+    def columnar_events(self):
+        return columnar_events(self.course_dir)
+    def events_index(self):
+        return day_index(self.notebook_events_path(),
+                         self.course_dir / "events.days")
+    def student_index(self):
+        return student_index(self.notebook_events_path(), self.course_dir)
+    def segments(self):
+        return Segments(self.course_dir)
+    def staff_path(self):
+        # same as in CourseDir, without probing all the course settings
+        return nbhroot / "courses" / self.course / ".staff"
+
+    # the files that each product depends upon
+    def _sources(self, product):
+        events = [self.notebook_events_path(), self.staff_path()]
+        counts = [self.monitor_counts_path()]
+        return {
+            'daily_metrics' : events,
+            'monitor_counts' : counts,
+            'material_usage' : events,
+            'all_metrics' : events + counts,
+        }[product]
+
+    def signature(self, product):
+        """
+        a string that changes whenever the result of
+        the method named <product> may change;
+        it is made of (inode, size, mtime) for all the files it depends upon
+        """
+        parts = [self.course, product]
+        for path in self._sources(product):
+            try:
+                stat = path.stat()
+                parts.append("{}-{}-{}".format(
+                    stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                parts.append("none")
+        return " ".join(parts)
+
     ####################
     def _write_events_line(self, student, notebook, action, port):
-        timestamp = time.strftime(time_format, time.gmtime())
+        now = time.time()
+        # when the collector is running, it does the actual writing
+        # in batches; otherwise, or if it cannot keep up, write right away
+        if collector.send_event(self.course, int(now), student, notebook, action, port):
+            return
+        self.write_events([(int(now), student, notebook, action, port)])
+
+    def write_events(self, events, fsync=False):
+        """
+        append events - an iterable of tuples
+        (epoch, student, notebook, action, port) - to events.raw,
+        with a single write(); the columnar store and the indexes
+        get updated accordingly
+
+        fsync can be set to flush the events to disk before returning
+        """
         path = self.notebook_events_path()
         course = self.course
-        try:
-            with path.open("a") as f:
-                f.write("{timestamp} {course} {student} {notebook} {action} {port}\n".
+        store = self.columnar_events()
+        index = self.events_index()
+        students = self.student_index()
+        # hold the lock so that events.raw, the columnar store
+        # and the indexes remain in sync
+        with store.locked():
+            # a course with no event yet can start with all formats;
+            # otherwise the columnar store needs to be created
+            # with the converter in nbhosting.stats.columnar
+            # and the indexes get rebuilt on the first query that needs them
+            offset = path.stat().st_size if path.exists() else 0
+            first_event = not offset
+            # (timestamp, offset, epoch, student, notebook, action) for each line
+            lines, records = [], []
+            for epoch, student, notebook, action, port in events:
+                timestamp = time.strftime(time_format, time.gmtime(epoch))
+                line = ("{timestamp} {course} {student} {notebook} {action} {port}\n".
                         format(timestamp=timestamp, course=course, student=student,
-                               notebook=notebook, action=action, port=port))
-        except Exception as e:
-            logger.exception("Cannot store stats line into {}".format(path))
+                               notebook=notebook, action=action, port=port)).encode()
+                lines.append(line)
+                records.append((timestamp, offset, epoch, student, notebook, action))
+                offset += len(line)
+            if not lines:
+                return
+            try:
+                with path.open("ab") as f:
+                    f.write(b"".join(lines))
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+            except Exception as e:
+                logger.exception("Cannot store stats line into {}".format(path))
+                return
+            try:
+                if first_event or index.exists():
+                    for timestamp, offset, *_ in records:
+                        index.record(timestamp[:10], offset)
+            except Exception as e:
+                logger.exception("Cannot update day index in {}"
+                                 .format(self.course_dir))
+            try:
+                if first_event and not students.exists():
+                    students.create()
+                if students.exists():
+                    for _, offset, _, student, *_ in records:
+                        students.record(student, offset)
+            except Exception as e:
+                logger.exception("Cannot update student index in {}"
+                                 .format(self.course_dir))
+            try:
+                if first_event and not store.exists():
+                    store.create()
+                if store.exists():
+                    store.extend([(int(epoch), student, notebook, action)
+                                  for _, _, epoch, student, notebook, action in records])
+            except Exception as e:
+                logger.exception("Cannot store event into columnar store in {}"
+                                 .format(self.course_dir))
 
     def record_open_notebook(self, student, notebook, action, port):
         """
@@ -172,6 +625,55 @@ class Stats:
         """
         return self._write_events_line(student, '-', 'killing', '-')
 
+    def record_pause_jupyter(self, student):
+        """
+        add one line in the stats file for that course, when monitor
+        pauses an idle container; same format as for killing
+        """
+        return self._write_events_line(student, '-', 'pausing', '-')
+
+    ####################
+    # monitor leaves a marker for each container that it pauses, so that
+    # edxfront can tell that a container needs resuming without asking dockerd
+    def paused_marker_path(self, student):
+        return self.course_dir / "paused" / student
+
+    def is_marked_paused(self, student):
+        return self.paused_marker_path(student).exists()
+
+    def mark_paused(self, student, paused=True):
+        path = self.paused_marker_path(student)
+        try:
+            if paused:
+                path.parent.mkdir(exist_ok=True)
+                path.touch()
+            else:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.exception("Cannot update paused marker {}".format(path))
+
+    def clear_paused_markers(self, keep=()):
+        """
+        remove the markers, except for the students in keep
+        """
+        directory = self.paused_marker_path('-').parent
+        for path in directory.glob("*"):
+            if path.name in keep:
+                continue
+            try:
+                path.unlink()
+            except Exception as e:
+                logger.exception("Cannot remove paused marker {}".format(path))
+
+    def record_cull_kernel(self, student, notebook, port):
+        """
+        add one line in the stats file for that course, when monitor
+        shuts down an idle kernel; notebook is '-' if not known
+        """
+        return self._write_events_line(student, notebook, 'culling', port)
+
     ####################
     # every cycle the monitor writes a counts line
     # with a predefined set of integer counts
@@ -186,6 +688,16 @@ class Stats:
         'docker_ds_percent', 'docker_ds_free',
         'nbhosting_ds_percent', 'nbhosting_ds_free',
         'system_ds_percent', 'system_ds_free',
+        # kernels shut down by monitor since the previous line
+        'culled_kernel',
+        'paused_container',
+        # from the cgroups of the course containers, see cgroups.py
+        # total memory in MiB, total cpu in % of one core,
+        # and memory in MiB of the biggest container
+        'container_memory', 'container_cpu', 'max_container_memory',
+        # containers killed under memory pressure since the previous line,
+        # and memory available on the host in MiB, see pressure.py
+        'evicted_container', 'available_memory',
     ]
     
     def record_monitor_known_counts_line(self):
@@ -197,8 +709,13 @@ class Stats:
         except Exception as e:
             logger.exception("Cannot store headers line into {}".format(path))
         
-    def record_monitor_counts(self, *args):
-        timestamp = time.strftime(time_format, time.gmtime())
+    def record_monitor_counts(self, *args, period=None):
+        """
+        period is the monitor period in seconds, it is used
+        to select the right rollup when reading counts
+        """
+        now = int(time.time())
+        timestamp = time.strftime(time_format, time.gmtime(now))
         path = self.monitor_counts_path()
         if len(args) > len(self.known_counts):
             logger.error("two many arguments to counts line - dropped {} from {}"
@@ -208,9 +725,351 @@ class Stats:
                 f.write("{} {}\n".format(timestamp, " ".join(str(arg) for arg in args)))
         except Exception as e:
             logger.exception("Cannot store counts line into {}".format(path))
-        
+        try:
+            rollups = self.counts_rollups()
+            if rollups.exists():
+                values = list(args[:len(self.known_counts)])
+                values += [None] * (len(self.known_counts) - len(values))
+                rollups.add(now, values, period)
+            else:
+                # first time ever, this will take the line above into account
+                self.rebuild_counts_rollups(period)
+        except Exception as e:
+            logger.exception("Cannot update counts rollups in {}".format(self.course_dir))
+
+    def record_container_usage(self, usages):
+        """
+        add one line per container in usage.raw, for the top consumers
+        of that course; usages is a list of tuples
+        (student, memory in MiB, cpu in % of one core)
+        """
+        timestamp = time.strftime(time_format, time.gmtime())
+        path = self.container_usage_path()
+        try:
+            with path.open('a') as f:
+                f.write("".join("{} {} {} {}\n".format(timestamp, student, memory, cpu)
+                                for student, memory, cpu in usages))
+        except Exception as e:
+            logger.exception("Cannot store usage lines into {}".format(path))
+
+    def counts_rollups(self):
+        return CountsRollups(self.course_dir, self.known_counts)
+
+    def rebuild_counts_rollups(self, period=None):
+        """
+        recompute the hourly and daily rollups from counts.raw
+        """
+        self.counts_rollups().rebuild(
+            ((epoch_from_timestamp(timestamp), values)
+             for timestamp, values in self._iter_monitor_counts()),
+            period)
+
     ####################
-    def daily_metrics(self):
+    def seal_segments(self, month=None):
+        """
+        move the lines older than month - like '2018-02', default is the
+        current month - from events.raw, counts.raw and usage.raw into
+        closed segments, and seal the summaries of the events segments;
+        see segments.py
+
+        this is meant to be called by nbh-monitor, that is
+        the only one to write into counts.raw and usage.raw
+        """
+        if month is None:
+            month = time.strftime("%Y-%m", time.gmtime())
+        segments = self.segments()
+        for path, kind in ((self.monitor_counts_path(), 'counts'),
+                           (self.container_usage_path(), 'usage')):
+            split = segments.split(path, kind, month)
+            if split.prepare():
+                split.install()
+        split = segments.split(self.notebook_events_path(), 'events', month)
+        if split.prepare():
+            with self.columnar_events().locked():
+                # the columnar store spans all segments, but the indexes
+                # hold offsets in events.raw
+                if split.install():
+                    for index in self.events_index(), self.student_index():
+                        if index.exists():
+                            index.rebuild()
+        # rather than on the next query
+        self._sealed_summaries(CourseDir(self.course).staff)
+
+    ####################
+    # the daily metrics are computed incrementally; the state of the
+    # computation is saved in this file, together with the offset in
+    # events.raw that it accounts for
+    daily_checkpoint_version = 4
+    # how many bytes at the beginning of events.raw are remembered
+    # so as to detect a file that was rotated or truncated and then grew again
+    daily_checkpoint_head = 256
+
+    def daily_checkpoint_path(self):
+        return self.course_dir / "daily_metrics.ckpt"
+
+    def _events_head(self, events_path, size):
+        with events_path.open('rb') as f:
+            return f.read(min(size, self.daily_checkpoint_head))
+
+    def _load_daily_checkpoint(self, events_path, staff):
+        """
+        returns the state as saved by _store_daily_checkpoint,
+        or None if there is no checkpoint or if it can't be trusted
+        """
+        checkpoint_path = self.daily_checkpoint_path()
+        if not checkpoint_path.exists():
+            return None
+        try:
+            with checkpoint_path.open('rb') as f:
+                state = pickle.load(f)
+            stat = events_path.stat()
+            if state['version'] != self.daily_checkpoint_version:
+                reason = "version has changed"
+            elif state['inode'] != stat.st_ino:
+                reason = "events file was rotated"
+            elif state['offset'] > stat.st_size:
+                reason = "events file was truncated"
+            elif state['head'] != self._events_head(events_path, len(state['head'])):
+                reason = "events file was rewritten"
+            elif set(state['staff']) != set(staff):
+                reason = "staff has changed"
+            else:
+                return state
+            logger.info("{}: discarding checkpoint - {}"
+                        .format(checkpoint_path, reason))
+        except Exception as e:
+            logger.exception("{}: discarding unreadable checkpoint"
+                             .format(checkpoint_path))
+        return None
+
+    def _store_daily_checkpoint(self, state):
+        """
+        write in a temporary file and then rename, so that concurrent
+        readers always find a consistent checkpoint
+        """
+        checkpoint_path = self.daily_checkpoint_path()
+        tmp_path = checkpoint_path.with_name(
+            "{}.{}".format(checkpoint_path.name, os.getpid()))
+        try:
+            with tmp_path.open('wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_path.rename(checkpoint_path)
+        except Exception as e:
+            logger.exception("Cannot store checkpoint into {}"
+                             .format(checkpoint_path))
+
+    def _new_daily_state(self, staff):
+        return {
+            'version' : self.daily_checkpoint_version,
+            'staff' : list(staff),
+            'offset' : 0,
+            'lineno' : 0,
+            # whether the closed segments are accounted for
+            'segments' : False,
+            'metrics' : DailyMetrics(),
+        }
+
+    def _keep_student_function(self, staff):
+        """
+        returns a function that tells if a student is to be considered
+        i.e. not in staff and looking like an edx hash
+        the function can be pickled, so it can be used in a parallel scan
+        """
+        return functools.partial(keep_student, frozenset(staff))
+
+    def _parallel_workers(self, workers=None):
+        """
+        the number of processes to use for scanning events.raw from scratch
+
+        if workers is not specified, sitesettings.stats_parallel_workers
+        is used, but only for an events file larger than
+        sitesettings.stats_parallel_megabytes
+        """
+        if workers is not None:
+            return workers
+        workers = getattr(sitesettings, 'stats_parallel_workers', 1)
+        megabytes = getattr(sitesettings, 'stats_parallel_megabytes', 64)
+        try:
+            size = self.notebook_events_path().stat().st_size
+        except FileNotFoundError:
+            return 1
+        return workers if size >= megabytes * 2**20 else 1
+
+    def _sealed_summaries(self, staff):
+        """
+        the summaries of the closed segments, see segments.py
+        """
+        keep_student = self._keep_student_function(staff)
+        grain_seconds = int(self.material_usage_grain.total_seconds())
+        return [segment.summary(staff, keep_student, grain_seconds)
+                for segment in self.segments().events()]
+
+    def _parallel_scan(self, staff, workers, daily=True, material=True):
+        """
+        scan events.raw from scratch with that many processes,
+        and merge with the summaries of the closed segments;
+        with workers == 1, events.raw is scanned in this process
+
+        returns a tuple (daily_state, material) where
+        * daily_state is a state as returned by _new_daily_state,
+          or None if not requested, or if events are too much out of order
+          - see DailyMetrics.from_partials
+        * material is a MaterialUsage instance, or None if not requested
+        both are None if anything goes wrong
+        """
+        events_path = self.notebook_events_path()
+        try:
+            keep_student = self._keep_student_function(staff)
+            grain_seconds = int(self.material_usage_grain.total_seconds())
+            sealed = [summary['partial'] for summary in self._sealed_summaries(staff)]
+            if workers > 1:
+                partials = parallel.map_ranges(
+                    events_path, workers, keep_student, grain_seconds,
+                    daily=daily, material=material)
+            else:
+                partials = [parallel.parse_range(
+                    events_path, 0, events_path.stat().st_size,
+                    keep_student, grain_seconds, daily=daily, material=material)]
+            daily_state = None
+            if daily:
+                metrics = DailyMetrics.from_partials(sealed + partials)
+                if metrics is None:
+                    logger.info("{}: events out of order - cannot merge daily metrics"
+                                .format(events_path))
+                else:
+                    daily_state = self._new_daily_state(staff)
+                    offset = partials[-1].offset
+                    daily_state.update(
+                        metrics=metrics,
+                        inode=events_path.stat().st_ino,
+                        head=self._events_head(events_path, offset),
+                        offset=offset,
+                        lineno=sum(partial.nb_lines for partial in partials),
+                        segments=True)
+            material_usage = None
+            if material:
+                material_usage = MaterialUsage.from_partials(
+                    sealed + partials, self.material_usage_grain)
+            return daily_state, material_usage
+        except Exception as e:
+            logger.exception("{}: parallel scan failed".format(events_path))
+            return None, None
+
+    def _events_window(self, since=None, until=None):
+        """
+        locate the part of events.raw that holds the events
+        in [since, until] (epochs, either can be None), using the day index
+
+        returns a window suitable for _scan_events, i.e. a tuple
+        (start_offset, start_lineno, end_offset, since_timestamp, until_timestamp,
+         segments) where segments are the closed segments for the months
+        in that range, or None if there is no event in that range
+        """
+        index = self.events_index()
+        if not index.exists() or not index.is_valid():
+            logger.info("{}: rebuilding day index".format(self.course_dir))
+            with self.columnar_events().locked():
+                index.rebuild()
+        since_timestamp = None if since is None \
+                          else time.strftime(time_format, time.gmtime(since))
+        until_timestamp = None if until is None \
+                          else time.strftime(time_format, time.gmtime(until))
+        window = index.window(since_timestamp and since_timestamp[:10],
+                              until_timestamp and until_timestamp[:10])
+        segments = self.segments().events(since_timestamp and since_timestamp[:7],
+                                          until_timestamp and until_timestamp[:7])
+        if window is None:
+            if not segments:
+                return None
+            # nothing to read in events.raw
+            window = (0, 0, 0)
+        return window + (since_timestamp, until_timestamp, segments)
+
+    def _scan_events(self, keep_student, daily_state=None, material=None,
+                     window=None):
+        """
+        the one loop over events, that feeds
+        * daily_state['metrics'] - if daily_state is provided - with
+          the events past daily_state['offset'] in events.raw; daily_state
+          is updated to account for the lines read
+        * material - if provided - with all events
+
+        the closed segments are read first, when needed, i.e. for material,
+        and for a daily_state that does not account for them yet
+
+        if window is provided - see _events_window - only that part
+        of events.raw and of the segments is read, and only events in the
+        time range are considered; in that case daily_state is expected
+        to start at the window
+
+        only considers events for students that pass keep_student,
+        and ignores the events from monitor, like 'killing'
+        """
+        events_path = self.notebook_events_path()
+        end_offset, since_timestamp, until_timestamp = None, None, None
+        daily_metrics = daily_state['metrics'] if daily_state is not None else None
+        daily_segments = daily_state is not None and not daily_state['segments']
+        if window is not None:
+            offset, lineno, end_offset, since_timestamp, until_timestamp, segments \
+                = window
+        else:
+            if material is not None:
+                offset, lineno = 0, 0
+            else:
+                offset, lineno = daily_state['offset'], daily_state['lineno']
+            segments = self.segments().events() \
+                       if material is not None or daily_segments else []
+        daily_offset = daily_state['offset'] if daily_state is not None else None
+
+        def scan_line(bytes_line, source, lineno, daily):
+            try:
+                line = bytes_line.decode()
+                timestamp, course, student, notebook, action, port = line.split()
+                if since_timestamp is not None and timestamp < since_timestamp:
+                    return
+                if until_timestamp is not None and timestamp > until_timestamp:
+                    return
+                # if action is 'killing' then notebook is '-'
+                # which should not be counted as a notebook of course
+                # so let's ignore these lines altogether
+                # same for 'pausing' and 'culling', that are not opens either
+                if action in non_open_actions:
+                    return
+                # ignore staff or other artefact users
+                if not keep_student(student):
+                    return
+                if material is not None:
+                    material.add_event(timestamp, student, notebook)
+                if daily:
+                    daily_metrics.add_event(timestamp, student, notebook)
+            except Exception as e:
+                logger.exception("{}:{}: skipped misformed events line :{}"
+                                 .format(source, lineno, bytes_line))
+
+        for segment in segments:
+            for segment_lineno, bytes_line in enumerate(segment.lines(), 1):
+                scan_line(bytes_line, segment.path, segment_lineno, daily_segments)
+        with events_path.open('rb') as f:
+            f.seek(offset)
+            for bytes_line in f:
+                # the last line may still be in the process of being written
+                # leave it for next time
+                if not bytes_line.endswith(b'\n'):
+                    break
+                if end_offset is not None and offset >= end_offset:
+                    break
+                line_offset = offset
+                offset += len(bytes_line)
+                lineno += 1
+                scan_line(bytes_line, events_path, lineno,
+                          daily_metrics is not None and line_offset >= daily_offset)
+        if daily_state is not None:
+            daily_state.update(
+                inode=events_path.stat().st_ino,
+                head=self._events_head(events_path, offset),
+                offset=offset, lineno=lineno, segments=True)
+
+    def daily_metrics(self, staff=None, since=None, until=None, workers=None):
         """
         read the events file for that course and produce
         data arrays suitable for being composed under plotly
@@ -222,76 +1081,204 @@ class Stats:
           (one per day, time is always 23:59:59)
         * 'events': { 'timestamps', 'total_students', 'total_notebooks' } 
            - all 3 same size
+
+        the state of the computation is checkpointed in daily_checkpoint_path()
+        so that the next call only needs to parse the lines appended since then
+
+        since and until optionally restrict the time range (as epochs);
+        only that part of events.raw is read, thanks to the day index,
+        and totals are then relative to the beginning of the range
+
+        when there is no checkpoint, events.raw may be scanned with
+        several processes, see _parallel_workers
         """
-        
+        if staff is None:
+            staff = CourseDir(self.course).staff
+        if since is not None or until is not None:
+            return self._daily_metrics_window(staff, since, until)
         events_path = self.notebook_events_path()
-        # a dictionary day -> figures
-        figures_by_day = OrderedDict()
-        previous_figures = None
-        current_figures = DailyFigures()
-        # the events dimension
-        accumulator = TotalsAccumulator()
-        #
-        staff = CourseDir(self.course).staff
+        state = self._load_daily_checkpoint(events_path, staff)
+        if state is None:
+            workers = self._parallel_workers(workers)
+            if workers > 1 or self.segments().events():
+                state, _ = self._parallel_scan(staff, workers, material=False)
+        state = state or self._new_daily_state(staff)
         try:
-            with events_path.open() as f:
-                for lineno, line in enumerate(f, 1):
-                    try:
-                        timestamp, course, student, notebook, action, port = line.split()
-                        # if action is 'killing' then notebook is '-'
-                        # which should not be counted as a notebook of course
-                        # so let's ignore these lines altogether
-                        if action == 'killing':
-                            continue
-                        # ignore staff or other artefact users
-                        if student in staff or not edx_hash_regexp.match(student):
-                            continue
-                        day = timestamp.split('T')[0] + ' 23:59:59'
-                        if day in figures_by_day:
-                            current_figures = figures_by_day[day]
-                        else:
-                            current_figures.wrap()
-                            previous_figures = current_figures
-                            current_figures = DailyFigures(previous_figures)
-                            figures_by_day[day] = current_figures
-                        current_figures.add_notebook(notebook)
-                        current_figures.add_student(student)
-                        accumulator.insert(
-                            timestamp,
-                            current_figures.nb_total_students(),
-                            current_figures.nb_total_notebooks())
-                    except Exception as e:
-                        logger.exception("{}:{}: skipped misformed events line :{}"
-                                         .format(events_path, lineno, line))
-                        continue
+            # after a parallel scan, this takes care of recent events
+            self._scan_events(self._keep_student_function(staff),
+                              daily_state=state)
+            # save state before it gets altered by result()
+            self._store_daily_checkpoint(state)
         except Exception as e:
             logger.exception("unexpected exception in daily_metrics")
-        finally:
-            current_figures.wrap()
-            accumulator.wrap()
-            daily_timestamps = []
-            unique_students = []
-            unique_notebooks = []
-            new_students = []
-            new_notebooks = []
-
-            for timestamp, figures in figures_by_day.items():
-                daily_timestamps.append(timestamp)
-                unique_students.append(figures.nb_unique_students)
-                unique_notebooks.append(figures.nb_unique_notebooks)
-                new_students.append(figures.nb_new_students)
-                new_notebooks.append(figures.nb_new_notebooks)
-
-            return { 'daily' : { 'timestamps' : daily_timestamps,
-                                 'unique_students' : unique_students,
-                                 'unique_notebooks' : unique_notebooks,
-                                 'new_students' : new_students,
-                                 'new_notebooks' : new_notebooks},
-                     'events' : { 'timestamps' : accumulator.timestamps,
-                                  'total_students' : accumulator.students,
-                                  'total_notebooks' : accumulator.notebooks}}
-                
-    def monitor_counts(self):
+        return state['metrics'].result()
+
+    def _daily_metrics_window(self, staff, since, until):
+        # no checkpointing here
+        state = self._new_daily_state(staff)
+        try:
+            window = self._events_window(since, until)
+            if window is not None:
+                state['offset'], state['lineno'] = window[:2]
+                self._scan_events(self._keep_student_function(staff),
+                                  daily_state=state, window=window)
+        except Exception as e:
+            logger.exception("unexpected exception in daily_metrics")
+        return state['metrics'].result()
+
+    def student_timeline(self, student):
+        """
+        all the events for that student, using the student index,
+        so that events.raw does not need to be scanned; closed segments
+        are only read if their summary mentions that student
+
+        returns a dict with the following keys, all lists of the same size
+        * 'timestamps'
+        * 'notebooks' - '-' for a container being killed
+        * 'actions' - like 'started' or 'running', or 'killing'
+        * 'ports'
+        """
+        result = {'student' : student, 'timestamps' : [], 'notebooks' : [],
+                  'actions' : [], 'ports' : []}
+        def add_line(source, bytes_line):
+            try:
+                timestamp, _, line_student, notebook, action, port = \
+                    bytes_line.decode().split()
+                if line_student != student:
+                    return
+            except Exception as e:
+                logger.error("{}: skipped misformed events line {}"
+                             .format(source, bytes_line))
+                return
+            result['timestamps'].append(timestamp)
+            result['notebooks'].append(notebook)
+            result['actions'].append(action)
+            result['ports'].append(port)
+        # only the closed segments where that student shows up are read
+        staff = CourseDir(self.course).staff
+        for segment, summary in zip(self.segments().events(),
+                                    self._sealed_summaries(staff)):
+            if student in summary['students']:
+                for bytes_line in segment.lines():
+                    add_line(segment.path, bytes_line)
+        events_path = self.notebook_events_path()
+        if not events_path.exists():
+            return result
+        index = self.student_index()
+        store = self.columnar_events()
+        if not index.exists() or not index.is_valid():
+            logger.info("{}: rebuilding student index".format(self.course_dir))
+            with store.locked():
+                index.rebuild()
+        with store.locked(shared=True):
+            offsets = index.offsets(student)
+        with events_path.open('rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                add_line("{}@{}".format(events_path, offset), f.readline())
+        return result
+
+    def _iter_monitor_counts(self, since=None, until=None):
+        """
+        iterate over the lines in the counts file - and in the closed
+        segments before that - restricted to the [since, until] range
+        if specified (epochs); yields tuples (timestamp, values) where
+        values has one integer - or None - per item in known_counts
+        """
+        counts_path = self.monitor_counts_path()
+        since_timestamp = None if since is None \
+                          else time.strftime(time_format, time.gmtime(since))
+        until_timestamp = None if until is None \
+                          else time.strftime(time_format, time.gmtime(until))
+        for segment in self.segments().counts(since_timestamp and since_timestamp[:7],
+                                              until_timestamp and until_timestamp[:7]):
+            yield from self._parse_counts_lines(
+                segment.path, segment.lines(), since_timestamp, until_timestamp)
+        try:
+            f = counts_path.open('rb')
+        except FileNotFoundError:
+            return
+        with f:
+            if since_timestamp is not None:
+                seek_timestamp(f, since_timestamp)
+            # line numbers are relative when since is specified
+            yield from self._parse_counts_lines(
+                counts_path, f, None, until_timestamp)
+
+    def _parse_counts_lines(self, path, bytes_lines, since_timestamp, until_timestamp):
+        known_counts = self.known_counts
+        max_counts = len(known_counts)
+        for lineno, bytes_line in enumerate(bytes_lines, 1):
+            line = bytes_line.decode()
+            if line.startswith('#'):
+                # ignore any comment
+                continue
+            try:
+                timestamp, *values = line.split()
+                if since_timestamp is not None and timestamp < since_timestamp:
+                    continue
+                if until_timestamp is not None and timestamp > until_timestamp:
+                    break
+                # each line should have at most len(known_counts)
+                # and should all contain integers
+                if len(values) > max_counts:
+                    logger.error("{}:{}: counts line has too many fields - {} > {}"
+                                 .format(path, lineno, len(values), max_counts))
+                    continue
+                ivalues = [int(v) for v in values]
+                # fill in for missing values
+                ivalues += [None] * (max_counts - len(values))
+                yield timestamp, ivalues
+            except Exception as e:
+                logger.exception("{}:{}: skipped misformed counts line - {}"
+                                 .format(path, lineno, line))
+
+    def _monitor_counts_bounds(self):
+        """
+        the epochs of the first and last lines in the counts file,
+        or None, None
+        """
+        first = next(self._iter_monitor_counts(), None)
+        last = self.last_monitor_counts()
+        if first is None or last is None:
+            return None, None
+        return (epoch_from_timestamp(first[0]),
+                epoch_from_timestamp(last[0]))
+
+    def last_monitor_counts(self):
+        """
+        the last line in the counts file - or in the last closed segment
+        if the counts file has none yet - as a tuple
+        (timestamp, { count: value }) with counts as in known_counts,
+        or None if there is none
+        """
+        try:
+            try:
+                with self.monitor_counts_path().open('rb') as f:
+                    f.seek(0, os.SEEK_END)
+                    f.seek(max(0, f.tell() - 4096))
+                    # the last item is either empty or still being written
+                    lines = [line for line in f.read().split(b'\n')[:-1]
+                             if line and not line.startswith(b'#')]
+            except FileNotFoundError:
+                lines = []
+            if not lines:
+                segments = self.segments().counts()
+                if not segments:
+                    return None
+                lines = [line for line in segments[-1].lines()
+                         if not line.startswith(b'#')]
+            timestamp, *values = lines[-1].decode().split()
+            return timestamp, dict(zip(self.known_counts,
+                                       (int(v) for v in values)))
+        except IndexError:
+            return None
+        except Exception as e:
+            logger.exception("cannot read last counts line for {}"
+                             .format(self.course))
+            return None
+
+    def monitor_counts(self, since=None, until=None, max_points=None):
         """
         read the counts file for that course and produce
         data arrays suitable for plotly
@@ -303,48 +1290,73 @@ class Stats:
         * 'running_jupyters': running containers
         * 'total_jupyters' :  total containers
         * ...
+
+        since and until optionally restrict the time range (as epochs)
+
+        if max_points is specified, the finest resolution that
+        has at most that many points over the time range is used;
+        with the hourly or daily rollups, values are the means over each
+        bucket, and the min and max values come in additional keys
+        like 'running_jupyters_min' and 'running_jupyters_max';
+        in all cases the 'resolution' key tells which one was used
         """
-        counts_path = self.monitor_counts_path()
+        if max_points is not None:
+            rollups = self.counts_rollups()
+            if rollups.exists():
+                first, last = self._monitor_counts_bounds()
+                if first is not None:
+                    start = since if since is not None else first
+                    end = until if until is not None else last
+                    span = max(0, end - start)
+                    if span / rollups.raw_period() > max_points:
+                        for resolution, period in rollup_resolutions:
+                            if span / period <= max_points:
+                                break
+                        return rollups.read(resolution, since, until)
         timestamps = []
         counts = { count: [] for count in self.known_counts}
-        known_counts = self.known_counts
-        max_counts = len(known_counts)
         try:
-            with counts_path.open() as f:
-                for lineno, line in enumerate(f, 1):
-                    if line.startswith('#'):
-                        # ignore any comment
-                        continue
-                    try:
-                        timestamp, *values = line.split()
-                        timestamps.append(timestamp)
-                        # each line should have at most len(known_counts)
-                        # and should all contain integers
-                        if len(values) > max_counts:
-                            logger.error("{}:{}: counts line has too many fields - {} > {}"
-                                         .format(counts_path, lineno, len(values), max_counts))
-                            continue
-                        ivalues = [int(v) for v in values]
-                        for count, ivalue in zip(known_counts, ivalues):
-                            counts[count].append(ivalue)
-                        # fill in for missing values
-                        missing = max_counts - len(values)
-                        if missing > 0:
-                            for count in known_counts[-missing:]:
-                                counts[count].append(None)
-                    except Exception as e:
-                        logger.exception("{}:{}: skipped misformed counts line - {}"
-                                         .format(counts_path, lineno, line))
-        except:
-            pass
-        finally:
-            # add as many keys (with an extra 's') as we have known keys
-            result = { "{}s".format(count) : counts[count] for count in self.known_counts }
-            # do not forget the timestamps
-            result['timestamps'] = timestamps
-            return result
+            for timestamp, values in self._iter_monitor_counts(since, until):
+                timestamps.append(timestamp)
+                for count, value in zip(self.known_counts, values):
+                    counts[count].append(value)
+        except Exception as e:
+            logger.exception("unexpected exception in monitor_counts")
+        # add as many keys (with an extra 's') as we have known keys
+        result = { "{}s".format(count) : counts[count] for count in self.known_counts }
+        # do not forget the timestamps
+        result['timestamps'] = timestamps
+        result['resolution'] = 'raw'
+        return result
+
+    # the grain for nbstudents_per_notebook_animated
+    material_usage_grain = timedelta(hours=6)
+
+    def _material_usage_engine(self, engine):
+        """
+        returns the engine to use, taking into account the availability
+        of the columnar store for the numpy engine, and whether it is
+        consistent with events.raw
+        """
+        if engine is None:
+            engine = getattr(sitesettings, 'stats_engine', 'numpy')
+        if engine == 'numpy':
+            store = self.columnar_events()
+            events_path = self.notebook_events_path()
+            if not store.exists():
+                logger.info("no columnar store in {} - using python engine"
+                            .format(self.course_dir))
+                engine = 'python'
+            elif not store.is_valid(events_path, self.events_index()):
+                logger.warning("columnar store in {} is out of sync with {} - "
+                               "using python engine; rebuild it with "
+                               "python -m nbhosting.stats.columnar {}"
+                               .format(self.course_dir, events_path.name, self.course))
+                engine = 'python'
+        return engine
 
-    def material_usage(self):
+    def material_usage(self, engine=None, staff=None, since=None, until=None,
+                       workers=None, **heatmap_options):
         """
         read the events file and produce data about relations 
         between notebooks and students
@@ -352,99 +1364,159 @@ class Stats:
         'nbstudents' : how many students are considered (test students are removed..)
         'nbstudents_per_notebook' : a sorted list of tuples (notebook, nb_students)
                                   how many students have read this notebook
-        'nbstudents_per_notebook_animated' : same but animated over time
+        'nbstudents_per_notebook_animated' : same but animated over time, as a keyframe
+                                  and deltas - see nbhosting.stats.timebuckets.AnimatedCounts
         'nbstudents_per_nbnotebooks' : a sorted list of tuples (nb_notebooks, nb_students)
                                   how many students have read exactly that number of notebooks
         'heatmap' : a complete matrix notebook x student ready to feed to plotly.heatmap
                     comes with 'x', 'y' and 'z' keys
+
+        engine is either 'python' or 'numpy', and defaults to
+        sitesettings.stats_engine; the numpy engine works on the columnar
+        store, so the python engine is used if that store does not exist,
+        or is not consistent with events.raw
+
+        heatmap_options allow to select another encoding for the heatmap,
+        see nbhosting.stats.heatmap.heatmap
+
+        since and until optionally restrict the time range (as epochs)
+
+        with the python engine, events.raw may be scanned with
+        several processes, see _parallel_workers
         """
+        if staff is None:
+            staff = CourseDir(self.course).staff
+        keep_student = self._keep_student_function(staff)
+        windowed = since is not None or until is not None
+        if self._material_usage_engine(engine) == 'numpy':
+            events = self.columnar_events().load()
+            if windowed:
+                events = events.window(since, until)
+            return vectorized.material_usage(
+                events, keep_student,
+                self.material_usage_grain, time_format, **heatmap_options)
+        if not windowed:
+            workers = self._parallel_workers(workers)
+            if workers > 1 or self.segments().events():
+                _, material = self._parallel_scan(staff, workers, daily=False)
+                if material is not None:
+                    return material.result(**heatmap_options)
+        material = MaterialUsage(self.material_usage_grain)
+        try:
+            if not windowed:
+                self._scan_events(keep_student, material=material)
+            else:
+                window = self._events_window(since, until)
+                if window is not None:
+                    self._scan_events(keep_student, material=material,
+                                      window=window)
+        except Exception as e:
+            logger.exception("could not read {} to count students per notebook"
+                             .format(self.notebook_events_path()))
+        return material.result(**heatmap_options)
 
-        events_path = self.notebook_events_path()
-        # a dict notebook -> set of students
-        set_by_notebook = defaultdict(set)
-        nbstudents_per_notebook_buckets = TimeBuckets(grain=timedelta(hours=6),
-                                                      time_format=time_format)
-        # a dict student -> set of notebooks
-        set_by_student = defaultdict(set)
-        # a dict hashed on a tuple (notebook, student) -> number of visits
-        raw_counts = defaultdict(int)
-        #
+    def all_metrics(self, engine=None, since=None, until=None,
+                    counts_options=None, **heatmap_options):
+        """
+        the results of daily_metrics, monitor_counts and material_usage
+        in a single dict with these 3 keys
+
+        since and until restrict the time range for daily_metrics and
+        material_usage; counts_options are passed to monitor_counts,
+        and heatmap_options to material_usage
+
+        this is cheaper than calling the 3 methods separately, as
+        the staff is read only once, and events.raw is scanned only once
+        (and only from the daily_metrics checkpoint on, when using the numpy engine)
+        """
         staff = CourseDir(self.course).staff
+        keep_student = self._keep_student_function(staff)
+        engine = self._material_usage_engine(engine)
+        windowed = since is not None or until is not None
+        material = MaterialUsage(self.material_usage_grain) \
+                   if engine == 'python' else None
         try:
-            with events_path.open() as f:
-                for lineno, line in enumerate(f, 1):
-                    date, _, student, notebook, action, *_ = line.split()
-                    # action 'killing' needs to be ignored
-                    if action in ('killing',):
-                        continue
-                    # ignore staff or other artefact users
-                    if student in staff or not edx_hash_regexp.match(student):
-                        logger.debug("ignoring staff or artefact student {}"
-                                     .format(student))
-                        continue
-                    # animated data must be taken care of before anything else
-                    previous, next, changed = nbstudents_per_notebook_buckets.prepare(date)
-                    if changed:
-                        nspn = [ (notebook, len(set_by_notebook[notebook]))
-                                for notebook in sorted(set_by_notebook)]
-                        nbstudents_per_notebook_buckets.record_data(nspn, previous, next)
-                    set_by_notebook[notebook].add(student)
-                    set_by_student[student].add(notebook)
-                    raw_counts[notebook, student] += 1
+            if not windowed:
+                events_path = self.notebook_events_path()
+                daily_state = self._load_daily_checkpoint(events_path, staff)
+                workers = self._parallel_workers()
+                scanned = None
+                sealed = self.segments().events()
+                if daily_state is None and (workers > 1 or sealed):
+                    daily_state, scanned = self._parallel_scan(
+                        staff, workers, material=material is not None)
+                elif material is not None and sealed:
+                    # rather than decompressing the closed segments
+                    _, scanned = self._parallel_scan(staff, workers, daily=False)
+                daily_state = daily_state or self._new_daily_state(staff)
+                # after a parallel scan, this takes care of recent events
+                self._scan_events(keep_student, daily_state=daily_state,
+                                  material=material if scanned is None else None)
+                if scanned is not None:
+                    material = scanned
+                self._store_daily_checkpoint(daily_state)
+            else:
+                daily_state = self._new_daily_state(staff)
+                window = self._events_window(since, until)
+                if window is not None:
+                    daily_state['offset'], daily_state['lineno'] = window[:2]
+                    self._scan_events(keep_student, daily_state=daily_state,
+                                      material=material, window=window)
         except Exception as e:
-            logger.exception("could not read {} to count students per notebook"
-                             .format(events_path))
-
-        finally:
-            nbstudents_per_notebook = [
-                (notebook, len(set_by_notebook[notebook]))
-                for notebook in sorted(set_by_notebook)
-            ]
-            nb_by_student = { student: len(s) for (student, s) in set_by_student.items() }
-
-            nbstudents_per_notebook_animated = nbstudents_per_notebook_buckets.wrap(nbstudents_per_notebook)
-            
-            # counting in the other direction is surprisingly tedious
-            nbstudents_per_nbnotebooks = [
-                (number, iter_len(v))
-                for (number, v) in itertools.groupby(sorted(nb_by_student.values()))
-            ]
-            # the heatmap
-            heatmap_notebooks = sorted(set_by_notebook.keys())
-            heatmap_students = sorted(set_by_student.keys())
-            # a first attempt at showing the number of times a given notebook was open
-            # by a given student resulted in poor outcome
-            # problem being mostly with colorscale, we'd need to have '0' stick out
-            # as transparent or something, but OTOH sending None instead or 0 
-            heatmap_z = [
-                [raw_counts.get( (notebook, student,), None) for notebook in heatmap_notebooks]
-                for student in heatmap_students
-            ]
-            # sort students on total number of opened notebooks
-            heatmap_z.sort(key = lambda student_line: sum(x for x in student_line if x))
-
-            zmax = max( max(x for x in line if x) for line in heatmap_z )
-            zmin = min( min(x for x in line if x) for line in heatmap_z )
-                
-            return {
-                'nbnotebooks' : len(set_by_notebook),
-                'nbstudents' : len(set_by_student),
-                'nbstudents_per_notebook' : nbstudents_per_notebook,
-                'nbstudents_per_notebook_animated' : nbstudents_per_notebook_animated,
-                'nbstudents_per_nbnotebooks' : nbstudents_per_nbnotebooks,
-                'heatmap' : {'x' : heatmap_notebooks, 'y' : heatmap_students,
-                             'z' : heatmap_z,
-                             'zmin' : zmin, 'zmax' : zmax,
-                },
-            }
+            logger.exception("unexpected exception in all_metrics")
+        if material is not None:
+            material_usage = material.result(**heatmap_options)
+        else:
+            events = self.columnar_events().load()
+            if windowed:
+                events = events.window(since, until)
+            material_usage = vectorized.material_usage(
+                events, keep_student,
+                self.material_usage_grain, time_format, **heatmap_options)
+        return {
+            'daily_metrics' : daily_state['metrics'].result(),
+            'monitor_counts' : self.monitor_counts(**(counts_options or {})),
+            'material_usage' : material_usage,
+        }
 
 if __name__ == '__main__':
-    import sys
-    course = 'fp' if len(sys.argv) == 1 else sys.argv[1]
-    d = Stats(course).daily_metrics()
-    for cat, cat_dict in d.items():
-        print("---------- {cat}".format(**locals()))
-        for k, v in cat_dict.items():
-            print(" {k} -> {len_v} items".
-                  format(k=k, len_v=len(v)))
-    #d = Stats(course).monitor_counts()
+    from argparse import ArgumentParser
+    # offline recomputation, e.g. after a deploy, so that
+    # the web app finds checkpoints and indexes in place
+    from nbhosting.courses.models import CoursesDir
+    parser = ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="number of processes for parsing events - "
+                             "default is the number of cores")
+    parser.add_argument("-m", "--material-usage", action='store_true', default=False,
+                        help="also compute material usage with the python engine")
+    parser.add_argument("-s", "--seal", action='store_true', default=False,
+                        help="also move the previous months into closed segments")
+    parser.add_argument("courses", nargs='*',
+                        help="courses to recompute - default is all courses")
+    args = parser.parse_args()
+    for course in (args.courses or CoursesDir().coursenames()):
+        stats = Stats(course)
+        if not stats.notebook_events_path().exists():
+            print("{}: no events file - skipped".format(course))
+            continue
+        begin = time.time()
+        # start from scratch
+        checkpoint_path = stats.daily_checkpoint_path()
+        if checkpoint_path.exists():
+            checkpoint_path.unlink()
+        d = stats.daily_metrics(workers=args.workers)
+        with stats.columnar_events().locked():
+            stats.events_index().rebuild()
+            stats.student_index().rebuild()
+        if args.seal:
+            stats.seal_segments()
+        print("{}: {} days, {} events points in {:.2f}s"
+              .format(course, len(d['daily']['timestamps']),
+                      len(d['events']['timestamps']), time.time() - begin))
+        if args.material_usage:
+            begin = time.time()
+            m = stats.material_usage(engine='python', workers=args.workers)
+            print("{}: {} students x {} notebooks in {:.2f}s"
+                  .format(course, m['nbstudents'], m['nbnotebooks'],
+                          time.time() - begin))
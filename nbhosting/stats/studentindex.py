@@ -0,0 +1,207 @@
+"""
+an index of events.raw by student
+
+it allows to find all the lines for one student without reading the
+whole events file; it is made of 3 files in raw/<course>/
+
+* events.bystudent.dict   the students, one per line, so that an id
+                          is a line number - see columnar.Interner
+* events.bystudent        one record per indexed line, made of two int64:
+                          the offset of the line in events.raw, and the
+                          number of the previous record for the same student,
+                          or -1
+* events.bystudent.heads  one int64 per student id: the number
+                          of the last record for that student
+
+so the records for one student form a chain, that is walked backwards
+from its head; adding a line costs one append and one in-place write
+
+like the day index, it is updated as events get written, which requires
+to hold the same lock as for writing events.raw; it can also be rebuilt
+from scratch
+"""
+
+import os
+import struct
+
+from nbhosting.stats.columnar import Interner
+from nbhosting.main.settings import logger
+
+record_format = struct.Struct("<qq")
+head_format = struct.Struct("<q")
+
+
+def parse_student(bytes_line):
+    """
+    the student in an events line, or None if the line is misformed
+    """
+    try:
+        timestamp, course, student, notebook, action, port = \
+            bytes_line.decode().split()
+        return student
+    except Exception as e:
+        return None
+
+
+class StudentIndex:
+
+    def __init__(self, events_path, course_dir):
+        self.events_path = events_path
+        self.records_path = course_dir / "events.bystudent"
+        self.heads_path = course_dir / "events.bystudent.heads"
+        self.students = Interner(course_dir / "events.bystudent.dict")
+
+    def exists(self):
+        return all(path.exists() for path in
+                   (self.records_path, self.heads_path, self.students.path))
+
+    def create(self):
+        """
+        create an empty index - caller must hold the lock
+        """
+        for path in self.records_path, self.heads_path, self.students.path:
+            path.touch()
+
+    def _nb_records(self):
+        return self.records_path.stat().st_size // record_format.size
+
+    def _read_head(self, heads, id):
+        heads.seek(id * head_format.size)
+        bytes = heads.read(head_format.size)
+        if len(bytes) < head_format.size:
+            return -1
+        return head_format.unpack(bytes)[0]
+
+    def record(self, student, offset):
+        """
+        to be called - with the lock held - when a line for that student
+        is about to be written at that offset in events.raw
+        """
+        self.students.refresh()
+        id = self.students.intern(student)
+        nb_records = self._nb_records()
+        with self.heads_path.open('r+b') as heads:
+            previous = self._read_head(heads, id)
+            with self.records_path.open('ab') as records:
+                # a previous record may have been interrupted halfway
+                records.truncate(nb_records * record_format.size)
+                records.write(record_format.pack(offset, previous))
+            # fill the gap, if any, with -1
+            heads.seek(0, os.SEEK_END)
+            missing = id - heads.tell() // head_format.size
+            if missing > 0:
+                heads.write(head_format.pack(-1) * missing)
+            heads.seek(id * head_format.size)
+            heads.write(head_format.pack(nb_records))
+
+    def rebuild(self):
+        """
+        rebuild the index from scratch - to be called with the lock held
+        """
+        ids, records, heads = {}, [], []
+        offset = 0
+        with self.events_path.open('rb') as events:
+            for bytes_line in events:
+                # the last line may still be in the process of being written
+                if not bytes_line.endswith(b'\n'):
+                    break
+                student = parse_student(bytes_line)
+                # ignore misformed lines
+                if student is not None:
+                    id = ids.setdefault(student, len(ids))
+                    if id == len(heads):
+                        heads.append(-1)
+                    records.append((offset, heads[id]))
+                    heads[id] = len(records) - 1
+                offset += len(bytes_line)
+        # write everything aside, and then rename
+        renames = []
+        def tmp(path):
+            tmp_path = path.with_name(path.name + ".tmp")
+            renames.append((tmp_path, path))
+            return tmp_path
+        with tmp(self.records_path).open('wb') as f:
+            for record in records:
+                f.write(record_format.pack(*record))
+        with tmp(self.heads_path).open('wb') as f:
+            for head in heads:
+                f.write(head_format.pack(head))
+        with tmp(self.students.path).open('w') as f:
+            # dicts preserve insertion order, i.e. ids
+            for student in ids:
+                f.write(student + "\n")
+        for tmp_path, path in renames:
+            tmp_path.rename(path)
+
+    def is_valid(self):
+        """
+        check that the index is consistent with events.raw, i.e. that
+        the last record points at the beginning of a line, and that there
+        is no well-formed line after that one
+        """
+        try:
+            nb_records = self._nb_records()
+            with self.events_path.open('rb') as events:
+                if nb_records == 0:
+                    offset = 0
+                else:
+                    with self.records_path.open('rb') as records:
+                        records.seek((nb_records - 1) * record_format.size)
+                        offset, _ = record_format.unpack(
+                            records.read(record_format.size))
+                    if offset > 0:
+                        events.seek(offset - 1)
+                        if events.read(1) != b'\n':
+                            return False
+                    else:
+                        events.seek(0)
+                    if parse_student(events.readline()) is None:
+                        return False
+                for bytes_line in events:
+                    if bytes_line.endswith(b'\n') \
+                       and parse_student(bytes_line) is not None:
+                        return False
+            return True
+        except Exception as e:
+            logger.exception("cannot check student index for {}"
+                             .format(self.events_path))
+            return False
+
+    def offsets(self, student):
+        """
+        the offsets in events.raw of all the lines for that student,
+        in file order; caller should hold the lock in shared mode
+        """
+        self.students.refresh()
+        id = self.students.index.get(student)
+        if id is None:
+            return []
+        result = []
+        with self.heads_path.open('rb') as heads, \
+             self.records_path.open('rb') as records:
+            current = self._read_head(heads, id)
+            while current >= 0:
+                records.seek(current * record_format.size)
+                offset, previous = record_format.unpack(
+                    records.read(record_format.size))
+                result.append(offset)
+                # records only point backwards
+                if previous >= current:
+                    logger.error("{}: broken chain for {}"
+                                 .format(self.records_path, student))
+                    break
+                current = previous
+        result.reverse()
+        return result
+
+
+# one instance per course directory and per process, so that
+# the dictionary does not get re-read from scratch on each event
+_student_indexes_by_dir = {}
+
+def student_index(events_path, course_dir):
+    try:
+        return _student_indexes_by_dir[course_dir]
+    except KeyError:
+        return _student_indexes_by_dir.setdefault(
+            course_dir, StudentIndex(events_path, course_dir))
@@ -1,3 +1,5 @@
+import time
+import calendar
 from collections import OrderedDict
 from datetime import datetime, timedelta
 
@@ -26,6 +28,8 @@ class TimeBuckets:
     """
 
     epoch = datetime(year=2017, month=1, day=1)
+    # same, as a number of seconds since the unix epoch
+    epoch_seconds = calendar.timegm(epoch.timetuple())
 
     def __init__(self, grain: timedelta, time_format):
         self.grain = grain
@@ -69,7 +73,113 @@ class TimeBuckets:
     def wrap(self, data):
         self.record_data(data, self.quotient)
         return self._make_readable()
-        
+
+
+class AnimatedCounts:
+    """
+    a cheaper replacement for TimeBuckets, for counts that only increase,
+    like the number of students per notebook
+
+    the caller owns no data; instead it calls
+    * advance(epoch) for each event, before counting anything about it,
+      with epoch a number of seconds since the unix epoch
+    * increment(item) each time the count for item increases,
+      items being dense ids
+    and finally encode() to get the result
+
+    buckets are the same as with TimeBuckets, but for each bucket
+    only the items whose count has changed are remembered
+    """
+
+    # same as TimeBuckets
+    origin = TimeBuckets.epoch_seconds
+
+    def __init__(self, grain: timedelta, time_format):
+        self.grain = int(grain.total_seconds())
+        self.time_format = time_format
+        # item -> count
+        self.counts = {}
+        # items changed in the current bucket
+        self.changed = set()
+        # one tuple (quotient, {item: count}) per closed bucket
+        self.frames = []
+        self.quotient = None
+        # the current bucket is [start, end)
+        self.start, self.end = None, None
+
+    def advance(self, epoch):
+        if self.start is not None and self.start <= epoch < self.end:
+            return
+        quotient = (epoch - self.origin) // self.grain
+        if self.quotient is not None and quotient != self.quotient:
+            self._close()
+        self.quotient = quotient
+        self.start = self.origin + quotient * self.grain
+        self.end = self.start + self.grain
+
+    def increment(self, item, delta=1):
+        self.counts[item] = self.counts.get(item, 0) + delta
+        self.changed.add(item)
+
+    def _close(self):
+        counts = self.counts
+        self.frames.append((self.quotient,
+                            {item: counts[item] for item in self.changed}))
+        self.changed = set()
+
+    def _frames_in_order(self):
+        """
+        like with TimeBuckets, a bucket that is seen again - which happens
+        if time goes backwards - keeps its first position and its last data;
+        in that case, deltas need to be recomputed
+        """
+        quotients = [quotient for quotient, _ in self.frames]
+        if len(set(quotients)) == len(quotients):
+            return self.frames
+        states = OrderedDict()
+        state = {}
+        for quotient, delta in self.frames:
+            state.update(delta)
+            states[quotient] = dict(state)
+        frames = []
+        previous = {}
+        for quotient, state in states.items():
+            frames.append((quotient, {item: count for item, count in state.items()
+                                      if previous.get(item) != count}))
+            previous = state
+        return frames
+
+    def encode(self, names):
+        """
+        names maps items to their names
+
+        closes the current bucket, and returns a dict with
+        * 'notebooks' : the sorted names of all items
+        * 'timestamps' : the end of each bucket
+        * 'keyframe' : the counts at the end of the first bucket
+        * 'deltas' : for each next bucket, the counts that have changed
+        where counts are given as [index in 'notebooks', count] pairs
+        """
+        if self.quotient is not None:
+            self._close()
+            self.quotient, self.start, self.end = None, None, None
+        order = sorted(self.counts, key=lambda item: names[item])
+        index_of_item = {item: index for index, item in enumerate(order)}
+        timestamps = []
+        pairs_list = []
+        for quotient, delta in self._frames_in_order():
+            timestamps.append(time.strftime(
+                self.time_format,
+                time.gmtime(self.origin + (quotient + 1) * self.grain)))
+            pairs_list.append(sorted([index_of_item[item], count]
+                                     for item, count in delta.items()))
+        return {
+            'notebooks' : [names[item] for item in order],
+            'timestamps' : timestamps,
+            'keyframe' : pairs_list[0] if pairs_list else [],
+            'deltas' : pairs_list[1:],
+        }
+
 
 if __name__ == '__main__':
     tb = TimeBuckets(grain = timedelta(hours=1), time_format="%Y-%m-%dT%H:%M:%S")
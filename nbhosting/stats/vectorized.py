@@ -0,0 +1,130 @@
+"""
+numpy-based implementations of the Stats computations
+
+these work on the columnar store (see columnar.py) rather than
+on events.raw, and must return the exact same results as their
+pure python counterparts in stats.py
+"""
+
+import numpy as np
+
+from nbhosting.stats.columnar import non_open_actions
+from nbhosting.stats.timebuckets import AnimatedCounts
+from nbhosting.stats.heatmap import heatmap
+
+
+def factorize(ids, names):
+    """
+    ids is an array of ids in names (typically from the columnar store)
+
+    returns a tuple (codes, sorted_names) where
+    * sorted_names is the sorted list of the names actually used in ids
+    * codes is an array of the same size as ids, with the
+      index of each name in sorted_names
+    """
+    used = np.unique(ids)
+    sorted_names = sorted(names[i] for i in used.tolist())
+    # map ids to their rank in sorted_names
+    rank = {name: code for code, name in enumerate(sorted_names)}
+    id_to_code = np.zeros(len(names), dtype=np.int64)
+    for i in used.tolist():
+        id_to_code[i] = rank[names[i]]
+    return id_to_code[ids], sorted_names
+
+
+def material_usage(events, keep_student, grain, time_format, **heatmap_options):
+    """
+    events is a LoadedEvents instance
+    keep_student is a function name -> bool, to filter out staff and artefacts
+    heatmap_options are passed to nbhosting.stats.heatmap.heatmap
+
+    see Stats.material_usage for details on the result
+    """
+    # a mask over student ids
+    kept_students = np.fromiter((keep_student(name) for name in events.student_names),
+                                dtype=bool, count=len(events.student_names))
+    mask = kept_students[events.students] if len(events) else np.zeros(0, dtype=bool)
+    for action in non_open_actions:
+        action_id = events.action_id(action)
+        if action_id is not None:
+            mask &= (events.actions != action_id)
+    times = events.times[mask]
+    student_codes, students = factorize(events.students[mask], events.student_names)
+    notebook_codes, notebooks = factorize(events.notebooks[mask], events.notebook_names)
+    nb_students, nb_notebooks = len(students), len(notebooks)
+
+    # one item per (student, notebook) couple actually seen
+    # that's our sparse count matrix
+    pairs = student_codes * nb_notebooks + notebook_codes
+    unique_pairs, first_index, inverse = np.unique(
+        pairs, return_index=True, return_inverse=True)
+    pair_counts = np.bincount(inverse.ravel(), minlength=len(unique_pairs))
+    pair_students = unique_pairs // nb_notebooks if nb_notebooks else unique_pairs
+    pair_notebooks = unique_pairs % nb_notebooks if nb_notebooks else unique_pairs
+
+    students_per_notebook = np.bincount(pair_notebooks, minlength=nb_notebooks)
+    notebooks_per_student = np.bincount(pair_students, minlength=nb_students)
+
+    nbstudents_per_notebook = list(zip(notebooks, students_per_notebook.tolist()))
+
+    numbers, how_many = np.unique(notebooks_per_student, return_counts=True)
+    nbstudents_per_nbnotebooks = list(zip(numbers.tolist(), how_many.tolist()))
+
+    # the animated version
+    # the indices of the events that change time bucket
+    animated = AnimatedCounts(grain=grain, time_format=time_format)
+    grain_seconds = int(grain.total_seconds())
+    quotients = (times - animated.origin) // grain_seconds
+    changes = np.flatnonzero(quotients[1:] != quotients[:-1]) + 1
+    # snapshot j is the state right before event changes[j]
+    # the last one being the final state
+    # a couple first seen at index f counts in all snapshots j
+    # such that f < changes[j]
+    first_snapshot = np.searchsorted(changes, first_index, side='right')
+    nb_snapshots = len(changes) + 1
+    # how many couples show up in each snapshot, per notebook
+    increments = np.bincount(first_snapshot * nb_notebooks + pair_notebooks,
+                             minlength=nb_snapshots * nb_notebooks)
+    increments = increments.reshape(nb_snapshots, nb_notebooks)
+
+    # replay time bucket changes, so that AnimatedCounts
+    # has the exact same behaviour as with the python engine
+    if len(times):
+        animated.advance(int(times[0]))
+    for j in range(nb_snapshots):
+        row = increments[j]
+        for code in np.flatnonzero(row).tolist():
+            animated.increment(code, int(row[code]))
+        if j < len(changes):
+            animated.advance(int(times[changes[j]]))
+    nbstudents_per_notebook_animated = animated.encode(notebooks)
+
+    # the heatmap, one line per student, sorted on total number of opened notebooks
+    student_totals = np.bincount(pair_students, weights=pair_counts,
+                                 minlength=nb_students)
+    order = np.argsort(student_totals, kind='stable')
+    line_of_student = np.empty(nb_students, dtype=np.int64)
+    line_of_student[order] = np.arange(nb_students)
+    pair_lines = line_of_student[pair_students]
+    by_line = np.lexsort((pair_notebooks, pair_lines))
+    line_columns = pair_notebooks[by_line]
+    line_counts = pair_counts[by_line]
+    bounds = np.searchsorted(pair_lines[by_line], np.arange(nb_students + 1)).tolist()
+
+    def lines():
+        for line in range(nb_students):
+            begin, end = bounds[line], bounds[line+1]
+            yield list(zip(line_columns[begin:end].tolist(),
+                           line_counts[begin:end].tolist()))
+
+    return {
+        'nbnotebooks' : nb_notebooks,
+        'nbstudents' : nb_students,
+        'nbstudents_per_notebook' : nbstudents_per_notebook,
+        'nbstudents_per_notebook_animated' : nbstudents_per_notebook_animated,
+        'nbstudents_per_nbnotebooks' : nbstudents_per_nbnotebooks,
+        'heatmap' : heatmap(notebooks, students, lines(),
+                            int(pair_counts.min()) if len(pair_counts) else None,
+                            int(pair_counts.max()) if len(pair_counts) else None,
+                            **heatmap_options),
+    }
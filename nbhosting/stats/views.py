@@ -1,11 +1,24 @@
-import json
+import os
+import hashlib
+from collections import OrderedDict
 
 from django.shortcuts import render
 from django.http import HttpResponse, HttpResponseNotFound, HttpResponseRedirect
+from django.http import HttpResponseBadRequest, StreamingHttpResponse, FileResponse
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.views.decorators.csrf import csrf_protect
 from django.contrib.auth.decorators import login_required
 
+from nbhosting.version import __version__
+from nbhosting.main.settings import sitesettings
 from nbhosting.stats.stats import Stats
+from nbhosting.stats.products import computer, json_chunks
+from nbhosting.stats.snapshots import Snapshots, page_query
+from nbhosting.stats.overview import overview
+from nbhosting.stats.livestream import live_events
+from nbhosting.courses.models import CoursesDir, CourseDir
 
 # Create your views here.
 
@@ -79,6 +92,10 @@ def show_stats(request, course):
               'title' : 'CPU loads',
               'hide' : True,
             },
+            { 'div_id' : 'plotly-container-usage',
+              'title' : 'Memory and CPU used by containers',
+              'hide' : True,
+            },
         ]
     ))
 
@@ -91,27 +108,204 @@ def show_stats(request, course):
     # propagate server_name to html template
     server_name = request.META['SERVER_NAME'].split('.')[0]
 
-    env = dict(course=course, sections=sections, server_name=server_name)
+    env = dict(course=course, sections=sections, server_name=server_name,
+               page_query=page_query)
 
     return render(request, "stats.html", env)
 
+class EncodedCache:
+    """
+    a per-process LRU cache of encoded JSON results
+    bounded by the total size of the cached bytes
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        encoded = self.entries.get(key)
+        if encoded is not None:
+            self.entries.move_to_end(key)
+        return encoded
+
+    def put(self, key, encoded):
+        if len(encoded) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.total_bytes -= len(self.entries.pop(key))
+        self.entries[key] = encoded
+        self.total_bytes += len(encoded)
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+
+encoded_cache = EncodedCache(
+    1024 * 1024 * getattr(sitesettings, 'stats_cache_megabytes', 32))
+
+
+def tee_into_cache(chunks, etag):
+    """
+    pass chunks along, and store them in encoded_cache
+    unless they turn out to be too big for that
+    """
+    kept, size = [], 0
+    for chunk in chunks:
+        if kept is not None:
+            size += len(chunk)
+            if size <= encoded_cache.max_bytes:
+                kept.append(chunk)
+            else:
+                kept = None
+        yield chunk
+    if kept is not None:
+        encoded_cache.put(etag, b"".join(kept))
+
+
+def send_snapshot(request, stats, product):
+    """
+    answer with the snapshot precomputed by nbh-monitor, if
+    there is a recent enough one for that request; returns None otherwise
+    """
+    max_age = getattr(sitesettings, 'stats_snapshots_max_age', 3600)
+    path = Snapshots(stats).find(product, request.GET.urlencode(), max_age)
+    if path is None:
+        return None
+    gzip_path = Snapshots.gzip_path(path)
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '') \
+       and gzip_path.exists():
+        path, encoding = gzip_path, 'gzip'
+    else:
+        encoding = None
+    try:
+        snapshot = path.open('rb')
+    except FileNotFoundError:
+        return None
+    # the file may have been replaced in the meanwhile
+    stat = os.fstat(snapshot.fileno())
+    key = "{} snapshot {} {}-{}-{}".format(__version__, path,
+                                           stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    etag = quote_etag(hashlib.sha1(key.encode()).hexdigest())
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        snapshot.close()
+        return response
+    response = FileResponse(snapshot, content_type = "application/json")
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Vary'] = 'Accept-Encoding'
+    response['ETag'] = etag
+    return response
+
+
+def send_json(request, course, product):
+    """
+    answer with the JSON encoding of that product
+
+    unless fresh=1 is specified, a snapshot precomputed
+    by nbh-monitor is used if available
+
+    the ETag is derived from the files that the product depends upon,
+    so a browser that already has the current version gets a 304;
+    otherwise a previously encoded result is served from encoded_cache
+    if available, and the product is computed only as a last resort
+
+    the result is streamed, so large parts of the result
+    can be provided as generators
+    """
+    try:
+        compute = computer(product, request.GET)
+    except ValueError as e:
+        return HttpResponseBadRequest("{}".format(e))
+    stats = Stats(course)
+    if not request.GET.get('fresh'):
+        response = send_snapshot(request, stats, product)
+        if response is not None:
+            return response
+    key = "{} {} {} {}".format(__version__, stats.signature(product),
+                               getattr(sitesettings, 'stats_engine', 'numpy'),
+                               request.GET.urlencode())
+    etag = quote_etag(hashlib.sha1(key.encode()).hexdigest())
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        return response
+    encoded = encoded_cache.get(etag)
+    if encoded is not None:
+        response = HttpResponse(encoded, content_type = "application/json")
+    else:
+        response = StreamingHttpResponse(
+            tee_into_cache(json_chunks(compute(stats)), etag),
+            content_type = "application/json")
+    response['ETag'] = etag
+    return response
+
+
 @csrf_protect
 def send_daily_metrics(request, course):
-    stats = Stats(course)
-    encoded = json.dumps(stats.daily_metrics())
-    return HttpResponse(encoded, content_type = "application/json")
+    return send_json(request, course, 'daily_metrics')
 
 
 @csrf_protect
 def send_monitor_counts(request, course):
-    stats = Stats(course)
-    encoded = json.dumps(stats.monitor_counts())
-    return HttpResponse(encoded, content_type = "application/json")
+    return send_json(request, course, 'monitor_counts')
 
 
 @csrf_protect
 def send_material_usage(request, course):
-    stats = Stats(course)
-    encoded = json.dumps(stats.material_usage())
-    return HttpResponse(encoded, content_type = "application/json")
+    return send_json(request, course, 'material_usage')
+
+
+@csrf_protect
+def send_all_metrics(request, course):
+    """
+    what the stats page needs, in a single request
+    """
+    return send_json(request, course, 'all_metrics')
+
+
+@login_required
+@csrf_protect
+def send_student_timeline(request, course, student):
+    """
+    what that student did in that course, see Stats.student_timeline
+    """
+    return JsonResponse(Stats(course).student_timeline(student))
+
+
+@login_required
+@csrf_protect
+def send_live(request, course):
+    """
+    a stream of server-sent events about that course, see livestream.py
+    """
+    response = StreamingHttpResponse(
+        live_events(Stats(course), CourseDir(course).staff),
+        content_type = "text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    # so that nginx does not buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required
+@csrf_protect
+def show_overview(request):
+    """
+    the headline figures of all courses on a single page
+    """
+    server_name = request.META['SERVER_NAME'].split('.')[0]
+    # the caches are kept up to date by nbh-monitor,
+    # so this does not need a process pool
+    headlines_by_course = overview(CoursesDir().coursenames(), workers=1)
+    env = dict(headlines_by_course=headlines_by_course, server_name=server_name)
+    return render(request, "stats-overview.html", env)
+
 
+@login_required
+@csrf_protect
+def send_overview(request):
+    """
+    same as show_overview, as JSON
+    """
+    return JsonResponse(overview(CoursesDir().coursenames(), workers=1))
@@ -22,6 +22,7 @@ setup(
     long_description = long_description,
     install_requires = [
         'Django',
+        'numpy',
     ],
     setup_requires = [],
     tests_require = [],
@@ -0,0 +1,145 @@
+"""
+unit tests for nbhosting.stats.monitor.ContainerTable, that
+drive the table with a fake dockerd and a synthetic events feed
+
+run with e.g.
+    python -m unittest tests/test_container_table.py
+"""
+
+import time
+import threading
+import unittest
+
+from nbhosting.stats.monitor import ContainerTable
+
+
+class FakeContainer:
+    def __init__(self, id, name, status):
+        self.id, self.name, self.status = id, name, status
+
+
+class FakeDocker:
+    """
+    db maps container ids to (name, status) tuples;
+    list() can be held up with the hold event
+    """
+    def __init__(self, db):
+        self.db = db
+        self.hold = None
+        self.listing = threading.Event()
+
+    def list(self, all=False):
+        self.listing.set()
+        containers = [FakeContainer(id, name, status)
+                      for id, (name, status) in self.db.items()]
+        if self.hold is not None:
+            self.hold.wait(5)
+        return containers
+
+    def get(self, id):
+        name, status = self.db[id]
+        return FakeContainer(id, name, status)
+
+    @property
+    def containers(self):
+        return self
+
+
+def event(action, id, name, time=100):
+    return {'Type': 'container', 'Action': action, 'time': time,
+            'Actor': {'ID': id, 'Attributes': {'name': name}}}
+
+
+class TestContainerTable(unittest.TestCase):
+
+    def setUp(self):
+        self.docker = FakeDocker({
+            '1': ('crs-x-s1', 'running'),
+            '2': ('crs-x-s2', 'exited'),
+            '3': ('crs-x-s3', 'paused'),
+        })
+        self.table = ContainerTable()
+        self.table.reconcile(self.docker)
+
+    def statuses(self):
+        return {container.name: status
+                for container, status in self.table.snapshot()}
+
+    def test_reconcile(self):
+        self.assertEqual(self.statuses(), {
+            'crs-x-s1': 'running',
+            'crs-x-s2': 'stopped',
+            'crs-x-s3': 'paused',
+        })
+        self.assertFalse(self.table.needs_reconcile(3600))
+
+    def test_create_start_die_destroy(self):
+        self.docker.db['4'] = ('crs-x-s4', 'created')
+        self.table.apply(event('create', '4', 'crs-x-s4'), self.docker.get)
+        self.assertEqual(self.statuses()['crs-x-s4'], 'stopped')
+        self.docker.db['4'] = ('crs-x-s4', 'running')
+        self.table.apply(event('start', '4', 'crs-x-s4'), self.docker.get)
+        self.assertEqual(self.statuses()['crs-x-s4'], 'running')
+        self.table.apply(event('die', '4', 'crs-x-s4'), self.docker.get)
+        self.assertEqual(self.statuses()['crs-x-s4'], 'stopped')
+        self.table.apply(event('destroy', '4', 'crs-x-s4'), self.docker.get)
+        self.assertNotIn('crs-x-s4', self.statuses())
+
+    def test_pause_unpause(self):
+        self.table.apply(event('pause', '1', 'crs-x-s1'), self.docker.get)
+        self.assertEqual(self.statuses()['crs-x-s1'], 'paused')
+        self.table.apply(event('unpause', '1', 'crs-x-s1'), self.docker.get)
+        self.assertEqual(self.statuses()['crs-x-s1'], 'running')
+        self.table.apply(event('unpause', '3', 'crs-x-s3'), self.docker.get)
+        self.assertEqual(self.statuses()['crs-x-s3'], 'running')
+
+    def test_ignored_events(self):
+        before = self.statuses()
+        self.table.follow([
+            event('exec_start: bash', '1', 'crs-x-s1', time=101),
+            {'Type': 'network', 'Action': 'connect', 'time': 102},
+            # already gone when inspected
+            event('start', '99', 'crs-x-gone', time=103),
+        ], self.docker.get)
+        self.assertEqual(self.statuses(), before)
+        self.assertEqual(self.table.since, 103)
+
+    def test_mark(self):
+        self.table.mark('crs-x-s1', 'stopped')
+        self.table.mark('crs-x-s2', 'paused')
+        self.assertEqual(self.statuses(), {
+            'crs-x-s1': 'stopped',
+            'crs-x-s2': 'paused',
+            'crs-x-s3': 'paused',
+        })
+
+    def test_events_during_reconcile(self):
+        # the list reflects the state before these events
+        self.docker.hold = threading.Event()
+        self.docker.listing.clear()
+        thread = threading.Thread(target=self.table.reconcile, args=(self.docker,))
+        thread.start()
+        self.assertTrue(self.docker.listing.wait(5))
+        # none of this must block while the list is in progress
+        beg = time.time()
+        self.docker.db['1'] = ('crs-x-s1', 'exited')
+        self.table.apply(event('die', '1', 'crs-x-s1'), self.docker.get)
+        self.docker.db['5'] = ('crs-x-s5', 'running')
+        self.table.apply(event('start', '5', 'crs-x-s5'), self.docker.get)
+        self.table.mark('crs-x-s3', 'stopped')
+        self.table.snapshot()
+        self.assertLess(time.time() - beg, 1)
+        self.docker.hold.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.statuses(), {
+            'crs-x-s1': 'stopped',
+            'crs-x-s2': 'stopped',
+            'crs-x-s3': 'stopped',
+            'crs-x-s5': 'running',
+        })
+        self.assertIsNone(self.table.journal)
+
+
+if __name__ == '__main__':
+    unittest.main()
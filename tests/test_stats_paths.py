@@ -0,0 +1,162 @@
+"""
+unit tests for nbhosting.stats.stats.Stats, that check that the
+incremental ways of computing daily_metrics and material_usage -
+from a checkpoint, with several processes, or on top of closed
+segments - give the same results as a plain scan of events.raw
+
+run with e.g.
+    python -m unittest tests/test_stats_paths.py
+"""
+
+import time
+import json
+import random
+import tempfile
+import unittest
+import calendar
+from pathlib import Path
+
+from nbhosting.stats import stats as stats_module
+from nbhosting.courses import models as courses_module
+from nbhosting.stats.stats import Stats, time_format
+
+
+def student(index):
+    return "{:032x}".format(0xabc0 + index)
+
+
+def make_lines(course, months, per_day=6, seed=0):
+    """
+    a few events per day, for each day in months like '2018-01',
+    for a handful of students - plus staff and artefacts
+    """
+    rng = random.Random(seed)
+    students = [student(i) for i in range(8)] + ['staff0', 'student']
+    notebooks = ["w{}/nb{}".format(w, n) for w in range(1, 3) for n in range(1, 4)]
+    actions = ['opening', 'opening', 'running', 'killing']
+    lines = []
+    for month in months:
+        year, month_number = (int(x) for x in month.split('-'))
+        for day in range(1, 29, 3):
+            epoch = calendar.timegm((year, month_number, day, 8, 0, 0))
+            for _ in range(per_day):
+                epoch += rng.randrange(60, 3600)
+                action = rng.choice(actions)
+                notebook = '-' if action == 'killing' else rng.choice(notebooks)
+                timestamp = time.strftime(time_format, time.gmtime(epoch))
+                lines.append("{} {} {} {} {} {}\n".format(
+                    timestamp, course, rng.choice(students), notebook, action, 9000))
+    return lines
+
+
+def normalized(result):
+    # tuples vs lists
+    return json.loads(json.dumps(result))
+
+
+class TestStatsPaths(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        root = Path(tmpdir.name)
+        for module in stats_module, courses_module:
+            self.addCleanup(setattr, module, 'nbhroot', module.nbhroot)
+            module.nbhroot = root
+        self.root = root
+        self.staff = {'staff0'}
+        self.nb_courses = 0
+
+    def new_stats(self):
+        self.nb_courses += 1
+        course = "course{}".format(self.nb_courses)
+        course_dir = self.root / "courses" / course
+        course_dir.mkdir(parents=True)
+        (course_dir / ".staff").write_text("".join(
+            "{}\n".format(name) for name in self.staff))
+        return Stats(course)
+
+    def append(self, stats, lines):
+        with stats.notebook_events_path().open('a') as f:
+            f.write("".join(lines))
+
+    def reference(self, lines):
+        """
+        the results of a plain scan, on a fresh course with these lines
+        """
+        stats = self.new_stats()
+        self.append(stats, lines)
+        return (normalized(stats.daily_metrics(workers=1)),
+                normalized(stats.material_usage(engine='python', workers=1)))
+
+    def check(self, stats, lines, workers=1):
+        daily, material = self.reference(lines)
+        self.assertEqual(normalized(stats.daily_metrics(workers=workers)), daily)
+        self.assertEqual(normalized(stats.material_usage(engine='python',
+                                                         workers=workers)),
+                         material)
+        all_metrics = normalized(stats.all_metrics(engine='python'))
+        self.assertEqual(all_metrics['daily_metrics'], daily)
+        self.assertEqual(all_metrics['material_usage'], material)
+
+    def test_appends_after_checkpoint(self):
+        lines = make_lines('x', ['2018-01', '2018-02'])
+        stats = self.new_stats()
+        third = len(lines) // 3
+        self.append(stats, lines[:third])
+        self.check(stats, lines[:third])
+        self.assertTrue(stats.daily_checkpoint_path().exists())
+        self.append(stats, lines[third:2*third])
+        self.check(stats, lines[:2*third])
+        # a line being written is not accounted for until it is complete
+        last = lines[2*third]
+        self.append(stats, [last[:20]])
+        self.check(stats, lines[:2*third])
+        self.append(stats, [last[20:]] + lines[2*third+1:])
+        self.check(stats, lines)
+
+    def test_truncate_and_rewrite(self):
+        lines = make_lines('x', ['2018-01', '2018-02'])
+        stats = self.new_stats()
+        self.append(stats, lines)
+        self.check(stats, lines)
+        # truncated
+        half = lines[:len(lines) // 2]
+        stats.notebook_events_path().write_text("".join(half))
+        self.check(stats, half)
+        # rewritten with other contents, and larger than before
+        other = make_lines('x', ['2018-01', '2018-02', '2018-03'], seed=1)
+        with stats.notebook_events_path().open('r+') as f:
+            f.write("".join(other))
+        self.check(stats, other)
+
+    def test_sealed_segments(self):
+        lines = make_lines('x', ['2018-01', '2018-02', '2018-03'])
+        stats = self.new_stats()
+        self.append(stats, lines)
+        self.check(stats, lines)
+        stats.seal_segments('2018-03')
+        self.assertEqual(len(stats.segments().events()), 2)
+        self.assertTrue(stats.notebook_events_path().read_text()
+                        .startswith('2018-03'))
+        # with the checkpoint made before sealing
+        self.check(stats, lines)
+        # and from scratch
+        stats.daily_checkpoint_path().unlink()
+        self.check(stats, lines)
+        more = make_lines('x', ['2018-04'], seed=2)
+        self.append(stats, more)
+        self.check(stats, lines + more)
+
+    def test_several_workers(self):
+        lines = make_lines('x', ['2018-01', '2018-02', '2018-03'], per_day=20)
+        stats = self.new_stats()
+        self.append(stats, lines)
+        self.check(stats, lines, workers=3)
+        stats.daily_checkpoint_path().unlink()
+        stats.seal_segments('2018-02')
+        self.check(stats, lines, workers=3)
+
+
+if __name__ == '__main__':
+    unittest.main()